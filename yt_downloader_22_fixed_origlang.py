@@ -22,55 +22,213 @@ YouTube Downloader GUI (Tkinter + yt-dlp)
 - «Добавить в очередь» берёт ссылку из буфера (если это URL)
 - ДВА ЛОГА: слева «Важные сообщения», справа «Подробный лог (yt-dlp)» (горизонтальный сплит)
 - Защита от «очень длинных» названий: умное сокращение в UI и при переименовании
+- Параллельная очередь: N одновременных загрузок (настраивается, сохраняется в конфиге),
+  прогресс/скорость по каждой задаче в колонке «Прогресс»
+- Дисковый кэш метаданных (~/.yt_gui_downloader_cache): анализ, названия в очереди и проба
+  перед загрузкой не извлекают одно и то же видео повторно, в том числе между запусками
+- Очередь хранится на диске (SQLite, ~/.yt_gui_downloader_queue.sqlite3) и восстанавливается
+  после закрытия/падения; прерванные задачи снова становятся «Ожидает»
+- Архив скачанного (ID видео + пресет → файл): уже скачанное пропускается без запросов в сеть,
+  опция «перекачивать, если пресет другой», импорт архива yt-dlp (--download-archive)
+- Общий лимит скорости на все загрузки (меняется на лету), необязательный лимит на одну загрузку
+  и расписание по времени суток; число параллельных фрагментов подбирается по лимиту и числу
+  активных загрузок
+- Очередь с индексом по стабильным ID задач: поиск, удаление и номер «[i/N]» без линейных
+  проходов — десятки тысяч задач не тормозят обновление прогресса
+- Таблица очереди виртуальная: создаются только видимые строки, обновления применяются раз
+  в кадр; фильтр по статусу и сортировка кликом по заголовку колонки
+- Прогресс и статусы из рабочих потоков идут через общий канал и применяются окном 10 раз
+  в секунду одним проходом — без обращений к Tk из фоновых потоков
+- Сводка по всей очереди: скорость (скользящее среднее), скачано/осталось, ETA, задач в час —
+  в строке статуса, в консоли и в ~/.yt_gui_downloader_stats.json
+- Повторы по классу ошибки (HTTP 429/403, сеть, извлечение, ffmpeg, возрастное ограничение):
+  экспоненциальная пауза со случайным разбросом, задача уходит в конец очереди, история попыток
+  по задаче вместо всплывающих окон
+- Общий темп запросов по сайтам для всех экземпляров yt-dlp (отдельно метаданные и медиа),
+  автоматическое замедление после HTTP 429 и возврат к обычному темпу; счётчики в окне
+- Плейлисты и каналы в очереди разворачиваются плоской экстракцией в задачи по видео,
+  порциями по мере прихода страниц: загрузка начинается сразу, форматы выбираются перед каждым видео
+- Подписки на каналы/плейлисты: хранятся виденные ID видео, проверка листает канал только
+  до уже известных и ставит в очередь новые видео с пресетом подписки (кнопка, --sync, --daemon)
+- Конвейер очереди: загрузчики отдают скачанные потоки отдельному пулу ffmpeg (по потоку на ядро)
+  и сразу берут следующую ссылку; глубина очереди и занятость каждой стадии — в сводке
+- Аудио из плейлиста (одиночная загрузка) перекодируется параллельно пулом ffmpeg по числу ядер,
+  пока качаются следующие треки; -threads у каждого ffmpeg — чтобы ядра не делились с перебором
+- «Только аудио»: предпочитается исходный поток в выбранном кодеке (Opus, AAC, …) с достаточным
+  битрейтом — он копируется без перекодирования; в логе видно, копирование было или перекодирование
+- Быстрый старт: yt-dlp импортируется в фоне, пока строится окно; проверка ffmpeg и версия
+  yt-dlp — не на пути к первому кадру
+- Перед загрузкой задача резервирует место под свой пик на диске (части + итоговый файл + копия
+  при remux); если места мало, задача ждёт, пока закончат другие, а не падает посреди загрузки
+- Консольный режим без окна (движок DownloadEngine общий с GUI):
+    python yt_downloader_22_fixed_origlang.py --batch links.txt --workers 4 --vcodec av1
+    python yt_downloader_22_fixed_origlang.py --daemon --batch links.txt --poll 60
+    python yt_downloader_22_fixed_origlang.py --sub-add https://www.youtube.com/@channel --quality 1080
+    python yt_downloader_22_fixed_origlang.py --sync                      (разово, например из cron)
+    python yt_downloader_22_fixed_origlang.py --daemon --sync-every 60
+  пресет по умолчанию — настройки окна; --help — все параметры
 © 2025
 """
 
 import os
+import re
+import errno
 import sys
 import json
+import gzip
+import heapq
+import hashlib
+import itertools
+import random
 import threading
 import time
 import shutil
 import subprocess
 import importlib
+import sqlite3
+import argparse
+import signal
 import tkinter as tk
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from tkinter import ttk, filedialog, messagebox
-from dataclasses import dataclass, field
-from typing import List, Optional, Tuple
+from dataclasses import asdict, dataclass, field, fields, replace
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 # ---------- Настройки сокращений ----------
 MAX_UI_TITLE = 80        # сколько символов показывать в статусе/таблице (умное многоточие по середине)
 MAX_QUEUE_TITLE = 70     # для колонки "Название"
+QUEUE_FILTER_ALL = "Все задачи"
 SAFE_MAX_PATH = 240      # безопасная длина полного пути (Windows без LongPaths)
 MIN_BASE_LEN = 20        # минимальная длина видимой части Title при ужатии имени файла
 
+# Сколько секунд info из пробы считается свежим для повторного использования при загрузке
+# (ссылки на потоки YouTube живут ~6 ч, берём с запасом)
+PROBE_INFO_MAX_AGE = 3600
+
+# Параллельная очередь
+DEFAULT_QUEUE_WORKERS = 3   # сколько задач очереди качаем одновременно
+MAX_QUEUE_WORKERS = 16
+DEFAULT_PROBE_WORKERS = 4   # сколько названий/метаданных очереди получаем одновременно
+MAX_PROBE_WORKERS = 16
+# Пост-обработка очереди (ffmpeg: объединение, remux, извлечение аудио) — отдельный пул, по потоку
+# на ядро: пока ffmpeg собирает одно видео, загрузчик уже качает следующее. Если собранных файлов
+# ждёт больше POSTPROC_MAX_BACKLOG на поток, загрузчик ждёт — несобранные части не копятся на диске.
+POSTPROC_WORKERS = max(1, os.cpu_count() or 1)
+POSTPROC_MAX_BACKLOG = 2
+# Место на диске: перед загрузкой задача резервирует оценку своего пика (части + итоговый файл
+# + копия при remux) в папке назначения. Не помещается, пока качают другие, — задача ждёт в хвосте
+# очереди и проверяет снова через DISK_HOLD_RECHECK с; DISK_RESERVE_MARGIN всегда остаётся свободным.
+DISK_RESERVE_MARGIN = 512 * 1024 * 1024
+DISK_HOLD_RECHECK = 30
+
+# Плейлисты/каналы в очереди разворачиваются плоской экстракцией в задачи по видео — порциями,
+# по мере прихода страниц; форматы каждого видео выбираются уже при его загрузке
+PLAYLIST_BATCH = 50              # сколько записей добавлять в очередь за раз
+PLAYLIST_BATCH_INTERVAL = 1.0    # ... или не реже, чем раз в столько секунд
+PLAYLIST_MAX_DEPTH = 3           # вложенность (канал → вкладки → плейлисты)
+
+# Повторы неудачных задач очереди: класс ошибки → подпись, всего попыток, базовая пауза и потолок (с).
+# Пауза растёт вдвое с каждой попыткой, плюс случайный разброс, чтобы воркеры не били в сайт разом.
+RETRY_POLICIES = {
+    "http429": {"label": "HTTP 429 (слишком много запросов)", "max_attempts": 5, "base": 60, "cap": 900},
+    "http403": {"label": "HTTP 403 (доступ запрещён)", "max_attempts": 3, "base": 15, "cap": 300},
+    "network": {"label": "сетевая ошибка", "max_attempts": 6, "base": 5, "cap": 300},
+    "extractor": {"label": "ошибка извлечения", "max_attempts": 2, "base": 30, "cap": 120},
+    "ffmpeg": {"label": "ошибка ffmpeg", "max_attempts": 2, "base": 5, "cap": 30},
+    "age_gate": {"label": "возрастное ограничение (нужны cookies)", "max_attempts": 1, "base": 0, "cap": 0},
+    "disk": {"label": "нет места на диске", "max_attempts": 1, "base": 0, "cap": 0},
+    "other": {"label": "ошибка загрузки", "max_attempts": 2, "base": 10, "cap": 60},
+}
+# Классы, при которых резервная сборка в MKV бессмысленна: дело не в контейнере
+RETRY_NO_MKV_FALLBACK = ("http429", "http403", "network", "extractor", "age_gate", "disk")
+
+# Логи: строки копятся в буфере и вставляются в виджеты пачкой по таймеру
+LOG_FLUSH_INTERVAL_MS = 100
+LOG_MAX_LINES = 5000         # сколько строк хранит каждый лог-виджет (кольцо)
+LOG_MAX_PENDING = 20000      # сколько строк может ждать вставки; более старые отбрасываются
+PROGRESS_SAMPLE_MS = 100     # окно забирает прогресс/статусы рабочих потоков 10 раз в секунду
+
 # Путь к файлу конфигурации
 CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".yt_gui_downloader_config.json")
 
+# Кэш метаданных extract_info (рядом с конфигом)
+METADATA_CACHE_DIR = os.path.join(os.path.dirname(CONFIG_PATH), ".yt_gui_downloader_cache")
+METADATA_STREAM_TTL = PROBE_INFO_MAX_AGE     # пока живы ссылки на потоки — info годится для загрузки
+METADATA_MAX_AGE = 30 * 24 * 3600            # название/длительность/форматы/языки храним месяц
+METADATA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+METADATA_CACHE_MAX_ENTRIES = 5000
+
+# Очередь на диске (SQLite): переживает закрытие/падение приложения
+QUEUE_DB_PATH = os.path.join(os.path.dirname(CONFIG_PATH), ".yt_gui_downloader_queue.sqlite3")
+QUEUE_HISTORY_MAX_AGE = 30 * 24 * 3600       # сколько хранить строки выполненных задач
+
+# Архив скачанного (ID видео + отпечаток пресета → файл): повторные прогоны не качают то же самое
+ARCHIVE_DB_PATH = os.path.join(os.path.dirname(CONFIG_PATH), ".yt_gui_downloader_archive.sqlite3")
+ARCHIVE_HASH_CHUNK = 1024 * 1024             # хэш файла — по первому и последнему мегабайту + размер
+
+# Подписки на каналы/плейлисты: виденные ID видео, синхронизация докачивает только новые
+SUBSCRIPTIONS_DB_PATH = os.path.join(os.path.dirname(CONFIG_PATH), ".yt_gui_downloader_subscriptions.sqlite3")
+SUBSCRIPTION_KNOWN_STREAK = 3    # остановка после стольких подряд уже виденных записей (закреп/премьеры
+                                 # могут стоять выше новых видео, поэтому не на первой же)
+SUBSCRIPTION_INITIAL_MARK = 100  # первая синхронизация без «скачать вышедшие»: столько последних видео
+                                 # запоминаются как виденные, в очередь не идут
+
+# Сводка по очереди: скорость (скользящее среднее), ETA, задач/час; снимок в JSON для внешних скриптов
+QUEUE_STATS_PATH = os.path.join(os.path.dirname(CONFIG_PATH), ".yt_gui_downloader_stats.json")
+QUEUE_STATS_INTERVAL = 5.0      # как часто переписывать файл статистики, с
+THROUGHPUT_WINDOW = 20          # окно скользящего среднего скорости, с
+
+# Ограничение скорости и параллельные фрагменты (DASH/HLS)
+FRAGMENT_BUDGET = 16            # всего одновременных фрагментов на все загрузки (без лимита скорости)
+MAX_FRAGMENT_CONCURRENCY = 8    # на одну загрузку
+FRAGMENT_RATE_STEP = 512 * 1024 # при лимите: один поток фрагментов на каждые 512 KB/s доли загрузки
+
+# Темп запросов по хостам (общий для всех экземпляров YoutubeDL): метаданные — страницы/API сайта,
+# медиа — CDN с потоками. rps — запросов в секунду, inflight — одновременных извлечений (meta)
+# или загрузок (media) с одного сайта. После HTTP 429 хост замедляется вдвое (до 1/16),
+# каждые HOST_RECOVERY_S без новых 429 — возвращается на ступень назад.
+HOST_LIMITS = {
+    "meta": {"rps": 5.0, "inflight": 3},
+    "media": {"rps": 20.0, "inflight": 8},
+}
+HOST_MEDIA_DOMAINS = ("googlevideo.com", "akamaized.net", "cloudfront.net", "fbcdn.net", "cdninstagram.com",
+                      "twimg.com", "vimeocdn.com", "ttvnw.net", "tiktokcdn.com")
+HOST_COOLDOWN_S = 10.0         # пауза хоста после 429 без Retry-After (растёт с каждой ступенью)
+HOST_MAX_COOLDOWN_S = 300.0
+HOST_RECOVERY_S = 60.0
+HOST_MAX_SLOWDOWN = 4          # ступеней замедления: темп / 2**4
+HOST_STATUS_REFRESH_MS = 2000
+
 # Настройки доступных аудио-форматов для режима «только аудио»
 AUDIO_FORMAT_OPTIONS = {
     "mp3": {
         "label": "MP3",
         "codec": "mp3",
         "extension": "mp3",
+        "source_acodec": "mp3",
         "bitrate_values": ["128", "160", "192", "224", "256", "320"],
     },
     "m4a": {
         "label": "M4A / AAC",
         "codec": "m4a",
         "extension": "m4a",
+        "source_acodec": "mp4a",
         "bitrate_values": ["128", "192", "256", "320"],
     },
     "opus": {
         "label": "Opus",
         "codec": "opus",
         "extension": "opus",
+        "source_acodec": "opus",
         "bitrate_values": ["96", "128", "160", "192"],
     },
     "vorbis": {
         "label": "Vorbis",
         "codec": "vorbis",
         "extension": "ogg",
+        "source_acodec": "vorbis",
         "bitrate_values": ["128", "160", "192", "224"],
     },
     "wav": {
@@ -81,8 +239,22 @@ AUDIO_FORMAT_OPTIONS = {
     },
 }
 
+# Метки качества в UI/конфиге → высота кадра
+QUALITY_HEIGHTS = {
+    "480p": 480,
+    "720p": 720,
+    "1080p": 1080,
+    "1440p (2K)": 1440,
+    "2160p (4K)": 2160,
+    "4320p (8K)": 4320,
+}
+
 DEFAULT_AUDIO_FORMAT = "mp3"
 DEFAULT_AUDIO_QUALITY = "192"
+# source_acodec — какой исходный поток копируется в выбранный формат без перекодирования
+# (FFmpegExtractAudio делает -acodec copy, если кодек уже совпадает). Такой поток предпочитаем,
+# если его битрейт не ниже AUDIO_COPY_MIN_RATIO от выбранного (или неизвестен).
+AUDIO_COPY_MIN_RATIO = 0.75
 
 LIGHT_BG = "#f5f7fb"
 LIGHT_PANEL_BG = "#ffffff"
@@ -91,21 +263,53 @@ MUTED_TEXT_COLOR = "#5a6b7d"
 ACCENT_COLOR = "#3a7bd5"
 ACCENT_COLOR_ACTIVE = "#4f8de3"
 
-# Попытка импорта yt_dlp
-try:
-    import yt_dlp
-    from yt_dlp import YoutubeDL
-except Exception as e:
-    root = tk.Tk()
-    root.withdraw()
-    messagebox.showerror(
-        "yt-dlp не найден",
+# yt_dlp импортируется лениво: это самая тяжёлая часть старта (сотни модулей, на медленных
+# дисках — секунды). Окно запускает импорт в фоне (preload_ytdlp) и сразу показывается;
+# код, которому нужен yt-dlp, берёт модуль через _ytdlp() — он дождётся идущего импорта.
+yt_dlp = None
+YoutubeDL = None
+_YTDLP_LOCK = threading.Lock()
+
+
+def _ytdlp():
+    """Модуль yt_dlp; первый вызов импортирует (потокобезопасно), ImportError — если не установлен."""
+    global yt_dlp, YoutubeDL
+    if yt_dlp is None:
+        with _YTDLP_LOCK:
+            if yt_dlp is None:
+                import yt_dlp as module
+                YoutubeDL = module.YoutubeDL
+                yt_dlp = module
+    return yt_dlp
+
+
+def ytdlp_version(module) -> str:
+    """Версия yt-dlp: у пакета нет __version__ на верхнем уровне, она в yt_dlp.version."""
+    return getattr(getattr(module, "version", None), "__version__", None) or getattr(module, "__version__", "?")
+
+
+def preload_ytdlp(on_done: Optional[Callable[[Optional[str], Optional[BaseException]], None]] = None):
+    """Импорт yt_dlp в фоновом потоке; on_done(версия, ошибка) — из того же потока."""
+    def worker():
+        try:
+            version = ytdlp_version(_ytdlp())
+        except Exception as e:
+            if on_done:
+                on_done(None, e)
+            return
+        if on_done:
+            on_done(version, None)
+    threading.Thread(target=worker, name="yt-dlp-import", daemon=True).start()
+
+
+def ytdlp_missing_message(error: BaseException) -> str:
+    return (
         "Библиотека 'yt-dlp' не установлена.\n\n"
         "Откройте терминал и выполните:\n"
         "    pip install yt-dlp\n\n"
-        f"Подробности: {e}"
+        "или нажмите «Обновить yt-dlp» в окне программы.\n\n"
+        f"Подробности: {error}"
     )
-    sys.exit(1)
 
 
 def human_readable_size(nbytes: float) -> str:
@@ -121,6 +325,44 @@ def human_readable_size(nbytes: float) -> str:
     return f"{nbytes:.2f} {units[i]}"
 
 
+_RATE_RE = re.compile(r"(?i)^(\d+(?:\.\d+)?)\s*([kmgtpezy]?)(?:i?b)?(?:/s)?$")
+
+
+def parse_rate(text: str) -> int:
+    """
+    «2M», «500K», «1.5M» → байт/с (как -r у yt-dlp, множители по 1024); пусто/«0» — без ограничения.
+    Разбор свой, а не yt_dlp.utils.parse_bytes: лимит из настроек применяется при старте окна,
+    до того как yt-dlp импортирован.
+    """
+    text = (text or "").strip()
+    if not text or text in ("0", "-"):
+        return 0
+    m = _RATE_RE.match(text)
+    if not m:
+        raise ValueError(f"Не понимаю скорость: {text!r} (примеры: 500K, 2M, 1.5M)")
+    return int(round(float(m.group(1)) * 1024 ** " KMGTPEZY".index(m.group(2).upper() or " ")))
+
+
+def parse_schedule(text: str) -> List[Tuple[int, int, int]]:
+    """
+    «09:00-18:00=2M, 22:00-07:00=0» → [(начало_мин, конец_мин, байт/с), ...].
+    Окно может переходить через полночь; первое подходящее окно побеждает.
+    """
+    windows = []
+    for part in re.split(r"[,;\n]+", text or ""):
+        part = part.strip()
+        if not part:
+            continue
+        m = re.fullmatch(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\S+)", part)
+        if not m:
+            raise ValueError(f"Не понимаю окно расписания: {part!r} (пример: 09:00-18:00=2M)")
+        h1, m1, h2, m2 = (int(x) for x in m.groups()[:4])
+        if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59:
+            raise ValueError(f"Неверное время в окне: {part!r}")
+        windows.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(m.group(5))))
+    return windows
+
+
 def seconds_to_hms(sec: Optional[int]) -> str:
     try:
         s = int(sec)
@@ -132,6 +374,118 @@ def seconds_to_hms(sec: Optional[int]) -> str:
     return f"{h:02d}:{m:02d}:{s2:02d}" if h else f"{m:02d}:{s2:02d}"
 
 
+def ellipsize(s: str, maxlen: int) -> str:
+    """Умное многоточие по середине: сохраняем начало и конец."""
+    try:
+        s = str(s)
+    except Exception:
+        return ""
+    if maxlen <= 1 or len(s) <= maxlen:
+        return s
+    keep = maxlen - 1
+    left = int(keep * 0.6)
+    right = keep - left
+    return f"{s[:left]}…{s[-right:]}" if right > 0 else s[:maxlen]
+
+
+def read_links_file(path: str) -> List[str]:
+    """Ссылки из .txt: по одной на строку, пустые строки и #комментарии пропускаются."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except UnicodeDecodeError:
+        with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
+            lines = f.readlines()
+    urls = []
+    for line in lines:
+        url = line.strip()
+        if url and not url.startswith("#"):
+            urls.append(url)
+    return urls
+
+
+# Подстроки сообщений об ошибках. Сверяются с текстом без префикса «[extractor] ID:» и без ссылок
+# (в ID/URL может оказаться что угодно), поэтому — фразы в том виде, в каком их пишут yt-dlp/ffmpeg/ОС
+_ERROR_PATTERNS = (
+    ("disk", ("no space left", "errno 28", "not enough space", "disk full")),
+    ("age_gate", ("confirm your age", "age-restricted", "age restricted", "inappropriate for some users")),
+    ("http429", ("http error 429", "too many requests")),
+    ("http403", ("http error 403", "403: forbidden", "403 forbidden")),
+    ("ffmpeg", ("ffmpeg not found", "ffprobe not found", "ffmpeg is not installed", "ffmpeg exited with code",
+                "postprocessing:", "conversion failed", "merging of multiple formats")),
+    ("network", ("connection reset", "connection aborted", "connection refused", "remote end closed",
+                 "timed out", "temporary failure in name resolution", "name or service not known",
+                 "network is unreachable", "incompleteread(", "incomplete read", "errno 104",
+                 "ssl:", "sslerror(", "ssleoferror(", "certificate verify failed", "eof occurred in violation of protocol",
+                 "http error 500", "http error 502", "http error 503", "http error 504")),
+    ("extractor", ("unable to extract", "unable to download webpage", "unsupported url", "video unavailable",
+                   "private video", "this video is not available", "sign in to")),
+)
+_ERROR_PREFIX_RE = re.compile(r"\[[\w:.-]+\]\s+[^\s:]+:\s|https?://\S+")
+_NETWORK_ERROR_TYPES = ("TransportError", "IncompleteRead", "SSLError", "SSLEOFError", "ProxyError",
+                        "ConnectionError", "ReadTimeoutError", "ProtocolError")
+_EXTRACTOR_ERROR_TYPES = ("ExtractorError", "UnsupportedError", "GeoRestrictedError")
+
+
+def _error_chain(exc: BaseException) -> List[BaseException]:
+    """Исключение и его причины: exc_info/cause у ошибок yt-dlp, __cause__ у обычных."""
+    chain: List[BaseException] = []
+    todo = [exc]
+    while todo and len(chain) < 8:
+        e = todo.pop(0)
+        if e is None or any(e is seen for seen in chain):
+            continue
+        chain.append(e)
+        todo += [(getattr(e, "exc_info", None) or (None, None))[1], getattr(e, "cause", None), e.__cause__]
+    return [e for e in chain if isinstance(e, BaseException)]
+
+
+def classify_download_error(exc: Optional[BaseException]) -> str:
+    """
+    Класс ошибки загрузки — ключ RETRY_POLICIES. Сначала по типам в цепочке причин
+    (DownloadError yt-dlp разворачивается до исходной), потом — по тексту сообщения.
+    """
+    if exc is None:
+        return "other"
+    chain = _error_chain(exc)
+    text = _ERROR_PREFIX_RE.sub(" ", " ".join(str(e) for e in chain).lower())
+    for e in chain:
+        if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+            return "disk"
+    for e in chain:
+        if type(e).__name__ != "HTTPError":
+            continue
+        status = getattr(e, "status", None) or getattr(e, "code", None)
+        if status == 429:
+            return "http429"
+        if status == 403:
+            return "http403"
+        if isinstance(status, int) and 500 <= status < 600:
+            return "network"
+    names = {type(e).__name__ for e in chain}
+    if "PostProcessingError" in names:
+        return "ffmpeg"
+    if names & set(_NETWORK_ERROR_TYPES) or any(isinstance(e, (ConnectionError, TimeoutError)) for e in chain):
+        return "network"
+    if names & set(_EXTRACTOR_ERROR_TYPES):
+        # возрастное ограничение и 429/403 приходят тоже как ExtractorError — различаем по тексту
+        for kind, needles in _ERROR_PATTERNS:
+            if kind in ("age_gate", "http429", "http403") and any(n in text for n in needles):
+                return kind
+        return "extractor"
+    for kind, needles in _ERROR_PATTERNS:
+        if any(n in text for n in needles):
+            return kind
+    return "other"
+
+
+def retry_delay(kind: str, attempt: int) -> float:
+    """Пауза перед повтором №attempt (с 1): экспонента до потолка, из которой случайна верхняя половина."""
+    policy = RETRY_POLICIES[kind]
+    delay = min(policy["cap"], policy["base"] * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 def open_file_manager(path: str):
     try:
         if sys.platform.startswith("win"):
@@ -144,26 +498,117 @@ def open_file_manager(path: str):
         messagebox.showerror("Ошибка", f"Не удалось открыть папку:\n{e}")
 
 
+class _PerThread:
+    """
+    Атрибут экземпляра, значение которого своё у каждого потока.
+    Нужен для состояния «текущей загрузки», когда очередь качает несколько задач параллельно.
+    """
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj._tls, self.name, self.default)
+
+    def __set__(self, obj, value):
+        setattr(obj._tls, self.name, value)
+
+
+class TkLogSink:
+    """
+    Потокобезопасный буфер строк для лог-виджетов.
+    Потоки только кладут строки в очередь; один периодический таймер Tk раз в
+    LOG_FLUSH_INTERVAL_MS вставляет накопленное одной операцией insert на виджет
+    и обрезает виджет до последних LOG_MAX_LINES строк.
+    Счётчики: dropped — строки, не дошедшие до экрана (переполнение буфера/кольца),
+    coalesced — строки, вставленные «попутно» в одну пачку с другими.
+    """
+
+    def __init__(self, root: tk.Misc, max_lines: int = LOG_MAX_LINES, max_pending: int = LOG_MAX_PENDING,
+                 interval_ms: int = LOG_FLUSH_INTERVAL_MS):
+        self._root = root
+        self.max_lines = max_lines
+        self.max_pending = max_pending
+        self.interval_ms = interval_ms
+        self._lock = threading.Lock()
+        self._pending: Dict[tk.Text, deque] = {}
+        self._after_id = None
+        self.dropped = 0
+        self.coalesced = 0
+        self.on_flush: Optional[Callable[["TkLogSink"], None]] = None
+
+    def write(self, widget: tk.Text, line: str):
+        with self._lock:
+            buf = self._pending.get(widget)
+            if buf is None:
+                buf = self._pending[widget] = deque(maxlen=self.max_pending)
+            if len(buf) == self.max_pending:
+                self.dropped += 1
+            buf.append(line)
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self._root.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        if self._after_id is not None:
+            try:
+                self._root.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+
+    def _tick(self):
+        self._after_id = None
+        try:
+            self.flush()
+        finally:
+            self._after_id = self._root.after(self.interval_ms, self._tick)
+
+    def flush(self):
+        with self._lock:
+            batches = [(w, list(buf)) for w, buf in self._pending.items() if buf]
+            for buf in self._pending.values():
+                buf.clear()
+        if not batches:
+            return
+        for widget, lines in batches:
+            if len(lines) > self.max_lines:
+                self.dropped += len(lines) - self.max_lines
+                lines = lines[-self.max_lines:]
+            self.coalesced += len(lines) - 1
+            try:
+                widget.configure(state="normal")
+                widget.insert("end", "\n".join(lines) + "\n")
+                count = int(widget.index("end-1c").split(".")[0]) - 1
+                if count > self.max_lines:
+                    widget.delete("1.0", f"{count - self.max_lines + 1}.0")
+                widget.see("end")
+                widget.configure(state="disabled")
+            except Exception:
+                pass
+        if self.on_flush:
+            self.on_flush(self)
+
+
 class TkLogger:
     """
     Логгер для интеграции с yt-dlp в два Text-виджета:
     - main_text: важные сообщения (info/warning/error)
     - raw_text: подробный поток (debug, прогресс)
+    Вставка идёт через общий TkLogSink, а не через after(0) на каждую строку.
     """
-    def __init__(self, main_text: tk.Text, raw_text: tk.Text):
+    def __init__(self, main_text: tk.Text, raw_text: tk.Text, sink: TkLogSink):
         self.main_text = main_text
         self.raw_text = raw_text
+        self.sink = sink
 
     def _append_to(self, widget: tk.Text, msg: str):
-        def do_insert():
-            try:
-                widget.configure(state="normal")
-                widget.insert("end", msg + "\n")
-                widget.see("end")
-                widget.configure(state="disabled")
-            except Exception:
-                pass
-        widget.after(0, do_insert)
+        self.sink.write(widget, msg)
 
     def debug(self, msg):
         self._append_to(self.raw_text, str(msg))
@@ -178,6 +623,330 @@ class TkLogger:
         self._append_to(self.main_text, "[ОШИБКА] " + str(msg))
 
 
+_YT_ID_RE = re.compile(r"(?:[?&]v=|/shorts/|/embed/|/live/|youtu\.be/)([0-9A-Za-z_-]{11})")
+
+# Поля форматов, которые протухают вместе с подписанными ссылками
+_STREAM_FIELDS = ("url", "manifest_url", "fragment_base_url", "fragments", "http_headers", "downloader_options")
+
+
+class MetadataCache:
+    """
+    Дисковый кэш результатов extract_info (один .json.gz на ключ).
+    Ключ: ID видео (или URL) + «отпечаток» cookies + noplaylist.
+    - Пока запись моложе METADATA_STREAM_TTL, info годится для загрузки (ссылки на потоки живы).
+    - Позже ссылки вырезаются, но название/длительность/форматы/языки живут до METADATA_MAX_AGE.
+    - Ограничение по размеру и числу записей, вытеснение LRU (порядок — по mtime файла).
+    Кэшируются только одиночные видео: у плейлистов sanitize_info выкидывает entries.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = METADATA_CACHE_MAX_BYTES,
+                 max_entries: int = METADATA_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index: Optional["OrderedDict[str, int]"] = None  # key -> размер файла, от старых к свежим
+        self._total_bytes = 0
+
+    # ---- ключи ----
+
+    @staticmethod
+    def video_key(url: str, noplaylist: bool) -> str:
+        url = (url or "").strip()
+        m = _YT_ID_RE.search(url)
+        if m and (noplaylist or "list=" not in url):
+            return f"youtube:{m.group(1)}"
+        return f"url:{url}|noplaylist={int(bool(noplaylist))}"
+
+    @staticmethod
+    def cookie_identity(cookies: Optional[str]) -> str:
+        if not cookies:
+            return ""
+        try:
+            st = os.stat(cookies)
+            return f"{os.path.abspath(cookies)}:{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            return os.path.abspath(cookies)
+
+    def _make_key(self, url: str, cookies: Optional[str], noplaylist: bool) -> str:
+        raw = f"{self.video_key(url, noplaylist)}|{self.cookie_identity(cookies)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json.gz")
+
+    # ---- индекс / LRU ----
+
+    def _ensure_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for de in it:
+                    if de.name.endswith(".json.gz"):
+                        st = de.stat()
+                        entries.append((st.st_mtime, de.name[:-len(".json.gz")], st.st_size))
+        except FileNotFoundError:
+            pass
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._total_bytes = sum(self._index.values())
+
+    def _drop(self, key: str):
+        size = self._index.pop(key, None) if self._index is not None else None
+        if size is not None:
+            self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._index and (self._total_bytes > self.max_bytes or len(self._index) > self.max_entries):
+            oldest = next(iter(self._index))
+            self._drop(oldest)
+            self.evictions += 1
+
+    # ---- чтение / запись ----
+
+    def _write(self, key: str, record: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp = path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._total_bytes -= old
+        self._index[key] = size
+        self._total_bytes += size
+
+    @staticmethod
+    def _strip_streams(info: dict) -> dict:
+        for fmt in info.get("formats") or []:
+            for k in _STREAM_FIELDS:
+                fmt.pop(k, None)
+        for k in _STREAM_FIELDS:
+            info.pop(k, None)
+        # для выбора языков нужны только ключи
+        for k in ("subtitles", "automatic_captions"):
+            if isinstance(info.get(k), dict):
+                info[k] = {lang: [] for lang in info[k]}
+        return info
+
+    def get(self, url: str, cookies: Optional[str], noplaylist: bool, need_streams: bool = False) -> Optional[dict]:
+        """
+        info_dict из кэша или None.
+        need_streams=True — только записи с живыми ссылками (для загрузки);
+        иначе подойдёт и «облегчённая» запись (название, длительность, форматы, языки).
+        """
+        key = self._make_key(url, cookies, noplaylist)
+        with self._lock:
+            self._ensure_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                self._drop(key)
+                self.misses += 1
+                return None
+            age = time.time() - float(record.get("ts", 0))
+            if age > METADATA_MAX_AGE:
+                self._drop(key)
+                self.misses += 1
+                return None
+            info = record.get("info") or {}
+            if record.get("streams") and age > METADATA_STREAM_TTL:
+                record["info"] = info = self._strip_streams(info)
+                record["streams"] = False
+                try:
+                    self._write(key, record)
+                except OSError:
+                    pass
+            if need_streams and not record.get("streams"):
+                self.stale_hits += 1
+                return None
+            self._index.move_to_end(key)
+            try:
+                os.utime(self._path(key))
+            except OSError:
+                pass
+            self.hits += 1
+            return info
+
+    def put(self, url: str, cookies: Optional[str], noplaylist: bool, info: dict) -> bool:
+        """Сохранить info; False — если запись не кэшируется (плейлист) или не удалось записать."""
+        if not isinstance(info, dict) or info.get("_type", "video") != "video":
+            return False
+        key = self._make_key(url, cookies, noplaylist)
+        record = {
+            "ts": time.time(),
+            "streams": True,
+            "info": _ytdlp().YoutubeDL.sanitize_info(info, remove_private_keys=True),
+        }
+        with self._lock:
+            self._ensure_index()
+            try:
+                self._write(key, record)
+            except (OSError, TypeError, ValueError):
+                return False
+            self._evict()
+        return True
+
+    def stats_line(self) -> str:
+        with self._lock:
+            n = len(self._index) if self._index is not None else 0
+            size = self._total_bytes
+        return (
+            f"Кэш метаданных: попаданий {self.hits}, промахов {self.misses}, "
+            f"устаревших ссылок {self.stale_hits}, вытеснено {self.evictions} | "
+            f"записей {n}, {human_readable_size(size)}"
+        )
+
+
+class ProbePool:
+    """
+    Ограниченный пул «проб» метаданных для элементов очереди.
+    - не больше `workers` одновременных извлечений (вместо потока на каждую ссылку);
+    - FIFO, но задачи с меньшим приоритетом (0 — видимые строки) идут вперёд;
+    - одинаковые ключи (та же ссылка с теми же опциями) склеиваются в одну пробу;
+    - счётчики resolved/failed/total для индикатора «названия 340/2000».
+    work_fn(items) выполняется в рабочем потоке для всех элементов с одним ключом.
+    """
+
+    PRIORITY_VISIBLE = 0
+    PRIORITY_NORMAL = 1
+
+    def __init__(self, work_fn: Callable[[list], None], workers: int,
+                 on_progress: Optional[Callable[[], None]] = None):
+        self._work_fn = work_fn
+        self._on_progress = on_progress
+        self._cond = threading.Condition()
+        self._heap: list = []                  # (priority, seq, key)
+        self._seq = itertools.count()
+        self._pending: Dict[object, list] = {}  # key -> элементы, ждущие пробы
+        self._priority: Dict[object, int] = {}
+        self._running: Dict[object, list] = {}
+        self._target = 0
+        self._alive = 0
+        self.total = 0
+        self.resolved = 0
+        self.failed = 0
+        self.set_workers(workers)
+
+    def set_workers(self, n: int):
+        with self._cond:
+            self._target = max(1, int(n))
+            while self._alive < self._target:
+                self._alive += 1
+                threading.Thread(target=self._worker, name="probe-worker", daemon=True).start()
+            self._cond.notify_all()
+
+    def submit(self, key, item, priority: int = PRIORITY_NORMAL):
+        with self._cond:
+            if not self._pending and not self._running:
+                self.total = self.resolved = self.failed = 0
+            self.total += 1
+            # если та же проба уже выполняется — ставим повторную: она возьмёт результат из кэша
+            if key in self._pending:
+                self._pending[key].append(item)
+                self._bump_locked(key, priority)
+            else:
+                self._pending[key] = [item]
+                self._priority[key] = priority
+                heapq.heappush(self._heap, (priority, next(self._seq), key))
+                self._cond.notify()
+        self._notify_progress()
+
+    def prioritize(self, keys):
+        with self._cond:
+            for key in keys:
+                if key in self._pending:
+                    self._bump_locked(key, self.PRIORITY_VISIBLE)
+            self._cond.notify_all()
+
+    def _bump_locked(self, key, priority: int):
+        if priority < self._priority.get(key, self.PRIORITY_NORMAL):
+            self._priority[key] = priority
+            heapq.heappush(self._heap, (priority, next(self._seq), key))
+
+    def clear(self):
+        with self._cond:
+            self._heap.clear()
+            self._pending.clear()
+            self._priority.clear()
+            self.total = self.resolved + self.failed + sum(len(v) for v in self._running.values())
+        self._notify_progress()
+
+    def busy(self) -> bool:
+        with self._cond:
+            return bool(self._pending or self._running)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._alive > self._target:
+                        self._alive -= 1
+                        return
+                    key = None
+                    while self._heap:
+                        prio, _, cand = heapq.heappop(self._heap)
+                        # устаревшие записи кучи (после повышения приоритета или clear) пропускаем
+                        if cand in self._pending and self._priority.get(cand) == prio:
+                            key = cand
+                            break
+                    if key is not None:
+                        break
+                    self._cond.wait()
+                items = self._pending.pop(key)
+                self._priority.pop(key, None)
+                self._running[key] = items
+            ok = True
+            try:
+                self._work_fn(items)
+            except Exception:
+                ok = False
+            with self._cond:
+                done = self._running.pop(key, items)
+                if ok:
+                    self.resolved += len(done)
+                else:
+                    self.failed += len(done)
+            self._notify_progress()
+
+    def _notify_progress(self):
+        if self._on_progress:
+            try:
+                self._on_progress()
+            except Exception:
+                pass
+
+    def progress_line(self) -> str:
+        with self._cond:
+            done = self.resolved + self.failed
+            total = self.total
+            failed = self.failed
+        if not total:
+            return ""
+        txt = f"Названия: {done}/{total}"
+        if failed:
+            txt += f" (ошибок {failed})"
+        if done >= total:
+            txt += " ✓"
+        return txt
+
+
 @dataclass
 class DownloadPreset:
     # Добавлено: выбор языка аудиодорожки
@@ -199,731 +968,1862 @@ class DownloadPreset:
 
 
 @dataclass
+class FormatPlan:
+    """Что скачает пресет по известному списку форматов: потоки, контейнер, объём."""
+    format_id: str
+    height: Optional[int] = None
+    vcodec: str = ""  # короткое имя (av01 / vp9 / h264) или "" — без видео
+    acodec: str = ""  # короткое имя (opus / aac / ...) или "" — без аудио
+    abr: Optional[float] = None
+    container: str = "?"
+    size: Optional[int] = None
+    size_approx: bool = False  # True — хоть одна часть оценена (filesize_approx / битрейт × длительность)
+    peak: Optional[int] = None  # пик занятого места: части + итоговый файл (+ копия при remux/перекодировании)
+    fallback: bool = False  # сработала запасная ветка селектора (…/best) — нужных кодеков нет
+    transcode: bool = False  # только аудио: поток будет перекодирован
+    warning: Optional[str] = None  # корректировка кодеков под контейнер
+
+    def summary(self) -> str:
+        parts = []
+        if self.vcodec:
+            parts.append(f"{self.vcodec.upper()} {self.height}p" if self.height else self.vcodec.upper())
+        if self.acodec:
+            parts.append(self.acodec.upper() + (f" {int(self.abr)}k" if self.abr else ""))
+        text = " + ".join(parts) or self.format_id
+        text += f" → {self.container.upper()}"
+        if self.transcode:
+            text += " (перекодирование)"
+        if self.size:
+            text += f" {'≈' if self.size_approx else ''}{human_readable_size(self.size)}"
+            if self.peak and self.peak > self.size:
+                text += f", на диске до {human_readable_size(self.peak)}"
+        if self.fallback:
+            text += " — запасной формат"
+        return text
+
+
+_QUEUE_UIDS = itertools.count(1)
+
+
+@dataclass(eq=False)  # задачи сравниваются по идентичности, а не по полям (две одинаковые ссылки — разные задачи)
 class QueueItem:
     url: str
     preset: DownloadPreset
     status: str = field(default="Ожидает")
     result_path: Optional[str] = None
     title: Optional[str] = None  # полное название для таблицы/статуса
+    progress: float = 0.0  # процент текущей задачи (для колонки «Прогресс»)
+    detail: str = ""  # короткая строка прогресса/скорости для таблицы
+    info: Optional[dict] = field(default=None, repr=False)  # info_dict из пробы — переиспользуется при загрузке
+    info_key: Optional[tuple] = field(default=None, repr=False)  # с какими опциями получен info
+    info_ts: float = 0.0
+    db_id: Optional[int] = None  # строка в QueueStore
+    uid: int = field(default_factory=lambda: next(_QUEUE_UIDS))  # стабильный ID задачи (iid строки в таблице)
+    size_estimate: Optional[int] = None  # ожидаемый объём скачивания по пробе (filesize / filesize_approx)
+    plan: Optional[FormatPlan] = field(default=None, repr=False)  # выбор форматов по пробе (не сохраняется)
+    sub_key: Optional[Tuple[int, str]] = None  # (подписка, ID видео) — задача пришла из синхронизации подписки
+    history: List[dict] = field(default_factory=list, repr=False)  # неудачные попытки: время, класс, ошибка, пауза
+    retries: Dict[str, int] = field(default_factory=dict, repr=False)  # попыток по классам ошибок в текущем прогоне
+    retry_at: float = 0.0  # не запускать раньше (пауза перед повтором)
+
+
+class QueueIndex:
+    """
+    Очередь задач с порядком добавления и индексом по uid: поиск/проверка/удаление — O(1),
+    позиция задачи — O(log n) по дереву Фенвика над «слотами» добавления (нужна progress-хуку
+    на каждом обновлении, поэтому без линейного list.index). Интерфейс — как у списка,
+    которым очередь была раньше. Потокобезопасна.
+    """
 
+    def __init__(self, items: Optional[List[QueueItem]] = None):
+        self._lock = threading.RLock()
+        self._items: Dict[int, QueueItem] = {}   # uid -> задача; dict хранит порядок добавления
+        self._slot: Dict[int, int] = {}          # uid -> слот (1..), слоты только растут
+        self._tree: List[int] = [0]              # дерево Фенвика: 1 — слот занят
+        if items:
+            self.extend(items)
+
+    # ---- дерево Фенвика ----
+
+    def _prefix(self, i: int) -> int:
+        tree, total = self._tree, 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _add(self, i: int, delta: int):
+        tree, n = self._tree, len(self._tree)
+        while i < n:
+            tree[i] += delta
+            i += i & -i
+
+    def _append_slot(self) -> int:
+        i = len(self._tree)
+        # узел i покрывает слоты (i - lowbit(i), i]: всё, что уже в этом диапазоне, + новый слот
+        self._tree.append(1 + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        return i
+
+    def _compact(self):
+        """Слотов от удалённых задач стало слишком много — перенумеровать живые, O(n)."""
+        n = len(self._items)
+        self._slot = {uid: k for k, uid in enumerate(self._items, start=1)}
+        tree = [0] + [1] * n
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    # ---- интерфейс списка ----
+
+    def append(self, item: QueueItem):
+        with self._lock:
+            if item.uid in self._items:
+                return
+            self._items[item.uid] = item
+            self._slot[item.uid] = self._append_slot()
+
+    def extend(self, items: List[QueueItem]):
+        with self._lock:
+            for item in items:
+                self.append(item)
+
+    def remove(self, item: QueueItem):
+        with self._lock:
+            if self._items.get(item.uid) is not item:
+                raise ValueError("задачи нет в очереди")
+            del self._items[item.uid]
+            self._add(self._slot.pop(item.uid), -1)
+            if len(self._tree) > 2 * len(self._items) + 1024:
+                self._compact()
+
+    def discard(self, item: QueueItem):
+        try:
+            self.remove(item)
+        except ValueError:
+            pass
 
-class DownloaderApp(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title("YouTube Видео Загрузчик (yt-dlp)")
-        self.geometry("1020x900")
-        self.minsize(1020, 900)
-        self.configure(bg=LIGHT_BG)
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._slot.clear()
+            self._tree = [0]
 
-        # Состояние
-        self.cancel_event = threading.Event()
-        self.download_thread = None
-        self.queue_thread = None
-        self.queue: List[QueueItem] = []
-        self.queue_running = False
-        self.last_output_path = None
-        self._save_debounce_after = None
-        self._extra_status_suffix = ""   # короткая подпись кодеков/контейнера в статусе
-        self._current_title: Optional[str] = None
-        self._updating = False
+    def index(self, item: QueueItem) -> int:
+        with self._lock:
+            if self._items.get(item.uid) is not item:
+                raise ValueError("задачи нет в очереди")
+            return self._prefix(self._slot[item.uid]) - 1
 
-        # Для «подробного» лога
-        self._last_raw_line_ts: float = 0.0
-        self._last_raw_percent: float = -1.0
+    def position(self, item: QueueItem) -> Optional[Tuple[int, int]]:
+        """(номер с 1, всего) или None — одним захватом замка, для строки прогресса."""
+        with self._lock:
+            if self._items.get(item.uid) is not item:
+                return None
+            return self._prefix(self._slot[item.uid]), len(self._items)
 
-        # Доступные языки (динамически обновляемые)
-        self.available_audio_languages: List[str] = ["orig", "ru", "en"]
-        self.available_subtitle_languages: List[str] = []
-        self.selected_subtitle_langs: List[str] = []
-        self._metadata_fetching = False
+    def get(self, uid: int) -> Optional[QueueItem]:
+        return self._items.get(uid)
 
-        # UI
-        self._build_ui()
+    def __contains__(self, item) -> bool:
+        return self._items.get(getattr(item, "uid", None)) is item
 
-        # Проверка ffmpeg
-        self._check_ffmpeg()
+    def __len__(self) -> int:
+        return len(self._items)
 
-        # Загрузка/подписка настроек
-        self._load_settings()
-        self._bind_setting_events()
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._items.values()))
 
-        # Закрытие
-        self.protocol("WM_DELETE_WINDOW", self._on_close)
 
-    # ------------------------ Вспомогательные сокращатели ------------------------
+class QueueStore:
+    """
+    Очередь в SQLite (WAL): ссылка, пресет (JSON), статус, название, путь результата,
+    число попыток и время — по строке на задачу. Методы вызываются из UI и из рабочих
+    потоков (одно соединение под замком). Выполненные задачи из окна уходят, но строка
+    остаётся как история (removed=1) и чистится через QUEUE_HISTORY_MAX_AGE.
+    """
 
-    def _ellipsize(self, s: str, maxlen: int) -> str:
-        """Умное многоточие по середине: сохраняем начало и конец."""
-        try:
-            s = str(s)
-        except Exception:
-            return ""
-        if maxlen <= 1 or len(s) <= maxlen:
-            return s
-        keep = maxlen - 1
-        left = int(keep * 0.6)
-        right = keep - left
-        return f"{s[:left]}…{s[-right:]}" if right > 0 else s[:maxlen]
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queue_items (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            url         TEXT    NOT NULL,
+            preset      TEXT    NOT NULL,
+            status      TEXT    NOT NULL,
+            title       TEXT,
+            result_path TEXT,
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            history     TEXT,
+            removed     INTEGER NOT NULL DEFAULT 0,
+            created_ts  REAL    NOT NULL,
+            updated_ts  REAL    NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS queue_items_active ON queue_items(removed, id);
+    """
 
-    # ------------------------ UI ------------------------
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # в WAL этого достаточно, чтобы пережить падение процесса
+        self._conn.executescript(self._SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(queue_items)")}
+        if "history" not in columns:  # база от версии без истории попыток
+            self._conn.execute("ALTER TABLE queue_items ADD COLUMN history TEXT")
+        self._conn.execute("DELETE FROM queue_items WHERE removed = 1 AND updated_ts < ?",
+                           (time.time() - QUEUE_HISTORY_MAX_AGE,))
+
+    # ---- пресет <-> JSON ----
+
+    @staticmethod
+    def preset_to_json(preset: DownloadPreset) -> str:
+        return json.dumps(asdict(preset), ensure_ascii=False, sort_keys=True)
+
+    @staticmethod
+    def preset_from_json(text: str) -> DownloadPreset:
+        data = json.loads(text)
+        known = {f.name for f in fields(DownloadPreset)}
+        data = {k: v for k, v in data.items() if k in known}
+        data["subtitle_langs"] = tuple(data.get("subtitle_langs") or ())
+        return DownloadPreset(**data)
+
+    # ---- чтение ----
+
+    def load(self) -> List[QueueItem]:
+        """
+        Незавершённые задачи в порядке добавления; прерванные «В процессе», ждавшие повтора
+        и ждавшие места на диске снова ждут.
+        """
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "UPDATE queue_items SET status = 'Ожидает', updated_ts = ? "
+                "WHERE removed = 0 AND (status = 'В процессе' OR status LIKE 'Повтор%' OR status = 'Ждёт места')",
+                (now,))
+            rows = self._conn.execute(
+                "SELECT id, url, preset, status, title, result_path, history FROM queue_items WHERE removed = 0 ORDER BY id"
+            ).fetchall()
+        items = []
+        presets: Dict[str, DownloadPreset] = {}  # одинаковый JSON — один объект пресета
+        for db_id, url, preset_json, status, title, result_path, history_json in rows:
+            try:
+                preset = presets.get(preset_json) or self.preset_from_json(preset_json)
+            except (ValueError, TypeError):
+                continue
+            presets[preset_json] = preset
+            try:
+                history = json.loads(history_json) if history_json else []
+            except ValueError:
+                history = []
+            items.append(QueueItem(url=url, preset=preset, status=status, title=title,
+                                   result_path=result_path, db_id=db_id, history=history))
+        return items
+
+    # ---- запись ----
+
+    def add_many(self, items: List[QueueItem]):
+        """Вставка одной транзакцией — импорт больших .txt не упирается в fsync на каждую строку."""
+        if not items:
+            return
+        now = time.time()
+        preset_json: Dict[int, str] = {}
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for item in items:
+                    pj = preset_json.get(id(item.preset))
+                    if pj is None:
+                        pj = preset_json[id(item.preset)] = self.preset_to_json(item.preset)
+                    cur = self._conn.execute(
+                        "INSERT INTO queue_items (url, preset, status, title, created_ts, updated_ts) VALUES (?, ?, ?, ?, ?, ?)",
+                        (item.url, pj, item.status, item.title, now, now))
+                    item.db_id = cur.lastrowid
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _update(self, item: QueueItem, sql: str, params: tuple):
+        if item.db_id is None:
+            return
+        with self._lock:
+            self._conn.execute(f"UPDATE queue_items SET {sql}, updated_ts = ? WHERE id = ?",
+                               params + (time.time(), item.db_id))
 
-    def _build_ui(self):
-        pad = 10
+    def mark_started(self, item: QueueItem):
+        self._update(item, "status = ?, attempts = attempts + 1", (item.status,))
 
-        main = ttk.Frame(self, padding=pad)
-        main.pack(fill="both", expand=True, padx=pad, pady=pad)
+    def update_state(self, item: QueueItem):
+        self._update(item, "status = ?, result_path = ?", (item.status, item.result_path))
 
-        # URL
-        url_frame = ttk.LabelFrame(main, text="Ссылка на видео (YouTube)", padding=pad)
-        url_frame.pack(fill="x", expand=False, pady=(0, pad))
-        self.url_var = tk.StringVar()
-        url_entry = ttk.Entry(url_frame, textvariable=self.url_var)
-        url_entry.pack(side="left", fill="x", expand=True, padx=(0, pad))
-        url_entry.focus_set()
+    def update_title(self, item: QueueItem):
+        self._update(item, "title = ?", (item.title,))
 
-        self.analyze_btn = ttk.Button(
-            url_frame,
-            text="Анализировать",
-            style="Accent.TButton",
-            command=self._on_fetch_metadata_clicked,
-        )
-        self.analyze_btn.pack(side="left", padx=(0, pad))
+    def update_history(self, item: QueueItem):
+        self._update(item, "status = ?, history = ?", (item.status, json.dumps(item.history, ensure_ascii=False)))
 
-        self.analyze_status_var = tk.StringVar(value="")
-        self.analyze_status_label = ttk.Label(
-            url_frame,
-            textvariable=self.analyze_status_var,
-            foreground=MUTED_TEXT_COLOR,
-        )
-        self.analyze_status_label.pack(side="left")
+    def update_preset(self, item: QueueItem):
+        self._update(item, "preset = ?", (self.preset_to_json(item.preset),))
 
-        paste_btn = ttk.Button(url_frame, text="Вставить", command=self._paste_from_clipboard)
-        paste_btn.pack(side="left", padx=(0, pad))
+    def archive(self, item: QueueItem):
+        """Задача выполнена: из очереди убрать, строку (статус, путь) оставить в истории."""
+        self._update(item, "status = ?, result_path = ?, removed = 1", (item.status, item.result_path))
 
-        clear_btn = ttk.Button(url_frame, text="Очистить", command=lambda: self.url_var.set(""))
-        clear_btn.pack(side="left", padx=(0, pad))
+    def delete(self, items: List[QueueItem]):
+        ids = [(it.db_id,) for it in items if it.db_id is not None]
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM queue_items WHERE id = ?", ids)
 
-        # Настройки
-        settings = ttk.LabelFrame(main, text="Настройки", padding=pad)
-        settings.pack(fill="x", expand=False, pady=(0, pad))
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM queue_items WHERE removed = 0")
 
-        # Качество
-        ttk.Label(settings, text="Качество:").grid(row=0, column=0, padx=(0, 5), pady=(0, 5), sticky="w")
-        self.quality_var = tk.StringVar(value="1080p")
-        qualities = ["480p", "720p", "1080p", "1440p (2K)", "2160p (4K)", "4320p (8K)"]
-        self.quality_cb = ttk.Combobox(settings, textvariable=self.quality_var, values=qualities, state="readonly", width=20)
-        self.quality_cb.grid(row=0, column=1, padx=(0, 15), pady=(0, 5), sticky="w")
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
-        # Видео кодек
-        ttk.Label(settings, text="Видео кодек:").grid(row=0, column=2, padx=(0, 5), pady=(0, 5), sticky="w")
-        self.vcodec_var = tk.StringVar(value="Авто")
-        vcodec_values = ["Авто", "AV1 (av01)", "VP9 (vp9)", "H.264 (avc1)"]
-        self.vcodec_cb = ttk.Combobox(settings, textvariable=self.vcodec_var, values=vcodec_values, state="readonly", width=18)
-        self.vcodec_cb.grid(row=0, column=3, padx=(0, 15), pady=(0, 5), sticky="w")
 
-        # Аудио кодек
-        ttk.Label(settings, text="Аудио кодек:").grid(row=0, column=4, padx=(0, 5), pady=(0, 5), sticky="w")
-        self.acodec_var = tk.StringVar(value="Авто")
-        acodec_values = ["Авто", "Opus (opus)", "AAC (mp4a)", "Vorbis (vorbis)"]
-        self.acodec_cb = ttk.Combobox(settings, textvariable=self.acodec_var, values=acodec_values, state="readonly", width=18)
-        self.acodec_cb.grid(row=0, column=5, padx=(0, 15), pady=(0, 5), sticky="w")
+class DownloadArchive:
+    """
+    Архив скачанного: (ключ видео, отпечаток пресета) → итоговый файл, размер, хэш.
+    Ключ — MetadataCache.video_key, т.е. ID берётся из самой ссылки, без запросов в сеть.
+    Индекс целиком в памяти (проверка — поиск в dict), SQLite хранит его между запусками.
+    Запись считается действительной, пока файл на месте и его размер не изменился.
+    Импорт из текстового архива yt-dlp («youtube <id>») даёт записи без пресета и файла —
+    они означают «когда-то скачано» и перекачиваются, только если включено «при другом пресете».
+    """
 
-        # Язык аудио
-        ttk.Label(settings, text="Язык аудио:").grid(row=0, column=6, padx=(0, 5), pady=(0, 5), sticky="w")
-        self.alang_var = tk.StringVar(value="orig")
-        self.alang_cb = ttk.Combobox(settings, textvariable=self.alang_var, values=self.available_audio_languages, state="readonly", width=8)
-        self.alang_cb.grid(row=0, column=7, padx=(0, 15), pady=(0, 5), sticky="w")
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archive (
+            video_key   TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            path        TEXT,
+            size        INTEGER,
+            hash        TEXT,
+            ts          REAL NOT NULL,
+            PRIMARY KEY (video_key, fingerprint)
+        );
+    """
 
-        self.playlist_var = tk.IntVar(value=0)
-        self.playlist_cb = ttk.Checkbutton(settings, text="Скачать плейлист целиком", variable=self.playlist_var,
-                                           command=self._save_settings_debounced)
-        self.playlist_cb.grid(row=0, column=8, padx=(0, 0), pady=(0, 5), sticky="w")
+    def __init__(self, path: str):
+        self.path = path
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._SCHEMA)
+        self._index: Dict[str, Dict[str, Tuple[Optional[str], Optional[int]]]] = {}
+        for key, fp, fpath, size in self._conn.execute("SELECT video_key, fingerprint, path, size FROM archive"):
+            self._index.setdefault(key, {})[fp] = (fpath, size)
+
+    # ---- ключи ----
+
+    @staticmethod
+    def key_for(url: str, preset: DownloadPreset) -> Optional[str]:
+        """Ключ одиночного видео; None — плейлист/канал (их содержимое заранее неизвестно)."""
+        noplaylist = not getattr(preset, 'download_playlist', False)
+        key = MetadataCache.video_key(url, noplaylist)
+        if not noplaylist and not key.startswith("youtube:"):
+            return None
+        return key
 
-        # Итоговый контейнер
-        ttk.Label(settings, text="Контейнер:").grid(row=1, column=0, padx=(0, 5), pady=5, sticky="w")
-        self.container_var = tk.StringVar(value="Авто")
-        container_values = ["Авто", "mp4", "mkv", "webm"]
-        self.container_cb = ttk.Combobox(settings, textvariable=self.container_var, values=container_values, state="readonly", width=20)
-        self.container_cb.grid(row=1, column=1, padx=(0, 15), pady=5, sticky="w")
+    @staticmethod
+    def fingerprint(preset: DownloadPreset) -> str:
+        """Только то, что влияет на сам файл (папка, шаблон имени и cookies — нет)."""
+        if getattr(preset, 'audio_only', False):
+            parts = ("audio", preset.audio_format, preset.audio_quality, preset.alang_choice)
+        else:
+            parts = ("video", preset.height, preset.vcodec_choice, preset.acodec_choice,
+                     preset.alang_choice, preset.container_choice)
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def quick_hash(path: str) -> str:
+        h = hashlib.sha1()
+        size = os.path.getsize(path)
+        h.update(str(size).encode())
+        with open(path, "rb") as f:
+            h.update(f.read(ARCHIVE_HASH_CHUNK))
+            if size > 2 * ARCHIVE_HASH_CHUNK:
+                f.seek(-ARCHIVE_HASH_CHUNK, os.SEEK_END)
+                h.update(f.read(ARCHIVE_HASH_CHUNK))
+        return h.hexdigest()
+
+    # ---- проверка / запись ----
+
+    @staticmethod
+    def _file_ok(path: Optional[str], size: Optional[int]) -> bool:
+        try:
+            return bool(path) and os.path.getsize(path) == size
+        except OSError:
+            return False
+
+    def lookup(self, key: str, fingerprint: str, redownload_if_differs: bool) -> Optional[Tuple[Optional[str], bool]]:
+        """(путь или None, тот_же_пресет) — если скачивать не нужно; иначе None."""
+        with self._lock:
+            entries = dict(self._index.get(key) or {})
+        if not entries:
+            return None
+        same = entries.get(fingerprint)
+        if same and self._file_ok(*same):
+            return same[0], True
+        if redownload_if_differs:
+            return None
+        for fp, (path, size) in entries.items():
+            if path is None or self._file_ok(path, size):
+                return path, fp == fingerprint
+        return None
 
-        # Папка сохранения
-        ttk.Label(settings, text="Папка сохранения:").grid(row=1, column=2, padx=(0, 5), pady=5, sticky="w")
-        self.outdir_var = tk.StringVar(value=os.path.join(os.path.expanduser("~"), "Downloads"))
-        outdir_entry = ttk.Entry(settings, textvariable=self.outdir_var, width=40)
-        outdir_entry.grid(row=1, column=3, padx=(0, 5), pady=5, sticky="ew")
-        outdir_btn = ttk.Button(settings, text="Выбрать...", command=self._choose_outdir)
-        outdir_btn.grid(row=1, column=4, padx=(0, 15), pady=5, sticky="w")
+    def record(self, key: str, fingerprint: str, path: str):
+        size = os.path.getsize(path)
+        digest = self.quick_hash(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO archive (video_key, fingerprint, path, size, hash, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, fingerprint, path, size, digest, time.time()))
+            self._index.setdefault(key, {})[fingerprint] = (path, size)
+
+    def import_ytdlp_archive(self, path: str) -> int:
+        """Строки вида «<extractor> <id>» (файл --download-archive yt-dlp). Возвращает число новых записей."""
+        rows = []
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    rows.append((f"{parts[0].lower()}:{parts[1]}", "", None, None, None, time.time()))
+        added = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for row in rows:
+                    entries = self._index.setdefault(row[0], {})
+                    if "" in entries:
+                        continue
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO archive (video_key, fingerprint, path, size, hash, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                        row)
+                    entries[""] = (None, None)
+                    added += 1
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def note_skipped(self):
+        with self._lock:
+            self.skipped += 1
+
+    def stats_line(self) -> str:
+        with self._lock:
+            n = sum(len(v) for v in self._index.values())
+        return f"Архив: видео {len(self._index)}, записей {n} | пропущено как уже скачанное: {self.skipped}"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
-        # Cookies
-        ttk.Label(settings, text="Cookies (опционально):").grid(row=1, column=5, padx=(0, 5), pady=5, sticky="w")
-        self.cookies_var = tk.StringVar()
-        cookies_btn = ttk.Button(settings, text="Выбрать cookies.txt...", command=self._choose_cookies)
-        cookies_btn.grid(row=1, column=6, columnspan=2, padx=(0, 15), pady=5, sticky="w")
 
-        # Путь к cookies
-        ttk.Label(settings, text="Путь cookies:").grid(row=2, column=0, padx=(0, 5), pady=5, sticky="w")
-        self.cookies_path_entry = ttk.Entry(settings, textvariable=self.cookies_var, width=85)
-        self.cookies_path_entry.grid(row=2, column=1, columnspan=7, padx=(0, 5), pady=5, sticky="ew")
-
-        # Имя файла (шаблон)
-        ttk.Label(settings, text="Имя файла:").grid(row=3, column=0, padx=(0, 5), pady=5, sticky="w")
-        self.outtmpl_var = tk.StringVar(value="%(title)s.%(ext)s")
-        outtmpl_entry = ttk.Entry(settings, textvariable=self.outtmpl_var, width=85)
-        outtmpl_entry.grid(row=3, column=1, columnspan=7, padx=(0, 5), pady=5, sticky="ew")
-        hint = ttk.Label(settings, text="Рекомендуем оставить %(title)s.%(ext)s — приложение переименует итоговый файл автоматически.", foreground=MUTED_TEXT_COLOR)
-        hint.grid(row=4, column=1, columnspan=7, padx=(0, 5), pady=(0, 5), sticky="w")
+@dataclass
+class Subscription:
+    id: int
+    url: str
+    name: Optional[str]
+    preset: DownloadPreset
+    backfill: bool = False  # первая синхронизация качает и уже вышедшие видео
+    last_sync_ts: Optional[float] = None
+    seen: int = 0
 
-        # Только аудио
-        self.audio_only_var = tk.IntVar(value=0)
-        audio_only_cb = ttk.Checkbutton(settings, text="Скачать только аудио", variable=self.audio_only_var,
-                                        command=self._on_audio_only_toggle)
-        audio_only_cb.grid(row=5, column=0, columnspan=2, sticky="w", pady=(5, 5))
 
-        ttk.Label(settings, text="Формат:").grid(row=5, column=2, padx=(0, 5), pady=(5, 5), sticky="e")
-        self.audio_format_var = tk.StringVar(value=DEFAULT_AUDIO_FORMAT)
-        format_labels = [info['label'] for info in AUDIO_FORMAT_OPTIONS.values()]
-        self.audio_format_map = {info["label"]: key for key, info in AUDIO_FORMAT_OPTIONS.items()}
-        self.audio_format_label_var = tk.StringVar(value=AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT]["label"])
-        self.audio_format_cb = ttk.Combobox(settings, state="readonly", values=format_labels,
-                                           textvariable=self.audio_format_label_var)
-        self.audio_format_cb.grid(row=5, column=3, padx=(0, 5), pady=(5, 5), sticky="w")
-        self.audio_format_cb.bind("<<ComboboxSelected>>", lambda *_: self._on_audio_format_selected())
+class SubscriptionStore:
+    """
+    Подписки в SQLite: канал/плейлист, пресет (JSON, как в QueueStore) и виденные ID видео
+    с датами загрузки. Синхронизация листает записи от новых к старым и останавливается,
+    упёршись в уже виденные, — повторный обход канала стоит одной-двух страниц.
+    """
 
-        ttk.Label(settings, text="Битрейт:").grid(row=5, column=4, padx=(0, 5), pady=(5, 5), sticky="e")
-        self.audio_quality_var = tk.StringVar(value=DEFAULT_AUDIO_QUALITY)
-        self.audio_quality_cb = ttk.Combobox(settings, textvariable=self.audio_quality_var, state="readonly", width=8)
-        self.audio_quality_cb.grid(row=5, column=5, padx=(0, 15), pady=(5, 5), sticky="w")
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            url          TEXT    NOT NULL UNIQUE,
+            name         TEXT,
+            preset       TEXT    NOT NULL,
+            backfill     INTEGER NOT NULL DEFAULT 0,
+            created_ts   REAL    NOT NULL,
+            last_sync_ts REAL
+        );
+        CREATE TABLE IF NOT EXISTS subscription_seen (
+            sub_id      INTEGER NOT NULL,
+            video_id    TEXT    NOT NULL,
+            upload_date TEXT,
+            ts          REAL    NOT NULL,
+            PRIMARY KEY (sub_id, video_id)
+        );
+    """
 
-        # Субтитры
-        ttk.Label(settings, text="Субтитры:").grid(row=6, column=0, padx=(0, 5), pady=(5, 0), sticky="w")
-        self.write_subs_var = tk.IntVar(value=0)
-        write_cb = ttk.Checkbutton(settings, text="Скачать", variable=self.write_subs_var,
-                                   command=self._on_subtitle_option_changed)
-        write_cb.grid(row=6, column=1, sticky="w", pady=(5, 0))
-        self.embed_subs_var = tk.IntVar(value=0)
-        self.embed_subs_check = ttk.Checkbutton(settings, text="Встроить в видео", variable=self.embed_subs_var,
-                                               command=self._on_subtitle_option_changed)
-        self.embed_subs_check.grid(row=6, column=2, columnspan=2, sticky="w", pady=(5, 0))
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._SCHEMA)
+
+    def add(self, url: str, preset: DownloadPreset, name: Optional[str] = None, backfill: bool = False) -> Subscription:
+        """Новая подписка; для уже отслеживаемой ссылки — обновить пресет/название (виденное сохраняется)."""
+        preset = replace(preset, download_playlist=True)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO subscriptions (url, name, preset, backfill, created_ts) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET name = COALESCE(excluded.name, name), preset = excluded.preset",
+                (url, name, QueueStore.preset_to_json(preset), int(backfill), time.time()))
+        return next(sub for sub in self.list() if sub.url == url)
+
+    def remove(self, key: str) -> bool:
+        """По ID или ссылке."""
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM subscriptions WHERE url = ? OR CAST(id AS TEXT) = ?",
+                                     (key, key)).fetchone()
+            if not row:
+                return False
+            self._conn.execute("DELETE FROM subscription_seen WHERE sub_id = ?", row)
+            self._conn.execute("DELETE FROM subscriptions WHERE id = ?", row)
+        return True
+
+    def list(self) -> List[Subscription]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.id, s.url, s.name, s.preset, s.backfill, s.last_sync_ts, "
+                "(SELECT COUNT(*) FROM subscription_seen WHERE sub_id = s.id) FROM subscriptions s ORDER BY s.id"
+            ).fetchall()
+        subs = []
+        for sub_id, url, name, preset_json, backfill, last_sync, seen in rows:
+            try:
+                preset = QueueStore.preset_from_json(preset_json)
+            except (ValueError, TypeError):
+                continue
+            subs.append(Subscription(sub_id, url, name, preset, bool(backfill), last_sync, seen))
+        return subs
+
+    def seen_ids(self, sub_id: int) -> Tuple[set, Optional[str]]:
+        """Виденные ID и самая поздняя известная дата загрузки (YYYYMMDD)."""
+        with self._lock:
+            ids = {r[0] for r in self._conn.execute("SELECT video_id FROM subscription_seen WHERE sub_id = ?",
+                                                    (sub_id,))}
+            newest = self._conn.execute("SELECT MAX(upload_date) FROM subscription_seen WHERE sub_id = ?",
+                                        (sub_id,)).fetchone()[0]
+        return ids, newest
+
+    def mark_seen(self, sub_id: int, entries: List[Tuple[str, Optional[str]]]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO subscription_seen (sub_id, video_id, upload_date, ts) VALUES (?, ?, ?, ?)",
+                    [(sub_id, vid, date, now) for vid, date in entries])
+                self._conn.execute("UPDATE subscriptions SET last_sync_ts = ? WHERE id = ?", (now, sub_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def forget(self, sub_id: int, video_id: str):
+        """Видео не скачалось и задача нигде не сохранена — следующая синхронизация предложит его снова."""
+        with self._lock:
+            self._conn.execute("DELETE FROM subscription_seen WHERE sub_id = ? AND video_id = ?", (sub_id, video_id))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BandwidthGovernor:
+    """
+    Общий на все загрузки «ведро токенов» (байт/с). Загрузки платят за каждый скачанный
+    кусок из progress-хука и при нехватке токенов ждут — так поток yt-dlp (и каждый поток
+    фрагментов) сам притормаживает. Лимит меняется на лету (set_rate / set_schedule) и
+    подхватывается уже идущими загрузками в пределах долей секунды.
+    Необязательный лимит на одну загрузку (set_download_rate) — своё ведро у каждой загрузки
+    (new_bucket), платится поверх общего.
+    Заодно считает активные загрузки, чтобы подобрать concurrent_fragment_downloads.
+    """
 
-        self.subtitle_display_var = tk.StringVar(value="Не выбрано")
-        subtitle_entry = ttk.Entry(settings, textvariable=self.subtitle_display_var, state="readonly", width=40)
-        subtitle_entry.grid(row=6, column=4, columnspan=3, sticky="ew", padx=(0, 5), pady=(5, 0))
-        self.subtitle_select_btn = ttk.Button(settings, text="Выбрать языки...", command=self._open_subtitle_selector)
-        self.subtitle_select_btn.grid(row=6, column=7, columnspan=2, sticky="w", pady=(5, 0))
+    _WAIT_SLICE = 0.25  # как часто спящий поток перепроверяет лимит/отмену
+
+    def __init__(self, rate: int = 0):
+        self._lock = threading.Lock()
+        self._manual_rate = max(0, int(rate))
+        self._download_rate = 0  # байт/с на одну загрузку, 0 — без ограничения
+        self._schedule: List[Tuple[int, int, int]] = []
+        self._tokens = 0.0
+        self._ts = time.monotonic()
+        self._active = 0
+        self._schedule_cache = (-1, 0, False)  # (минута суток, лимит, из расписания)
+
+    # ---- настройки ----
+
+    def set_rate(self, rate: int):
+        with self._lock:
+            self._manual_rate = max(0, int(rate))
+            self._schedule_cache = (-1, 0, False)
+
+    def set_download_rate(self, rate: int):
+        with self._lock:
+            self._download_rate = max(0, int(rate))
+
+    def set_schedule(self, windows: List[Tuple[int, int, int]]):
+        with self._lock:
+            self._schedule = list(windows)
+            self._schedule_cache = (-1, 0, False)
+
+    def _rate_locked(self) -> Tuple[int, bool]:
+        lt = time.localtime()
+        minute = lt.tm_hour * 60 + lt.tm_min
+        cached_minute, rate, scheduled = self._schedule_cache
+        if cached_minute == minute:
+            return rate, scheduled
+        rate, scheduled = self._manual_rate, False
+        for start, end, win_rate in self._schedule:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                rate, scheduled = win_rate, True
+                break
+        self._schedule_cache = (minute, rate, scheduled)
+        return rate, scheduled
+
+    def current_rate(self) -> Tuple[int, bool]:
+        """(байт/с или 0 — без ограничения, задан ли лимит расписанием)."""
+        with self._lock:
+            return self._rate_locked()
+
+    def describe(self) -> str:
+        rate, scheduled = self.current_rate()
+        text = "без ограничения" if not rate else f"{human_readable_size(rate)}/s"
+        if scheduled:
+            text += " (по расписанию)"
+        with self._lock:
+            per_download = self._download_rate
+        if per_download:
+            text += f", на загрузку — {human_readable_size(per_download)}/s"
+        return text
+
+    # ---- учёт трафика ----
+
+    @staticmethod
+    def new_bucket() -> list:
+        """Ведро одной загрузки для лимита на загрузку: [токены, время]."""
+        return [0.0, time.monotonic()]
+
+    def consume(self, nbytes: int, cancel_event: Optional[threading.Event] = None,
+                bucket: Optional[list] = None):
+        if nbytes <= 0:
+            return
+        self._pay(nbytes, cancel_event, None)
+        if bucket is not None:
+            self._pay(nbytes, cancel_event, bucket)
+
+    def _pay(self, nbytes: int, cancel_event: Optional[threading.Event], bucket: Optional[list]):
+        """Списать nbytes из общего ведра (bucket=None) или из ведра загрузки; ждать, пока токенов нет."""
+        first = True
+        while True:
+            with self._lock:
+                if bucket is None:
+                    rate, _ = self._rate_locked()
+                    tokens, ts = self._tokens, self._ts
+                else:
+                    rate = self._download_rate
+                    tokens, ts = bucket
+                now = time.monotonic()
+                if not rate:
+                    tokens, ts = 0.0, now
+                else:
+                    burst = max(rate, 64 * 1024)  # не больше секунды «накопленной» скорости
+                    tokens, ts = min(burst, tokens + (now - ts) * rate), now
+                    if first:
+                        tokens -= nbytes
+                        first = False
+                if bucket is None:
+                    self._tokens, self._ts = tokens, ts
+                else:
+                    bucket[0], bucket[1] = tokens, ts
+                if not rate or tokens >= 0:
+                    return
+                wait = -tokens / rate
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            time.sleep(min(wait, self._WAIT_SLICE))
 
-        for col in range(0, 9):
-            weight = 1 if col in (1, 3, 6, 7, 8) else 0
-            settings.grid_columnconfigure(col, weight=weight)
-        settings.grid_columnconfigure(3, weight=2)
+    # ---- активные загрузки / фрагменты ----
 
-        # Кнопки управления
-        buttons = ttk.Frame(main, padding=(0, 0, 0, 0))
-        buttons.pack(fill="x", expand=False, pady=(0, pad))
-        self.download_btn = ttk.Button(buttons, text="Скачать сейчас", style="Accent.TButton", command=self._on_download_clicked)
-        self.download_btn.pack(side="left", padx=(0, pad))
-        self.cancel_btn = ttk.Button(buttons, text="Отмена", command=self._on_cancel_clicked, state="disabled")
-        self.cancel_btn.pack(side="left", padx=(0, pad))
-        self.open_btn = ttk.Button(buttons, text="Открыть папку", command=lambda: open_file_manager(self.outdir_var.get()))
-        self.open_btn.pack(side="left", padx=(0, pad))
-        self.update_yt_btn = ttk.Button(buttons, text="Обновить yt-dlp", command=self._on_update_yt_dlp)
-        self.update_yt_btn.pack(side="left", padx=(0, pad))
+    def begin(self):
+        with self._lock:
+            self._active += 1
 
-        # Прогресс
-        progress_frame = ttk.LabelFrame(main, text="Прогресс", padding=pad)
-        progress_frame.pack(fill="x", expand=False, pady=(0, pad))
-        self.progress = ttk.Progressbar(progress_frame, mode="determinate", maximum=100)
-        self.progress.pack(fill="x", padx=0, pady=(0, 5))
-        self.status_var = tk.StringVar(value="Ожидание...")
-        status_label = ttk.Label(progress_frame, textvariable=self.status_var)
-        status_label.pack(fill="x", pady=(0, 0))
+    def end(self):
+        with self._lock:
+            self._active = max(0, self._active - 1)
 
-        # Центральная область с очередью и логами
-        center_split = ttk.Panedwindow(main, orient="vertical")
-        center_split.pack(fill="both", expand=True, pady=(0, pad))
+    def fragment_concurrency(self) -> int:
+        """
+        Сколько фрагментов качать параллельно в новой загрузке: без лимита — делим общий
+        бюджет FRAGMENT_BUDGET на активные загрузки; с лимитом — по доле скорости, чтобы
+        лишние потоки не стояли в очереди за токенами.
+        """
+        with self._lock:
+            active = max(1, self._active)
+            rate, _ = self._rate_locked()
+        if rate:
+            n = -(-rate // active // FRAGMENT_RATE_STEP)  # ceil
+        else:
+            n = FRAGMENT_BUDGET // active
+        return max(1, min(MAX_FRAGMENT_CONCURRENCY, int(n)))
 
-        # Очередь
-        queue_frame = ttk.LabelFrame(center_split, text="Очередь загрузок", padding=pad)
 
-        queue_buttons = ttk.Frame(queue_frame)
-        queue_buttons.pack(fill="x", expand=False, pady=(0, pad))
-        self.add_queue_btn = ttk.Button(queue_buttons, text="Добавить в очередь", command=self._on_add_to_queue)
-        self.add_queue_btn.pack(side="left", padx=(0, 5))
-        self.load_txt_btn = ttk.Button(queue_buttons, text="Загрузить .txt в очередь", command=self._on_load_txt_to_queue)
-        self.load_txt_btn.pack(side="left", padx=(0, 5))
-        self.start_queue_btn = ttk.Button(queue_buttons, text="Старт очереди", style="Accent.TButton", command=self._on_start_queue)
-        self.start_queue_btn.pack(side="left", padx=(0, 5))
-        self.clear_queue_btn = ttk.Button(queue_buttons, text="Очистить очередь", command=self._on_clear_queue)
-        self.clear_queue_btn.pack(side="left", padx=(0, 5))
+class HostGovernor:
+    """
+    Темп запросов по хостам для всех YoutubeDL приложения (проба, анализ, загрузки, резерв MKV).
+    install(ydl) подменяет ydl.urlopen: перед каждым HTTP-запросом — токен из корзины хоста,
+    на ответ 429 — замедление хоста и пауза (Retry-After, если сервер его прислал).
+    slot(url, kind) ограничивает одновременные извлечения метаданных / загрузки с одного сайта.
+    Хост сводится к последним двум меткам имени: r3---sn-….googlevideo.com → googlevideo.com.
+    """
 
-        columns = ("title", "quality", "vcodec", "acodec", "container", "status")
-        self.queue_tv = ttk.Treeview(queue_frame, columns=columns, show="headings", height=10)
-        headers = {
-            "title": "Название",
-            "quality": "Качество",
-            "vcodec": "ВИДЕО",
-            "acodec": "АУДИО",
-            "container": "КОНТЕЙНЕР",
-            "status": "СТАТУС",
-        }
-        for col, w in zip(columns, (420, 110, 120, 140, 120, 120)):
-            self.queue_tv.heading(col, text=headers[col])
-            self.queue_tv.column(col, width=w, anchor="w")
-        self.queue_tv.pack(fill="both", expand=True)
+    def __init__(self, cancel_event: Optional[threading.Event] = None):
+        self.cancel_event = cancel_event
+        self.limits = {kind: dict(v) for kind, v in HOST_LIMITS.items()}
+        self.log: Optional[Callable[[str], None]] = None
+        self._cond = threading.Condition()
+        self._hosts: Dict[str, dict] = {}
 
-        center_split.add(queue_frame, weight=3)
+    @staticmethod
+    def host_key(url: str) -> Tuple[str, str]:
+        """(ключ хоста, "meta" / "media")."""
+        try:
+            host = (urlsplit(url).hostname or "").lower()
+        except ValueError:
+            host = ""
+        labels = host.split(".")
+        is_ip = ":" in host or host.replace(".", "").isdigit()
+        key = ".".join(labels[-2:]) if len(labels) > 2 and not is_ip else host
+        return key or "?", ("media" if key in HOST_MEDIA_DOMAINS else "meta")
+
+    def set_limits(self, kind: str, rps: Optional[float] = None, inflight: Optional[int] = None):
+        with self._cond:
+            if rps:
+                self.limits[kind]["rps"] = float(rps)
+            if inflight:
+                self.limits[kind]["inflight"] = max(1, int(inflight))
+            self._cond.notify_all()
+
+    def _state(self, key: str, kind: str) -> dict:
+        st = self._hosts.get(key)
+        if st is None:
+            st = self._hosts[key] = {
+                "kind": kind, "tokens": 1.0, "ts": time.monotonic(), "level": 0, "calm_since": 0.0,
+                "blocked_until": 0.0, "inflight": {"meta": 0, "media": 0},
+                "requests": 0, "throttled": 0, "waited": 0.0,
+            }
+        return st
+
+    def _recover(self, st: dict, now: float):
+        while st["level"] and now - st["calm_since"] >= HOST_RECOVERY_S:
+            st["level"] -= 1
+            st["calm_since"] += HOST_RECOVERY_S
+
+    def _rate(self, st: dict) -> float:
+        return self.limits[st["kind"]]["rps"] / 2 ** st["level"]
+
+    def _cap(self, st: dict, kind: str) -> int:
+        return max(1, self.limits[kind]["inflight"] >> st["level"])
+
+    def _cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    # ---- запросы ----
+
+    def pace(self, url: str):
+        """Перед HTTP-запросом: дождаться токена хоста и конца паузы после 429."""
+        key, kind = self.host_key(url)
+        t0 = time.monotonic()
+        with self._cond:
+            st = self._state(key, kind)
+            while True:
+                now = time.monotonic()
+                self._recover(st, now)
+                rate = self._rate(st)
+                wait = st["blocked_until"] - now
+                if wait > 0:  # за время паузы после 429 токены не копятся
+                    st["tokens"], st["ts"] = 0.0, now
+                else:
+                    st["tokens"] = min(max(1.0, rate), st["tokens"] + (now - st["ts"]) * rate)
+                    st["ts"] = now
+                    if st["tokens"] >= 1.0:
+                        st["tokens"] -= 1.0
+                        break
+                    wait = (1.0 - st["tokens"]) / rate
+                if self._cancelled():
+                    break
+                self._cond.wait(min(wait, 0.25))
+            st["requests"] += 1
+            st["waited"] += time.monotonic() - t0
+
+    def throttled(self, url: str, retry_after: Optional[float] = None):
+        """Хост ответил 429: ступень замедления (не чаще раза за паузу — пачка 429 считается одним) и пауза."""
+        key, kind = self.host_key(url)
+        with self._cond:
+            st = self._state(key, kind)
+            now = time.monotonic()
+            st["throttled"] += 1
+            if not st["level"] or now - st["calm_since"] >= HOST_COOLDOWN_S:
+                st["level"] = min(HOST_MAX_SLOWDOWN, st["level"] + 1)
+            st["calm_since"] = now
+            pause = retry_after or HOST_COOLDOWN_S * 2 ** (st["level"] - 1)
+            st["blocked_until"] = max(st["blocked_until"], now + min(pause, HOST_MAX_COOLDOWN_S))
+            st["tokens"] = 0.0
+            level, pause = st["level"], st["blocked_until"] - now
+        if self.log:
+            self.log(f"{key}: HTTP 429 — темп запросов к хосту снижен до 1/{2 ** level}, пауза {pause:.0f} с.")
+
+    def install(self, ydl):
+        """Пропускать все запросы этого экземпляра YoutubeDL (экстракторы и загрузчики) через pace()."""
+        send = ydl.urlopen
+
+        def urlopen(req):
+            url = req if isinstance(req, str) else (getattr(req, "url", None) or req.get_full_url())
+            self.pace(url)
+            try:
+                return send(req)
+            except Exception as e:
+                if getattr(e, "status", None) == 429:
+                    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+                    retry_after = str(headers.get("Retry-After") or "").strip()
+                    self.throttled(url, float(retry_after) if retry_after.isdigit() else None)
+                raise
+
+        ydl.urlopen = urlopen
+        return ydl
+
+    @contextmanager
+    def slot(self, url: str, kind: str):
+        """Место среди одновременных извлечений ("meta") или загрузок ("media") с сайта ссылки."""
+        key, host_kind = self.host_key(url)
+        with self._cond:
+            st = self._state(key, host_kind)
+            while st["inflight"][kind] >= self._cap(st, kind) and not self._cancelled():
+                self._recover(st, time.monotonic())
+                self._cond.wait(0.25)
+            st["inflight"][kind] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                st["inflight"][kind] -= 1
+                self._cond.notify_all()
+
+    # ---- счётчики ----
+
+    def stats(self) -> Dict[str, dict]:
+        now = time.monotonic()
+        with self._cond:
+            out = {}
+            for key, st in self._hosts.items():
+                self._recover(st, now)
+                out[key] = {
+                    "kind": st["kind"],
+                    "requests": st["requests"],
+                    "throttled": st["throttled"],
+                    "waited_s": round(st["waited"], 1),
+                    "slowdown": 2 ** st["level"],
+                    "paused_s": round(max(0.0, st["blocked_until"] - now), 1),
+                    "inflight": dict(st["inflight"]),
+                }
+            return out
+
+    def describe(self, limit: int = 3) -> str:
+        """Коротко по самым нагруженным хостам: запросы, 429, текущее замедление."""
+        hosts = sorted(self.stats().items(), key=lambda kv: -kv[1]["requests"])[:limit]
+        parts = []
+        for key, st in hosts:
+            text = f"{key}: {st['requests']} запр."
+            if st["throttled"]:
+                text += f", 429×{st['throttled']}"
+            if st["slowdown"] > 1:
+                text += f", темп 1/{st['slowdown']}"
+            if st["paused_s"]:
+                text += f", пауза {st['paused_s']:.0f} с"
+            parts.append(text)
+        return " | ".join(parts)
+
+
+class QueueTelemetry:
+    """
+    Сводка по прогону очереди, считается инкрементально (O(1) на колбэк):
+    скачано/осталось байт, скорость (скользящее среднее за THROUGHPUT_WINDOW с),
+    ETA всей очереди, задач в час. Объём задач без оценки экстраполируется
+    средним по известным. Снимок периодически пишется в JSON (stats_path).
+    """
 
-        # Контекстное меню / события таблицы
-        self._queue_menu = tk.Menu(self, tearoff=0)
-        self._queue_menu.add_command(label="Изменить…", command=self._on_queue_edit_selected)
-        self._queue_menu.add_command(label="Удалить", command=self._on_queue_delete_selected)
-        self._MENU_IDX_EDIT = 0
-        self._MENU_IDX_DELETE = 1
-        self.queue_tv.bind("<Button-3>", self._on_queue_right_click)
-        self.queue_tv.bind("<Control-Button-1>", self._on_queue_right_click)
-        self.queue_tv.bind("<Double-1>", self._on_queue_double_click)
-        self.queue_tv.configure(selectmode="extended")
+    def __init__(self, stats_path: Optional[str] = QUEUE_STATS_PATH, hosts: Optional[HostGovernor] = None):
+        self.stats_path = stats_path
+        self.hosts = hosts
+        self.stages: Optional[Callable[[], Dict[str, dict]]] = None  # стадии прогона (загрузка/ffmpeg)
+        self._lock = threading.Lock()
+        self.begin([])
+
+    def begin(self, items: List[QueueItem]):
+        with self._lock:
+            self._started = time.time()
+            self._pending: set = set()             # uid задач прогона, ещё не завершённых
+            self._estimates: Dict[int, int] = {}   # uid → ожидаемые байты незавершённых задач
+            self._done_by_item: Dict[int, int] = {}
+            self._unknown = 0                      # незавершённые задачи без оценки
+            self._known_sum = 0                    # сумма оценок (для среднего размера)
+            self._known_count = 0
+            self._est_sum = 0                      # = sum(_estimates.values())
+            self._est_done = 0                     # скачано задачами из _estimates (уже в пути)
+            self._bytes_done = 0
+            self._total = 0
+            self._finished = 0
+            self._ok = 0
+            self._failed = 0
+            self._skipped = 0
+            self._buckets: deque = deque()          # (секунда, байт) для скользящей скорости
+            self._last_write = 0.0
+        self.add_items(items)
+
+    def add_items(self, items: List[QueueItem]):
+        with self._lock:
+            for item in items:
+                if item.uid in self._pending:
+                    continue
+                self._pending.add(item.uid)
+                self._total += 1
+                if item.size_estimate:
+                    self._estimates[item.uid] = item.size_estimate
+                    self._est_sum += item.size_estimate
+                    self._est_done += self._done_by_item.get(item.uid, 0)
+                    self._known_sum += item.size_estimate
+                    self._known_count += 1
+                else:
+                    self._unknown += 1
 
-        # --- ДВА ЛОГА: слева важный, справа подробный ---
-        logs_group = ttk.LabelFrame(center_split, text="Журналы", padding=pad)
+    def set_estimate(self, item: QueueItem, size: Optional[int]):
+        """Оценка появилась/уточнилась по ходу (проба перед загрузкой)."""
+        if not size:
+            return
+        item.size_estimate = size
+        with self._lock:
+            if item.uid not in self._pending:
+                return
+            old = self._estimates.get(item.uid)
+            if old is None:
+                self._unknown = max(0, self._unknown - 1)
+                self._known_count += 1
+                self._est_done += self._done_by_item.get(item.uid, 0)
+            else:
+                self._known_sum -= old
+                self._est_sum -= old
+            self._estimates[item.uid] = size
+            self._known_sum += size
+            self._est_sum += size
+
+    def add_bytes(self, item: Optional[QueueItem], nbytes: int):
+        if nbytes <= 0 or item is None:
+            return
+        now = time.time()
+        sec = int(now)
+        with self._lock:
+            self._bytes_done += nbytes
+            self._done_by_item[item.uid] = self._done_by_item.get(item.uid, 0) + nbytes
+            if item.uid in self._estimates:
+                self._est_done += nbytes
+            if self._buckets and self._buckets[-1][0] == sec:
+                self._buckets[-1][1] += nbytes
+            else:
+                self._buckets.append([sec, nbytes])
+                while self._buckets and self._buckets[0][0] <= sec - THROUGHPUT_WINDOW:
+                    self._buckets.popleft()
+        self._maybe_write(now)
+
+    def _drop_estimate(self, uid: int):
+        """Убрать задачу из оценок остатка (под self._lock)."""
+        est = self._estimates.pop(uid, None)
+        done = self._done_by_item.pop(uid, 0)
+        if est is None:
+            self._unknown = max(0, self._unknown - 1)
+        else:
+            self._est_sum -= est
+            self._est_done -= done
 
-        # горизонтальное расположение панелей (левая/правая)
-        paned = ttk.Panedwindow(logs_group, orient="horizontal")
-        paned.pack(fill="both", expand=True)
+    def add_resumed(self, item: Optional[QueueItem], nbytes: int):
+        """Уже лежащее на диске (докачка): уменьшает остаток задачи, но не скорость и не «скачано»."""
+        if nbytes <= 0 or item is None:
+            return
+        with self._lock:
+            self._done_by_item[item.uid] = self._done_by_item.get(item.uid, 0) + nbytes
+            if item.uid in self._estimates:
+                self._est_done += nbytes
+
+    def item_finished(self, item: QueueItem, result: str):
+        with self._lock:
+            if item.uid not in self._pending:
+                return
+            self._pending.discard(item.uid)
+            if result == "expanded":  # плейлист развернулся в отдельные задачи — сам он не задача
+                self._total -= 1
+                self._drop_estimate(item.uid)
+                return
+            self._finished += 1
+            if result == "success":
+                self._ok += 1
+            elif result == "error":
+                self._failed += 1
+            else:                                  # archived / skip / cancel
+                self._skipped += 1
+            self._drop_estimate(item.uid)
+        self._maybe_write(time.time(), force=True)
+
+    # ---- чтение ----
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            elapsed = max(0.0, now - self._started)
+            window_start = int(now) - THROUGHPUT_WINDOW + 1
+            recent = sum(b for sec, b in self._buckets if sec >= window_start)
+            span = max(1.0, min(float(THROUGHPUT_WINDOW), elapsed))
+            speed = recent / span
+            avg_size = self._known_sum / self._known_count if self._known_count else 0
+            remaining = max(0, self._est_sum - self._est_done) + int(self._unknown * avg_size)
+            snap = {
+                "started_at": self._started,
+                "updated_at": now,
+                "elapsed_s": round(elapsed, 1),
+                "items_total": self._total,
+                "items_finished": self._finished,
+                "items_ok": self._ok,
+                "items_failed": self._failed,
+                "items_skipped": self._skipped,
+                "items_unknown_size": self._unknown,
+                "bytes_done": self._bytes_done,
+                "bytes_remaining": remaining,
+                "throughput_bps": round(speed, 1),
+                "eta_s": int(remaining / speed) if speed > 0 and remaining else None,
+                "items_per_hour": round(self._ok / elapsed * 3600, 1) if elapsed >= 60 else None,
+            }
+        if self.hosts:
+            snap["hosts"] = self.hosts.stats()
+        if self.stages:
+            snap["stages"] = self.stages()
+        return snap
+
+    def summary_line(self) -> str:
+        st = self.snapshot()
+        eta = seconds_to_hms(st["eta_s"]) if st["eta_s"] is not None else "?"
+        rest = human_readable_size(st["bytes_remaining"])
+        if st["items_unknown_size"]:
+            rest = "≈" + rest
+        line = (f"{human_readable_size(st['throughput_bps'])}/s · скачано {human_readable_size(st['bytes_done'])}, "
+                f"осталось {rest} · ETA {eta}")
+        if st["items_per_hour"] is not None:
+            line += f" · {st['items_per_hour']:.1f} задач/ч"
+        for key, label in (("download", "загрузка"), ("postprocess", "ffmpeg")):
+            stage = (st.get("stages") or {}).get(key)
+            if stage:
+                line += (f" · {label} {stage['busy']}/{stage['workers']}, очередь {stage['depth']}, "
+                         f"занято {stage['utilization'] * 100:.0f}%")
+        return line
+
+    def _maybe_write(self, now: float, force: bool = False):
+        if not self.stats_path:
+            return
+        with self._lock:
+            if not force and now - self._last_write < QUEUE_STATS_INTERVAL:
+                return
+            self._last_write = now
+        self.write()
 
-        # Важные сообщения (слева)
-        imp_frame = ttk.LabelFrame(paned, text="Важные сообщения", padding=pad)
-        self.log_main_text = tk.Text(imp_frame, wrap="word", height=10, state="disabled", bg=LIGHT_PANEL_BG, fg=TEXT_COLOR, insertbackground=ACCENT_COLOR)
-        imp_vsb = ttk.Scrollbar(imp_frame, orient="vertical", command=self.log_main_text.yview)
-        self.log_main_text.configure(yscrollcommand=imp_vsb.set)
-        self.log_main_text.pack(side="left", fill="both", expand=True)
-        imp_vsb.pack(side="right", fill="y")
-        paned.add(imp_frame, weight=1)
+    def write(self):
+        """Снимок в JSON атомарно (tmp + replace), чтобы читатель не увидел полфайла."""
+        if not self.stats_path:
+            return
+        tmp = f"{self.stats_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.stats_path)
+        except OSError:
+            pass
 
-        # Подробный лог (справа)
-        raw_frame = ttk.LabelFrame(paned, text="Подробный лог (yt-dlp)", padding=pad)
-        self.log_raw_text = tk.Text(raw_frame, wrap="none", height=10, state="disabled", bg=LIGHT_PANEL_BG, fg=TEXT_COLOR, insertbackground=ACCENT_COLOR)
-        raw_vsb = ttk.Scrollbar(raw_frame, orient="vertical", command=self.log_raw_text.yview)
-        self.log_raw_text.configure(yscrollcommand=raw_vsb.set)
-        self.log_raw_text.pack(side="left", fill="both", expand=True)
-        raw_vsb.pack(side="right", fill="y")
-        paned.add(raw_frame, weight=1)
 
-        center_split.add(logs_group, weight=2)
+class DiskBudget:
+    """
+    Резерв места на дисках под задачи, которые качаются одновременно. Резервы задач на одном диске
+    вычитаются из реально свободного места (shutil.disk_usage) вместе с запасом margin. Оценка
+    с запасом: уже записанное идущими задачами учитывается и в свободном месте, и в их резерве.
+    Не помещается: "hold", если на диске есть чужие резервы (их задачи закончат — место освободится),
+    иначе "full" — ждать нечего.
+    """
 
-        # Стили
+    def __init__(self, margin: int = DISK_RESERVE_MARGIN):
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._reserved: Dict[object, Tuple[int, int]] = {}  # ключ задачи -> (устройство, байты)
+
+    @staticmethod
+    def _existing_dir(path: str) -> str:
+        """Папка назначения может ещё не существовать (её создаст yt-dlp) — берём ближайшую родительскую."""
+        path = os.path.abspath(path or ".")
+        while not os.path.isdir(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return path
+
+    def reserve(self, key, directory: str, nbytes: int) -> Tuple[str, int]:
+        """("ok" / "hold" / "full", сколько байт доступно с учётом чужих резервов и запаса)."""
+        path = self._existing_dir(directory)
         try:
-            self.style = ttk.Style(self)
-            if sys.platform == "darwin":
-                self.style.theme_use("aqua")
-            else:
-                self.style.theme_use("clam")
-        except Exception:
-            self.style = ttk.Style(self)
+            dev = os.stat(path).st_dev
+            free = shutil.disk_usage(path).free
+        except OSError:
+            return "ok", 0  # место узнать не удалось — загрузке не мешаем
+        with self._lock:
+            self._reserved.pop(key, None)
+            others = sum(n for d, n in self._reserved.values() if d == dev)
+            available = free - others - self.margin
+            if nbytes <= available:
+                self._reserved[key] = (dev, nbytes)
+                return "ok", available
+            return ("hold" if others else "full"), available
+
+    def release(self, key):
+        with self._lock:
+            self._reserved.pop(key, None)
+
+    def reserved(self) -> int:
+        with self._lock:
+            return sum(n for _dev, n in self._reserved.values())
+
+
+class StageUsage:
+    """Сколько потоков стадии заняты сейчас и какую долю времени были заняты с начала прогона."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._started = self._since = time.time()
+        self._busy = 0
+        self._busy_s = 0.0
+
+    def _account(self, now: float):
+        self._busy_s += self._busy * (now - self._since)
+        self._since = now
+
+    def begin(self):
+        with self._lock:
+            self._account(time.time())
+            self._busy += 1
+
+    def end(self):
+        with self._lock:
+            self._account(time.time())
+            self._busy -= 1
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            self._account(now)
+            elapsed = now - self._started
+            return {
+                "workers": self.workers,
+                "busy": self._busy,
+                "utilization": round(self._busy_s / (self.workers * elapsed), 3) if elapsed > 0 else 0.0,
+            }
 
-        self.style.configure("TFrame", background=LIGHT_BG)
-        self.style.configure("TLabelframe", background=LIGHT_BG, foreground=TEXT_COLOR)
-        self.style.configure("TLabelframe.Label", background=LIGHT_BG, foreground=TEXT_COLOR)
-        self.style.configure("TLabel", background=LIGHT_BG, foreground=TEXT_COLOR)
-        self.style.configure("TCheckbutton", background=LIGHT_BG, foreground=TEXT_COLOR)
-        self.style.configure("TEntry", fieldbackground=LIGHT_PANEL_BG, foreground=TEXT_COLOR)
-        self.style.configure("TCombobox", fieldbackground=LIGHT_PANEL_BG, foreground=TEXT_COLOR)
-        self.style.configure("TButton", background="#dbe8ff", foreground=TEXT_COLOR)
-        self.style.map("TButton", background=[("active", "#c9dcff")])
-        self.style.configure("Accent.TButton", background=ACCENT_COLOR, foreground="#ffffff")
-        self.style.map("Accent.TButton", background=[("active", ACCENT_COLOR_ACTIVE)])
-        self.style.configure("Treeview", background=LIGHT_PANEL_BG, fieldbackground=LIGHT_PANEL_BG, foreground=TEXT_COLOR, rowheight=24)
-        self.style.configure("Treeview.Heading", background=ACCENT_COLOR, foreground="#ffffff")
-        self.style.configure("TProgressbar", troughcolor="#dce4f5", background=ACCENT_COLOR)
 
-        # Нижняя панель
-        footer = ttk.Frame(main, padding=(0, pad, 0, 0))
-        footer.pack(fill="x", expand=False)
-        note = ttk.Label(
-            footer,
-            text="Соблюдайте авторские права и условия YouTube. Загружайте только то, на что у вас есть права.",
-            foreground=MUTED_TEXT_COLOR
-        )
-        note.pack(side="left")
-        # Версия yt-dlp
-        self.ydl_version_var = tk.StringVar(value=f"yt-dlp {getattr(yt_dlp, '__version__', '?')}")
-        ver_lbl = ttk.Label(footer, textvariable=self.ydl_version_var, foreground=MUTED_TEXT_COLOR)
-        ver_lbl.pack(side="right")
+class WorkQueue:
+    """
+    Прогон задач `workers` потоками по порядку очереди. Задача, ждущая повтора
+    (item.retry_at в будущем), пропускается, пока не подойдёт её время, — остальные
+    идут мимо неё. Если run_fn вернула "retry" (или "hold" — ждёт места на диске), задача встаёт в хвост.
+    "deferred" — задачу доделывает пул пост-обработки и сообщит итог через complete().
+    После close() потоки завершаются, когда задач не осталось и ни одна не выполняется
+    и не ждёт пост-обработки.
+    """
 
-        self._refresh_audio_quality_values()
-        self._on_audio_only_toggle(init=True)
-        self._update_subtitle_display()
-        self._on_subtitle_option_changed(init=True)
+    def __init__(self, run_fn: Callable[[QueueItem], str], workers: int, cancel_event: threading.Event):
+        self._run_fn = run_fn
+        self._cancel = cancel_event
+        self._items: deque = deque()
+        self._cond = threading.Condition()
+        self._busy = 0
+        self._deferred = 0
+        self._closed = False
+        self._threads = [threading.Thread(target=self._worker, name=f"queue-worker-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        self.usage = StageUsage(len(self._threads))
+        for t in self._threads:
+            t.start()
+
+    def put(self, items: List[QueueItem]):
+        with self._cond:
+            self._items.extend(items)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def complete(self, item: QueueItem, result: str):
+        """Итог задачи, отданной пулу пост-обработки (run_fn вернула "deferred")."""
+        with self._cond:
+            self._deferred -= 1
+            if result == "retry":
+                self._items.append(item)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        st = self.usage.stats()
+        st["depth"] = len(self._items)
+        return st
+
+    def _take(self) -> Optional[QueueItem]:
+        with self._cond:
+            while not self._cancel.is_set():
+                now = time.time()
+                wait = 0.5  # не дольше — чтобы заметить отмену
+                for i, item in enumerate(self._items):
+                    if item.retry_at <= now:
+                        del self._items[i]
+                        self._busy += 1
+                        return item
+                    wait = min(wait, item.retry_at - now)
+                if not self._items and self._closed and not self._busy and not self._deferred:
+                    return None
+                self._cond.wait(wait)
+            return None
 
-    # ------------------------ Доп. помощники UI ------------------------
+    def _worker(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            result = "error"
+            self.usage.begin()
+            try:
+                result = self._run_fn(item)
+            finally:
+                self.usage.end()
+                with self._cond:
+                    self._busy -= 1
+                    if result in ("retry", "hold"):
+                        self._items.append(item)
+                    elif result == "deferred":
+                        self._deferred += 1
+                    self._cond.notify_all()
 
-    def _refresh_audio_quality_values(self):
-        if not hasattr(self, "audio_quality_cb"):
-            return
-        fmt_key = self.audio_format_var.get() or DEFAULT_AUDIO_FORMAT
-        fmt = AUDIO_FORMAT_OPTIONS.get(fmt_key, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
-        values = fmt.get("bitrate_values", [])
-        if values:
-            self.audio_quality_cb.configure(values=values, state="readonly")
-            if self.audio_quality_var.get() not in values:
-                self.audio_quality_var.set(values[0])
-        else:
-            self.audio_quality_cb.configure(values=[], state="disabled")
-            self.audio_quality_var.set("0")
 
-    def _on_audio_format_selected(self):
-        label = self.audio_format_label_var.get()
-        fmt = self.audio_format_map.get(label, DEFAULT_AUDIO_FORMAT)
-        self.audio_format_var.set(fmt)
-        self._refresh_audio_quality_values()
-        self._save_settings_debounced()
+class PostProcessPool:
+    """
+    Потоки пост-обработки очереди: загрузчик кладёт задание (ffmpeg по уже скачанным файлам)
+    и сразу берёт следующую ссылку. Если заданий ждёт больше max_backlog на поток, submit()
+    ждёт свободного места — так загрузки не убегают далеко вперёд ffmpeg.
+    Задание само подводит итог задачи (и при отмене), поэтому пул выполняет все принятые.
+    """
 
-    def _on_audio_only_toggle(self, init: bool = False):
-        only_audio = bool(self.audio_only_var.get())
-        state_main = "disabled" if only_audio else "readonly"
-        for widget in [self.quality_cb, self.vcodec_cb, self.acodec_cb, self.container_cb]:
+    def __init__(self, workers: int, cancel_event: threading.Event, max_backlog: int = POSTPROC_MAX_BACKLOG):
+        self._cancel = cancel_event
+        self._jobs: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._worker, name=f"postproc-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        self._max_depth = len(self._threads) * max(1, max_backlog)
+        self.usage = StageUsage(len(self._threads))
+        for t in self._threads:
+            t.start()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def submit(self, job: Callable[[], None]):
+        with self._cond:
+            while len(self._jobs) >= self._max_depth and not self._cancel.is_set():
+                self._cond.wait(0.5)
+            self._jobs.append(job)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def stats(self) -> dict:
+        st = self.usage.stats()
+        st["depth"] = len(self._jobs)
+        return st
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._closed:
+                    self._cond.wait()
+                if not self._jobs:
+                    return
+                job = self._jobs.popleft()
+                self._cond.notify_all()  # место для загрузчика, ждущего в submit()
+            self.usage.begin()
             try:
-                widget.configure(state=state_main)
-            except Exception:
-                pass
-        audio_state = "readonly" if only_audio else "disabled"
-        try:
-            self.audio_format_cb.configure(state=audio_state)
-        except Exception:
-            pass
-        if only_audio:
-            self._refresh_audio_quality_values()
-        if self.audio_quality_cb:
-            try:
-                if audio_state == "disabled":
-                    self.audio_quality_cb.configure(state="disabled")
-                elif self.audio_quality_cb.cget("state") == "disabled":
-                    self.audio_quality_cb.configure(state="readonly")
-            except Exception:
-                pass
-        if not init:
-            self._save_settings_debounced()
+                job()
+            finally:
+                self.usage.end()
 
-    def _on_subtitle_option_changed(self, init: bool = False):
-        if not self.write_subs_var.get():
-            self.embed_subs_var.set(0)
-        state = "normal" if self.write_subs_var.get() else "disabled"
-        if hasattr(self, 'embed_subs_check'):
-            self.embed_subs_check.configure(state=state)
-        if hasattr(self, 'subtitle_select_btn'):
-            self.subtitle_select_btn.configure(state=state)
-        if not init:
-            self._save_settings_debounced()
 
-    def _update_subtitle_display(self):
-        if not hasattr(self, "subtitle_display_var"):
-            return
-        if self.selected_subtitle_langs:
-            self.subtitle_display_var.set(", ".join(sorted(self.selected_subtitle_langs)))
-        else:
-            self.subtitle_display_var.set("Не выбрано")
+class EngineListener:
+    """
+    Куда DownloadEngine сообщает о ходе работы. Базовая реализация ничего не показывает;
+    окно Tk и консольный режим переопределяют нужные методы.
+    Вызовы приходят из рабочих потоков загрузки.
+    """
 
-    def _open_subtitle_selector(self):
-        if not self.available_subtitle_languages:
-            messagebox.showinfo(
-                "Субтитры",
-                "Список доступных субтитров пока неизвестен. Нажмите «Анализировать» для получения метаданных.",
-            )
-            return
+    def log(self, msg: str):
+        pass
 
-        win = tk.Toplevel(self)
-        win.title("Выбор субтитров")
-        win.transient(self)
-        win.grab_set()
-        pad = 10
+    def raw(self, msg: str):
+        pass
 
-        frame = ttk.Frame(win, padding=pad)
-        frame.pack(fill="both", expand=True)
+    def ydl_logger(self):
+        """Объект-логгер для опции yt-dlp 'logger'."""
+        return ListenerYdlLogger(self)
 
-        ttk.Label(frame, text="Выберите языки субтитров (можно несколько):").pack(anchor="w", pady=(0, 5))
+    def status(self, text: str):
+        """Общая строка статуса (одиночная загрузка)."""
 
-        listbox = tk.Listbox(frame, selectmode="multiple", height=10)
-        scrollbar = ttk.Scrollbar(frame, orient="vertical", command=listbox.yview)
-        listbox.configure(yscrollcommand=scrollbar.set)
-        listbox.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
+    def progress(self, percent: float):
+        """Общий прогресс (одиночная загрузка)."""
 
-        for idx, lang in enumerate(sorted(self.available_subtitle_languages)):
-            listbox.insert("end", lang)
-            if lang in self.selected_subtitle_langs:
-                listbox.selection_set(idx)
+    def item_state(self, item: QueueItem, status: str):
+        """Сменился статус задачи очереди («В процессе», «Готово», «Ошибка», ...)."""
 
-        btns = ttk.Frame(frame)
-        btns.pack(fill="x", expand=False, pady=(pad, 0))
+    def item_detail(self, item: QueueItem):
+        """Обновились item.detail / item.progress."""
 
-        def on_ok():
-            selections = [listbox.get(i) for i in listbox.curselection()]
-            self.selected_subtitle_langs = selections
-            self._update_subtitle_display()
-            self._save_settings_debounced()
-            win.destroy()
+    def item_title(self, item: QueueItem):
+        """Стало известно item.title."""
 
-        ttk.Button(btns, text="Отмена", command=win.destroy).pack(side="right")
-        ttk.Button(btns, text="Сохранить", style="Accent.TButton", command=on_ok).pack(side="right", padx=(0, 5))
+    def item_position(self, item: QueueItem) -> str:
+        """Префикс вида «[3/10] » для строки прогресса задачи."""
+        return ""
 
-    def _flatten_info_entries(self, info: dict) -> List[dict]:
-        if not isinstance(info, dict):
-            return []
-        if info.get("_type") in ("playlist", "multi_video") and info.get("entries"):
-            entries = []
-            for entry in info.get("entries", []):
-                if isinstance(entry, dict):
-                    entries.append(entry)
-            return entries or [info]
-        return [info]
+    def info_ready(self, info: dict):
+        """Получены метаданные текущей загрузки (для обновления списков языков и т.п.)."""
 
-    def _update_languages_from_info(self, info: dict):
-        entries = self._flatten_info_entries(info)
-        audio_langs = set()
-        subtitle_langs = set(self.available_subtitle_languages)
+    def error(self, item: Optional[QueueItem], message: str):
+        """Загрузка завершилась ошибкой."""
 
-        for entry in entries:
-            for fmt in entry.get("formats", []) or []:
-                raw_values = []
-                for key in ("language", "language_code", "language_original", "audio_lang"):
-                    value = fmt.get(key)
-                    if not value:
-                        continue
-                    if isinstance(value, (list, tuple, set)):
-                        raw_values.extend(value)
-                    else:
-                        raw_values.append(value)
+    def should_start(self, item: QueueItem) -> bool:
+        """False — задачу из очереди уже убрали, запускать не нужно."""
+        return True
 
-                pref_value = fmt.get("language_preference")
-                if isinstance(pref_value, str):
-                    raw_values.append(pref_value)
+    def item_started(self, item: QueueItem):
+        pass
 
-                for candidate in raw_values:
-                    if candidate is None:
-                        continue
-                    if isinstance(candidate, (int, float)):
-                        continue
-                    normalized = str(candidate).strip()
-                    if not normalized:
-                        continue
-                    normalized = normalized.replace("_", "-").lower()
-                    if "-" in normalized:
-                        normalized = normalized.split("-", 1)[0]
-                    if normalized and normalized not in {"und", "none"}:
-                        audio_langs.add(normalized)
-            subtitles = entry.get("subtitles") or {}
-            for lang_code in subtitles.keys():
-                if lang_code is None:
-                    continue
-                normalized_code = str(lang_code).strip()
-                if normalized_code:
-                    subtitle_langs.add(normalized_code)
+    def item_finished(self, item: QueueItem, result: str):
+        """result: 'success' / 'archived' (уже скачано раньше) / 'expanded' (плейлист развёрнут) / 'cancel' / 'error'."""
 
-        if audio_langs:
-            others = sorted({l for l in audio_langs if l.lower() not in ("", "und", "none", "orig")})
-            normalized = ["orig"] + others
-            self.available_audio_languages = normalized
-            current = self.alang_var.get()
-            self.alang_cb.configure(values=normalized)
-            if current not in normalized:
-                self.alang_var.set("orig")
+    def items_added(self, parent: QueueItem, items: List[QueueItem]):
+        """Плейлист parent дал очередную порцию задач по видео (они уже поставлены в работу)."""
 
-        self.available_subtitle_languages = sorted(subtitle_langs)
-        self.selected_subtitle_langs = [lang for lang in self.selected_subtitle_langs if lang in self.available_subtitle_languages]
-        self._update_subtitle_display()
+    def item_retry(self, item: QueueItem):
+        """Задача упала с временной ошибкой и ушла в хвост; item.history пополнилась, ждёт до item.retry_at."""
 
-        langs_preview = ", ".join(self.available_audio_languages[:6])
-        subs_preview = ", ".join(self.available_subtitle_languages[:6]) or "—"
-        self._append_log(f"Анализ завершён. Аудиодорожки: {langs_preview or '—'} | Субтитры: {subs_preview}")
-        self._set_analyze_state(
-            "done",
-            f"Найдено аудио: {len(self.available_audio_languages)} | субтитры: {len(self.available_subtitle_languages)}",
-        )
 
-    def _set_analyze_state(self, state: str, message: str = ""):
-        if not hasattr(self, "analyze_btn"):
-            return
+class ListenerYdlLogger:
+    """Логгер yt-dlp поверх EngineListener: debug — в подробный лог, остальное — в основной."""
 
-        def apply():
-            try:
-                if state == "running":
-                    self.analyze_btn.configure(state="disabled", text="Анализ…")
-                    self.analyze_status_var.set(message or "Получаем данные…")
-                elif state == "done":
-                    self.analyze_btn.configure(state="normal", text="Анализировать")
-                    self.analyze_status_var.set(message)
-                elif state == "error":
-                    self.analyze_btn.configure(state="normal", text="Анализировать")
-                    self.analyze_status_var.set(message or "Не удалось получить метаданные")
-                else:
-                    self.analyze_btn.configure(state="normal", text="Анализировать")
-                    self.analyze_status_var.set(message)
-            except Exception:
-                pass
+    def __init__(self, listener: EngineListener):
+        self.listener = listener
 
-        self.after(0, apply)
+    def debug(self, msg):
+        self.listener.raw(str(msg))
 
-    def _on_fetch_metadata_clicked(self):
-        url = (self.url_var.get() or "").strip()
-        if not url:
-            messagebox.showwarning("Введите ссылку", "Пожалуйста, вставьте ссылку для анализа.")
-            return
-        if self._metadata_fetching:
-            return
-        self._metadata_fetching = True
-        self._set_analyze_state("running")
-        self._append_log("Анализируем ссылку через yt-dlp...")
-        threading.Thread(target=self._fetch_metadata_worker, args=(url,), daemon=True).start()
+    def info(self, msg):
+        self.listener.log(str(msg))
+
+    def warning(self, msg):
+        self.listener.log("[ВНИМАНИЕ] " + str(msg))
+
+    def error(self, msg):
+        self.listener.log("[ОШИБКА] " + str(msg))
+
+
+class DownloadEngine:
+    """
+    Независимая от UI часть загрузчика: пресет → опции yt-dlp, проба, загрузка,
+    резервная сборка MKV, переименование результата и параллельный прогон очереди.
+    Используется и окном Tk, и консольным/фоновым режимом (--batch / --daemon).
+    """
+
+    # Состояние текущей загрузки — своё у каждого рабочего потока очереди
+    _current_title = _PerThread(None)
+    _extra_status_suffix = _PerThread("")   # короткая подпись кодеков/контейнера в статусе
+    last_output_path = _PerThread(None)
+    _last_raw_line_ts = _PerThread(0.0)
+    _last_raw_percent = _PerThread(-1.0)
+    _last_error = _PerThread(None)          # исключение последней неудачной попытки — для классификации
+    _stage_times = _PerThread(None)         # этап (загрузка, Merger, VideoRemuxer, …) → секунды, для лога
+    _stage_started = _PerThread(None)       # этап → время начала
+
+    def __init__(self, listener: Optional[EngineListener] = None, metadata_cache: Optional[MetadataCache] = None,
+                 archive: Optional[DownloadArchive] = None):
+        self._tls = threading.local()
+        self.listener = listener or EngineListener()
+        self.cancel_event = threading.Event()
+        self.metadata_cache = metadata_cache or MetadataCache(METADATA_CACHE_DIR)
+        self.archive = archive
+        self.redownload_if_preset_differs = False
+        self.governor = BandwidthGovernor()
+        self.hosts = HostGovernor(self.cancel_event)
+        self.hosts.log = self._log
+        self.telemetry = QueueTelemetry(hosts=self.hosts)
+        self.telemetry.stages = self.stages
+        self.work: Optional[WorkQueue] = None  # текущий прогон — сюда же встают видео из развёрнутых плейлистов
+        self.postproc: Optional[PostProcessPool] = None  # ffmpeg-этапы задач текущего прогона
+        self.postproc_workers = POSTPROC_WORKERS
+        self.disk = DiskBudget()
+        self.subscriptions: Optional[SubscriptionStore] = None
+        self._selector_ydl = None  # YoutubeDL только для компиляции селекторов — в сеть не ходит
+        self._selectors: Dict[str, Callable] = {}
+        self._selector_lock = threading.Lock()
+
+    def _log(self, msg: str):
+        self.listener.log(msg if isinstance(msg, str) else str(msg))
+
+    def new_ydl(self, opts: dict):
+        """YoutubeDL, все запросы которого идут через общий темп по хостам (self.hosts)."""
+        return self.hosts.install(_ytdlp().YoutubeDL(opts))
+
+    def _raw(self, msg: str):
+        self.listener.raw(msg if isinstance(msg, str) else str(msg))
+
+    # ------------------------ Очередь ------------------------
+
+    def run_queue(self, items: List[QueueItem], workers: int):
+        """Прогнать задачи `workers` потоками; возвращается, когда все завершены/отменены."""
+        self.telemetry.begin(items)
+        for item in items:
+            item.retries.clear()
+            item.retry_at = 0.0
+        self.start_work(workers).put(items)
+        self.finish_work()
+        for item in items:
+            if item.status.startswith(("Повтор", "Ждёт места")):  # прогон прерван, пока задача ждала повтора
+                self._item_state(item, "Ожидает")
+        self.telemetry.write()
+
+    def start_work(self, workers: int) -> "WorkQueue":
+        self.postproc = PostProcessPool(self.postproc_workers, self.cancel_event)
+        self.work = WorkQueue(self.run_item, workers, self.cancel_event)
+        return self.work
+
+    def finish_work(self):
+        """Дождаться конца прогона: загрузок (и отданной ими пост-обработки), затем пула ffmpeg."""
+        self.work.close()
+        self.work.join()
+        self.postproc.close()
+        self.postproc.join()
+
+    def stages(self) -> Dict[str, dict]:
+        """Потоки, глубина очереди и занятость каждой стадии текущего прогона."""
+        out = {}
+        if self.work:
+            out["download"] = self.work.stats()
+        if self.postproc:
+            out["postprocess"] = self.postproc.stats()
+        return out
+
+    def run_item(self, item: QueueItem) -> str:
+        """
+        Одна попытка задачи; "retry" — упала с временной ошибкой, WorkQueue поставит её в хвост;
+        "hold" — не хватает места на диске, задача тоже уходит в хвост и ждёт;
+        "deferred" — файлы скачаны, итог подведёт пул пост-обработки.
+        """
+        result = self._run_item(item)
+        if result == "deferred":
+            return result
+        return self._settle_item(item, result)
+
+    def _settle_item(self, item: QueueItem, result: str) -> str:
+        """Итог попытки: повтор или ошибка, архив, слушатель, телеметрия, подписки."""
+        self.disk.release(item.uid)
+        if result == "error":
+            result = self._queue_item_failed(item)
+        if result == "success":
+            self.archive_result(item.url, item.preset)
+        if result not in ("retry", "skip", "hold"):
+            self.listener.item_finished(item, result)
+        if result not in ("retry", "hold"):
+            self.telemetry.item_finished(item, result)
+            if (item.sub_key and self.subscriptions and item.db_id is None
+                    and result in ("error", "cancel", "skip")):
+                self.subscriptions.forget(*item.sub_key)
+        return result
+
+    def _run_item(self, item: QueueItem) -> str:
+        if self.cancel_event.is_set() or not self.listener.should_start(item):
+            return "skip"
+        if self.mark_if_archived(item):
+            self.archive.note_skipped()
+            self._item_state(item, item.status)
+            return "archived"
+        item.progress = 0.0
+        item.detail = ""
+        self._last_error = None
+        self._item_state(item, "В процессе")
+        self.listener.item_started(item)
+        try:
+            if self.is_playlist_url(item.url, item.preset):
+                result = self._expand_playlist(item)
+            else:
+                result = self.run_download(url=item.url, preset=item.preset, queue_item=item)
+        except Exception as e:
+            self._log(f"Непредвиденная ошибка задачи: {e}")
+            self._last_error = e
+            result = "error"
+        finally:
+            item.info = None  # info_dict с форматами тяжёлый — после попытки он больше не нужен
+        return result
+
+    # ------------------------ Плейлисты ------------------------
+
+    @staticmethod
+    def is_playlist_url(url: str, preset: DownloadPreset) -> bool:
+        """Включены плейлисты и ссылка не на одно видео YouTube (его ID виден прямо в ссылке)."""
+        return bool(getattr(preset, 'download_playlist', False)) and \
+            not MetadataCache.video_key(url, False).startswith("youtube:")
 
-    def _fetch_metadata_worker(self, url: str):
+    def _flat_ydl(self, cookies: Optional[str]):
         opts = {
             "quiet": True,
             "no_warnings": True,
-            "skip_download": True,
+            "extract_flat": "in_playlist",  # записи — только ссылка/ID/название, без форматов
+            "lazy_playlist": True,          # страницы запрашиваются по мере чтения записей
+            "logger": self.listener.ydl_logger(),
         }
-        if not bool(self.playlist_var.get()):
-            opts["noplaylist"] = True
-        cookies = (self.cookies_var.get() or "").strip()
         if cookies:
             opts["cookiefile"] = cookies
-        try:
-            with YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-            self.after(0, lambda info=info: self._update_languages_from_info(info))
-        except Exception as e:
-            self._append_log(f"Не удалось получить метаданные: {e}")
-            self._set_analyze_state("error", "Ошибка при анализе")
-            self.after(0, lambda: messagebox.showerror("Анализ", f"Не удалось получить метаданные: {e}"))
-        finally:
-            self.after(0, lambda: setattr(self, "_metadata_fetching", False))
-
-    # ------------------------ Помощники UI ------------------------
+        return self.new_ydl(opts)
+
+    def _flat_info(self, ydl, url: str, depth: int = 0) -> dict:
+        with self.hosts.slot(url, "meta"):
+            info = ydl.extract_info(url, download=False, process=False)
+        # редирект (короткая ссылка, канал → вкладка) без process=True не раскрывается сам
+        if info.get("_type") in ("url", "url_transparent") and info.get("url") and depth < PLAYLIST_MAX_DEPTH:
+            return self._flat_info(ydl, info["url"], depth + 1)
+        return info
+
+    def _iter_entries(self, ydl, info: dict, depth: int) -> Iterator[dict]:
+        for entry in info.get("entries") or ():
+            if self.cancel_event.is_set():
+                return
+            if not entry:
+                continue
+            url = entry.get("url") or entry.get("webpage_url")
+            nested = entry.get("_type") == "playlist" or (
+                entry.get("_type") == "url" and url
+                and any(k in (entry.get("ie_key") or "") for k in ("Tab", "Playlist", "Channel"))
+                and not MetadataCache.video_key(url, False).startswith("youtube:"))
+            if nested and depth < PLAYLIST_MAX_DEPTH:
+                sub = entry if entry.get("_type") == "playlist" else self._flat_info(ydl, url)
+                yield from self._iter_entries(ydl, sub, depth + 1)
+            elif url:
+                yield entry
+
+    def iter_playlist(self, url: str, cookies: Optional[str] = None) -> Iterator[dict]:
+        """Плоские записи плейлиста/канала по мере прихода страниц (вложенные вкладки — рекурсивно)."""
+        with self._flat_ydl(cookies) as ydl:
+            info = self._flat_info(ydl, url)
+            if info.get("_type") not in ("playlist", "multi_video") and not info.get("entries"):
+                yield info  # оказалось одно видео
+                return
+            self._current_title = info.get("title")
+            yield from self._iter_entries(ydl, info, 0)
+
+    @staticmethod
+    def entry_url(entry: dict) -> Optional[str]:
+        """Ссылка на видео из плоской записи; для YouTube — каноническая watch?v= (и для /shorts/)."""
+        if entry.get("ie_key") == "Youtube" and entry.get("id"):
+            return f"https://www.youtube.com/watch?v={entry['id']}"
+        return entry.get("url") or entry.get("webpage_url")
+
+    def probe_playlist(self, url: str, cookies: Optional[str] = None) -> dict:
+        """Название плейлиста и первая запись — без обхода всех страниц и без форматов."""
+        with self._flat_ydl(cookies) as ydl:
+            info = self._flat_info(ydl, url)
+            first = next(iter(self._iter_entries(ydl, info, 0)), None)
+        return {
+            "_type": "playlist",
+            "id": info.get("id"),
+            "title": info.get("title"),
+            "webpage_url": info.get("webpage_url") or url,
+            "entries": [first] if first else [],
+        }
 
-    def _check_ffmpeg(self):
-        if shutil.which("ffmpeg") is None:
-            self._append_log("⚠ ffmpeg не найден. Для объединения видео и аудио его необходимо установить и добавить в PATH.")
-            self._append_log("   Рекомендуем установить ffmpeg с официального сайта или через пакетный менеджер.")
+    def _expand_playlist(self, item: QueueItem) -> str:
+        """
+        Задача-плейлист → задачи по видео (пресет тот же, но без плейлиста). Порции сразу идут
+        в текущий прогон, так что загрузка первых видео начинается, пока листаются страницы.
+        """
+        entry_preset = replace(item.preset, download_playlist=False)
+        self._set_item_status(item, "Разворачиваем плейлист…")
+        self._current_title = None
+        seen = set()
+        batch: List[QueueItem] = []
+        total = 0
+        last_flush = time.time()
+
+        def flush():
+            nonlocal batch, total, last_flush
+            if batch:
+                total += len(batch)
+                self.listener.items_added(item, batch)
+                self.telemetry.add_items(batch)
+                if self.work is not None:
+                    self.work.put(batch)
+                item.detail = f"найдено видео: {total}"
+                self.listener.item_detail(item)
+                batch = []
+            last_flush = time.time()
 
-    def _paste_from_clipboard(self):
         try:
-            text = self.clipboard_get()
-            self.url_var.set(text.strip())
-        except Exception:
-            pass
-
-    def _choose_outdir(self):
-        path = filedialog.askdirectory(title="Выберите папку для сохранения", initialdir=self.outdir_var.get() or os.path.expanduser("~"))
-        if path:
-            self.outdir_var.set(path)
+            for entry in self.iter_playlist(item.url, item.preset.cookies):
+                if not item.title and self._current_title:
+                    item.title = self._current_title
+                    self.listener.item_title(item)
+                url = self.entry_url(entry)
+                if not url or url in seen:
+                    continue
+                seen.add(url)
+                batch.append(QueueItem(url=url, preset=entry_preset, title=entry.get("title")))
+                if len(batch) >= PLAYLIST_BATCH or time.time() - last_flush >= PLAYLIST_BATCH_INTERVAL:
+                    flush()
+        except Exception as e:
+            flush()
+            self._log(f"Не удалось развернуть плейлист {item.url}: {e}")
+            self._last_error = e
+            return "cancel" if self.cancel_event.is_set() else "error"
+        finally:
+            self._current_title = None
+        flush()
+        if self.cancel_event.is_set():
+            self._item_state(item, "Отменено")
+            return "cancel"
+        self._log(f"Плейлист «{ellipsize(item.title or item.url, MAX_UI_TITLE)}»: в очередь добавлено видео — {total}.")
+        item.detail = f"видео: {total}"
+        self._item_state(item, "Развёрнут")
+        return "expanded"
 
-    def _choose_cookies(self):
-        path = filedialog.askopenfilename(
-            title="Выберите cookies.txt (Netscape формат)",
-            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")],
-        )
-        if path:
-            self.cookies_var.set(path)
+    # ------------------------ Подписки ------------------------
 
-    def _append_log(self, msg: str):
-        if not isinstance(msg, str):
-            msg = str(msg)
-        timestamp = time.strftime("%H:%M:%S")
-        full = f"[{timestamp}] {msg}"
+    def sync_subscription(self, sub: Subscription) -> List[QueueItem]:
+        """
+        Новые видео подписки: записи идут от новых к старым, обход обрывается на
+        SUBSCRIPTION_KNOWN_STREAK подряд уже виденных (или более старых, чем самое свежее известное).
+        Найденное сразу помечается виденным; задачи — с пресетом подписки.
+        """
+        store = self.subscriptions
+        seen, newest = store.seen_ids(sub.id)
+        first_sync = not seen
+        entry_preset = replace(sub.preset, download_playlist=False)
+        fresh: List[QueueItem] = []
+        marks: List[Tuple[str, Optional[str]]] = []
+        streak = 0
+        for entry in self.iter_playlist(sub.url, sub.preset.cookies):
+            url = self.entry_url(entry)
+            vid = entry.get("id") or url
+            date = entry.get("upload_date")
+            if not vid:
+                continue
+            if vid in seen or (newest and date and date < newest):
+                streak += 1
+                if streak >= SUBSCRIPTION_KNOWN_STREAK:
+                    break
+                continue
+            streak = 0
+            seen.add(vid)
+            marks.append((vid, date))
+            if first_sync and not sub.backfill:
+                if len(marks) >= SUBSCRIPTION_INITIAL_MARK:
+                    break
+                continue
+            fresh.append(QueueItem(url=url, preset=entry_preset, title=entry.get("title"), sub_key=(sub.id, vid)))
+        store.mark_seen(sub.id, marks)
+        name = sub.name or sub.url
+        if first_sync and not sub.backfill:
+            self._log(f"Подписка «{name}»: первая синхронизация, запомнено видео — {len(marks)} (без загрузки).")
+        else:
+            self._log(f"Подписка «{name}»: новых видео — {len(fresh)}.")
+        return fresh
 
-        def write():
+    def sync_subscriptions(self) -> List[QueueItem]:
+        """Все подписки по очереди; ошибка одной не мешает остальным."""
+        items: List[QueueItem] = []
+        for sub in self.subscriptions.list() if self.subscriptions else []:
+            if self.cancel_event.is_set():
+                break
             try:
-                self.log_main_text.configure(state="normal")
-                self.log_main_text.insert("end", full + "\n")
-                self.log_main_text.see("end")
-                self.log_main_text.configure(state="disabled")
-            except Exception:
-                pass
+                items += self.sync_subscription(sub)
+            except Exception as e:
+                self._log(f"Подписка «{sub.name or sub.url}»: не удалось синхронизировать — {e}")
+        return items
 
-        self.log_main_text.after(0, write)
+    # ------------------------ Повторы ------------------------
 
-    def _append_raw(self, msg: str):
-        if not isinstance(msg, str):
-            msg = str(msg)
+    def _retry_decision(self, retries: Dict[str, int]) -> Tuple[str, str, Optional[float]]:
+        """
+        Разобрать ошибку последней попытки этого потока: (класс, текст, пауза перед повтором).
+        Пауза None — попытки этого класса исчерпаны (или идёт отмена), задача окончательно упала.
+        """
+        exc = self._last_error
+        self._last_error = None
+        kind = classify_download_error(exc)
+        message = ellipsize(str(exc).strip() if exc is not None else "неизвестная ошибка", 300)
+        n = retries.get(kind, 0) + 1
+        retries[kind] = n
+        if n >= RETRY_POLICIES[kind]["max_attempts"] or self.cancel_event.is_set():
+            return kind, message, None
+        return kind, message, retry_delay(kind, n)
+
+    def _queue_item_failed(self, item: QueueItem) -> str:
+        """Ошибка задачи очереди: записать попытку в историю и либо отложить в хвост ("retry"), либо "error"."""
+        kind, message, delay = self._retry_decision(item.retries)
+        policy = RETRY_POLICIES[kind]
+        entry = {"ts": round(time.time(), 1), "kind": kind, "error": message}
+        if delay is None:
+            item.history.append(entry)
+            item.detail = policy["label"]
+            self._item_state(item, "Ошибка")
+            self.listener.error(item, f"{policy['label']}: {message}")
+            return "error"
+        entry["retry_in"] = round(delay, 1)
+        item.history.append(entry)
+        item.retry_at = time.time() + delay
+        item.progress = 0.0
+        item.detail = f"{policy['label']}, повтор через {seconds_to_hms(delay)}"
+        attempt = item.retries[kind] + 1
+        self._log(f"{policy['label']}: «{ellipsize(item.title or item.url, MAX_UI_TITLE)}» — "
+                  f"попытка {attempt}/{policy['max_attempts']} через {delay:.0f} с (в конец очереди).")
+        self._item_state(item, f"Повтор ({attempt}/{policy['max_attempts']})")
+        self.listener.item_retry(item)
+        return "retry"
+
+    def download_with_retry(self, url: str, preset: DownloadPreset) -> str:
+        """Одиночная загрузка (вне очереди) с теми же правилами повторов; пауза прерывается отменой."""
+        retries: Dict[str, int] = {}
+        while True:
+            self._last_error = None
+            result = self.run_download(url, preset, None)
+            if result != "error":
+                return result
+            kind, message, delay = self._retry_decision(retries)
+            label = RETRY_POLICIES[kind]["label"]
+            if delay is None:
+                self.listener.error(None, f"{label}: {message}")
+                return "error"
+            self._log(f"{label}: повтор через {delay:.0f} с.")
+            self.listener.status(f"{label} — повтор через {delay:.0f} с…")
+            if self.cancel_event.wait(delay):
+                return "cancel"
 
-        def write():
-            try:
-                self.log_raw_text.configure(state="normal")
-                self.log_raw_text.insert("end", msg + "\n")
-                self.log_raw_text.see("end")
-                self.log_raw_text.configure(state="disabled")
-            except Exception:
-                pass
+    # ------------------------ Архив скачанного ------------------------
+
+    def mark_if_archived(self, item: QueueItem) -> bool:
+        """Уже скачано (по архиву, без сети) — статус «Уже скачано», путь и название из архива."""
+        if not self.archive:
+            return False
+        key = DownloadArchive.key_for(item.url, item.preset)
+        if key is None:
+            return False
+        hit = self.archive.lookup(key, DownloadArchive.fingerprint(item.preset), self.redownload_if_preset_differs)
+        if hit is None:
+            return False
+        path, _same = hit
+        if path:
+            item.result_path = path
+            item.title = item.title or os.path.splitext(os.path.basename(path))[0]
+        item.status = "Уже скачано"
+        return True
+
+    def archive_result(self, url: str, preset: DownloadPreset):
+        """Записать в архив итоговый файл только что завершённой загрузки (этого потока)."""
+        if not self.archive:
+            return
+        key = DownloadArchive.key_for(url, preset)
+        path = self.last_output_path
+        if key is None or not path or not os.path.isfile(path):
+            return
+        try:
+            self.archive.record(key, DownloadArchive.fingerprint(preset), path)
+        except (OSError, sqlite3.Error) as e:
+            self._log(f"Не удалось записать в архив: {e}")
+
+    @staticmethod
+    def estimate_size(info: Optional[dict]) -> Optional[int]:
+        """Объём скачивания по выбранным форматам; None — если хоть для одного размера нет."""
+        if not info or info.get("_type") in ("playlist", "multi_video") or info.get("entries"):
+            return None
+        total = 0
+        for f in info.get("requested_formats") or [info]:
+            size = f.get("filesize") or f.get("filesize_approx")
+            if not size:
+                return None
+            total += int(size)
+        return total or None
+
+    def probe_metadata(self, url: str, preset: DownloadPreset) -> Tuple[dict, bool]:
+        """
+        Метаданные для названия/анализа: из кэша или тихой экстракцией с форматом пресета.
+        Возвращает (info, cached_on_disk) — False значит, что info (плейлист) не попал в кэш.
+        """
+        if self.is_playlist_url(url, preset):
+            return self.probe_playlist(url, preset.cookies), False
+        noplaylist = not getattr(preset, 'download_playlist', False)
+        info = self.metadata_cache.get(url, preset.cookies, noplaylist)
+        if info is not None:
+            return info, True
+        opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "noplaylist": noplaylist,
+            "format": self.preset_format_selector(preset),
+        }
+        if preset.cookies:
+            opts["cookiefile"] = preset.cookies
+        with self.new_ydl(opts) as ydl, self.hosts.slot(url, "meta"):
+            info = ydl.extract_info(url, download=False)
+        return info, self.metadata_cache.put(url, preset.cookies, noplaylist, info)
 
-        self.log_raw_text.after(0, write)
+    # ------------------------ Нормализация выбора и построение фильтров ------------------------
 
-    def _append_raw_throttled(self, msg: str, percent: float):
-        """Печатаем подробные строки не чаще 2 раз/с и не чаще, чем при изменении прогресса на 0.5%."""
-        now = time.time()
-        if (now - self._last_raw_line_ts) < 0.5 and (percent - self._last_raw_percent) < 0.5:
-            return
-        self._last_raw_line_ts = now
-        self._last_raw_percent = percent
-        self._append_raw(msg)
-
-    # ---- нормализация коротких названий кодеков ----
-    def _short_vcodec(self, s: Optional[str]) -> str:
-        if not s:
-            return "?"
-        ss = s.lower()
-        if ss.startswith("av01"):
-            return "av01"
-        if ss.startswith("vp09") or ss == "vp9":
-            return "vp9"
-        if ss.startswith("avc1") or ss.startswith("h264"):
-            return "h264"
-        return s
-
-    def _short_acodec(self, s: Optional[str]) -> str:
-        if not s:
-            return "?"
-        ss = s.lower()
-        if ss.startswith("mp4a") or ss == "aac":
-            return "aac"
-        if ss.startswith("opus"):
-            return "opus"
-        if ss.startswith("vorbis") or ss == "vorbis":
-            return "vorbis"
-        return s
-
-    def _set_status(self, text: str):
-        base = text
-        if self._current_title and not base.strip().startswith("«"):
-            base = f"«{self._ellipsize(self._current_title, MAX_UI_TITLE)}» — {base}"
-        if self._extra_status_suffix:
-            self.status_var.set(f"{base}  |  {self._extra_status_suffix}")
-        else:
-            self.status_var.set(base)
-
-    # ------------------------ Пост-именной санитайзер ------------------------
-
-    def _sanitize_title(self, title: Optional[str]) -> str:
-        s = (title or "").strip()
-        for ch in '<>:"/\\|?*':
-            s = s.replace(ch, " ")
-        s = s.replace("\n", " ").replace("\r", " ")
-        s = " ".join(s.split())
-        s = s.strip(" .")
-        return s  # длину больше НЕ режем здесь; режем дальше умно
-
-    # ------------------------ Построение фильтров ------------------------
-
-    def _desired_height(self) -> int:
-        choice = self.quality_var.get()
-        mapping = {
-            "480p": 480,
-            "720p": 720,
-            "1080p": 1080,
-            "1440p (2K)": 1440,
-            "2160p (4K)": 2160,
-            "4320p (8K)": 4320
-        }
-        return mapping.get(choice, 1080)
-
-    def _norm_vcodec_choice(self, s: str) -> str:
+    def norm_vcodec_choice(self, s: str) -> str:
         if s.startswith("AV1"):
             return "av1"
         if s.startswith("VP9"):
@@ -932,7 +2832,7 @@ class DownloaderApp(tk.Tk):
             return "h264"
         return "auto"
 
-    def _norm_acodec_choice(self, s: str) -> str:
+    def norm_acodec_choice(self, s: str) -> str:
         if s.startswith("Opus"):
             return "opus"
         if s.startswith("AAC"):
@@ -941,10 +2841,10 @@ class DownloaderApp(tk.Tk):
             return "vorbis"
         return "auto"
 
-    def _norm_container_choice(self, s: str) -> str:
+    def norm_container_choice(self, s: str) -> str:
         return "auto" if s.lower().startswith("авто") else s.lower()
 
-    def _resolve_codecs_for_container(self, vcodec: str, acodec: str, container: str):
+    def resolve_codecs_for_container(self, vcodec: str, acodec: str, container: str):
         """
         Корректировка кодеков под контейнер.
         mp4: H.264 + AAC; webm: AV1/VP9 + Opus/Vorbis; mkv/auto: любые.
@@ -973,7 +2873,7 @@ class DownloaderApp(tk.Tk):
 
         return eff_v, eff_a, warn
 
-    def _format_selector(self, height: int, vcodec: str, acodec: str, alang: str) -> str:
+    def format_selector(self, height: int, vcodec: str, acodec: str, alang: str) -> str:
         vfilter = f"bestvideo[height<=?{height}]"
         if vcodec == "av1":
             vfilter += "[vcodec^=av01]"
@@ -1001,225 +2901,224 @@ class DownloaderApp(tk.Tk):
         """Без префиксов — дадим yt-dlp сохранить %(title)s.%(ext)s, а потом переименуем сами."""
         return os.path.join(outdir, user_tmpl)
 
-    # ------------------------ События кнопок ------------------------
+    def preset_format_selector(self, preset: DownloadPreset) -> str:
+        """Та же строка format, что построит _run_single_download для этого пресета."""
+        if getattr(preset, 'audio_only', False):
+            fmt_info = AUDIO_FORMAT_OPTIONS.get(preset.audio_format, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
+            return self.audio_format_selector(fmt_info, preset.audio_quality or DEFAULT_AUDIO_QUALITY,
+                                              preset.alang_choice)
+        eff_v, eff_a, _ = self.resolve_codecs_for_container(
+            self.norm_vcodec_choice(preset.vcodec_choice),
+            self.norm_acodec_choice(preset.acodec_choice),
+            self.norm_container_choice(preset.container_choice),
+        )
+        return self.format_selector(preset.height, eff_v, eff_a, preset.alang_choice)
+
+    def probe_key(self, preset: DownloadPreset) -> tuple:
+        """Опции, от которых зависит результат extract_info: info из пробы годится только при их совпадении."""
+        return (
+            self.preset_format_selector(preset),
+            preset.cookies or "",
+            bool(getattr(preset, 'download_playlist', False)),
+        )
 
-    def _url_from_clipboard_if_url(self) -> Optional[str]:
+    # ------------------------ Локальный выбор форматов ------------------------
+
+    def _compiled_selector(self, spec: str) -> Callable:
+        with self._selector_lock:
+            selector = self._selectors.get(spec)
+            if selector is None:
+                if self._selector_ydl is None:
+                    self._selector_ydl = _ytdlp().YoutubeDL({"quiet": True, "no_warnings": True})
+                selector = self._selectors[spec] = self._selector_ydl.build_format_selector(spec)
+            return selector
+
+    @staticmethod
+    def _format_size(f: dict, duration: Optional[float]) -> Tuple[Optional[int], bool]:
+        """(байты, приблизительно ли) для одного формата; без размера — по битрейту и длительности."""
+        if f.get("filesize"):
+            return int(f["filesize"]), False
+        if f.get("filesize_approx"):
+            return int(f["filesize_approx"]), True
+        tbr = f.get("tbr") or f.get("vbr") or f.get("abr")
+        if tbr and duration:
+            return int(float(tbr) * float(duration) * 125), True
+        return None, True
+
+    def plan_formats(self, info: Optional[dict], preset: DownloadPreset) -> Optional[FormatPlan]:
+        """
+        Выбор форматов пресета по списку форматов из пробы/кэша — тем же селектором, что и у загрузки,
+        но без сети: yt-dlp вычисляет его локально. None — плейлист или форматы неизвестны.
+        """
+        if not info or info.get("_type") in ("playlist", "multi_video") or info.get("entries"):
+            return None
+        formats = [f if f.get("protocol") else dict(f, protocol="https")  # облегчённые записи — без url
+                   for f in info.get("formats") or []]
+        if not formats:
+            return None
+        spec = self.preset_format_selector(preset)
         try:
-            clip = (self.clipboard_get() or "").strip()
+            chosen = next(iter(self._compiled_selector(spec)({
+                "formats": formats,
+                "has_merged_format": any("none" not in (f.get("acodec"), f.get("vcodec")) for f in formats),
+                "incomplete_formats": (all(f.get("vcodec") == "none" for f in formats)
+                                       or all(f.get("acodec") == "none" for f in formats)),
+            })), None)
         except Exception:
             return None
-        if clip.lower().startswith(("http://", "https://")):
-            return clip
-        if "youtu" in clip and (clip.startswith("www.") or clip.startswith("youtu")):
-            return "https://" + clip if not clip.startswith("http") else clip
-        return None
-
-    def _on_download_clicked(self):
-        url = (self.url_var.get() or "").strip()
-        if not url:
-            clip_url = self._url_from_clipboard_if_url()
-            if clip_url:
-                self.url_var.set(clip_url)
-                url = clip_url
-                self._append_log("Ссылка взята из буфера обмена.")
-        if not url:
-            messagebox.showwarning("Введите ссылку", "Пожалуйста, вставьте ссылку на видео YouTube.")
-            return
-
-        preset = self._collect_preset()
-        if not preset:
-            return
-
-        os.makedirs(preset.outdir, exist_ok=True)
-
-        self.cancel_event.clear()
-        self.progress["value"] = 0
-        self._set_status("Подготовка...")
-        self._append_log("Запуск загрузки (одиночная)...")
-        self._toggle_controls(downloading=True, queue_mode=False)
-
-        self.download_thread = threading.Thread(target=self._run_single_download_thread, args=(url, preset, None), daemon=True)
-        self.download_thread.start()
-
-    def _on_cancel_clicked(self):
-        if (self.download_thread and self.download_thread.is_alive()) or (self.queue_thread and self.queue_thread.is_alive()):
-            self.cancel_event.set()
-            self._append_log("Запрошена отмена. Дождитесь завершения текущей операции...")
-
-    def _on_add_to_queue(self):
-        clip_url = self._url_from_clipboard_if_url()
-        if clip_url:
-            self.url_var.set(clip_url)
-        url = (self.url_var.get() or "").strip()
-
-        if not url:
-            messagebox.showwarning("Введите ссылку", "Скопируйте ссылку в буфер обмена или вставьте её вручную.")
-            return
+        if chosen is None:
+            return None
+        parts = chosen.get("requested_formats") or [chosen]
+        duration = info.get("duration")
+        size, approx = 0, False
+        for f in parts:
+            part_size, part_approx = self._format_size(f, duration)
+            if part_size is None:
+                size = None
+                break
+            size += part_size
+            approx = approx or part_approx
+        vfmt = next((f for f in parts if f.get("vcodec") not in (None, "none")), None)
+        afmt = next((f for f in parts if f.get("acodec") not in (None, "none")), None)
+        plan = FormatPlan(
+            format_id=chosen.get("format_id") or "?",
+            height=(vfmt or {}).get("height"),
+            vcodec=self.short_vcodec(vfmt["vcodec"]) if vfmt else "",
+            acodec=self.short_acodec(afmt["acodec"]) if afmt else "",
+            abr=(afmt or {}).get("abr"),
+            size=size or None,
+            size_approx=approx,
+        )
+        if getattr(preset, 'audio_only', False):
+            fmt_info = AUDIO_FORMAT_OPTIONS.get(preset.audio_format, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
+            plan.container = fmt_info.get("extension", fmt_info["codec"])
+            src = ((afmt or chosen).get("acodec") or "").lower()
+            plan.transcode = not (fmt_info.get("source_acodec") and src.startswith(fmt_info["source_acodec"]))
+            out = plan.size
+            if plan.transcode:
+                # размер результата задаёт кодировщик, а не источник
+                bitrate = fmt_info.get("bitrate_values") and (preset.audio_quality or DEFAULT_AUDIO_QUALITY)
+                out = duration and int(float(duration) * (float(bitrate) * 125 if bitrate else 176400))  # WAV: 44.1 кГц, 16 бит, стерео
+            if plan.size and out:
+                plan.peak = plan.size + out  # исходник удаляется только после извлечения
+            return plan
+        container = self.norm_container_choice(preset.container_choice)
+        _v, _a, plan.warning = self.resolve_codecs_for_container(
+            self.norm_vcodec_choice(preset.vcodec_choice),
+            self.norm_acodec_choice(preset.acodec_choice),
+            container,
+        )
+        plan.container = container if container != "auto" else (chosen.get("ext") or "mkv")
+        plan.fallback = len(parts) == 1 and "+" in spec.split("/", 1)[0]
+        if plan.size:
+            # объединение (и remux/встраивание субтитров) пишет новый файл, пока исходные ещё лежат
+            copies = len(parts) > 1 or plan.container != chosen.get("ext") or (
+                getattr(preset, 'embed_subtitles', False) and getattr(preset, 'write_subtitles', False))
+            plan.peak = plan.size * (2 if copies else 1)
+        return plan
+
+    # ------------------------ Короткие названия кодеков и имена файлов ------------------------
+
+    def short_vcodec(self, s: Optional[str]) -> str:
+        if not s:
+            return "?"
+        ss = s.lower()
+        if ss.startswith("av01"):
+            return "av01"
+        if ss.startswith("vp09") or ss == "vp9":
+            return "vp9"
+        if ss.startswith("avc1") or ss.startswith("h264"):
+            return "h264"
+        return s
 
-        preset = self._collect_preset()
-        if not preset:
-            return
-        os.makedirs(preset.outdir, exist_ok=True)
+    def short_acodec(self, s: Optional[str]) -> str:
+        if not s:
+            return "?"
+        ss = s.lower()
+        if ss.startswith("mp4a") or ss == "aac":
+            return "aac"
+        if ss.startswith("opus"):
+            return "opus"
+        if ss.startswith("vorbis") or ss == "vorbis":
+            return "vorbis"
+        return s
 
-        item = QueueItem(url=url, preset=preset)
-        self.queue.append(item)
-        self._queue_insert_tv(item)
-        self._append_log(f"Добавлено в очередь: {url}")
-        self._save_settings_debounced()
-        self._probe_title_async(item)
+    def _sanitize_title(self, title: Optional[str]) -> str:
+        s = (title or "").strip()
+        for ch in '<>:"/\\|?*':
+            s = s.replace(ch, " ")
+        s = s.replace("\n", " ").replace("\r", " ")
+        s = " ".join(s.split())
+        s = s.strip(" .")
+        return s  # длину больше НЕ режем здесь; режем дальше умно
 
-    def _on_load_txt_to_queue(self):
-        path = filedialog.askopenfilename(
-            title="Выберите .txt со ссылками (по одной на строку)",
-            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")],
-        )
-        if not path:
-            return
-        preset = self._collect_preset()
-        if not preset:
-            return
-        count = 0
+    def auto_rename_result(
+        self,
+        path: Optional[str],
+        v_short: str,
+        a_short: str,
+        height: Optional[int],
+        ext_from_info: Optional[str],
+        title_hint: Optional[str] = None,
+        video_id_hint: Optional[str] = None,
+    ):
+        """Переименовать итоговый файл в <v>_<a>_<h>_<Title>.<ext> с защитой по длине пути."""
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
-                lines = f.readlines()
-        for line in lines:
-            url = line.strip()
-            if not url or url.startswith("#"):
-                continue
-            item = QueueItem(url=url, preset=preset)
-            self.queue.append(item)
-            self._queue_insert_tv(item)
-            self._probe_title_async(item)
-            count += 1
-        self._append_log(f"Из файла добавлено ссылок: {count}")
-        self._save_settings_debounced()
+            if not path or not os.path.isfile(path):
+                return
 
-    def _on_start_queue(self):
-        if self.queue_running:
-            messagebox.showinfo("Очередь", "Очередь уже выполняется.")
-            return
-        if not self.queue:
-            messagebox.showwarning("Очередь пуста", "Добавьте ссылки в очередь.")
-            return
+            folder = os.path.dirname(path)
+            orig_base, old_ext = os.path.splitext(os.path.basename(path))
+            ext = (ext_from_info or old_ext.lstrip(".") or "mkv").lower()
 
-        self.cancel_event.clear()
-        self.queue_running = True
-        self._set_status("Старт очереди...")
-        self._append_log("Старт очереди загрузок.")
-        self._toggle_controls(downloading=True, queue_mode=True)
+            # 1) Берём нормальное название из info_dict
+            base = self._sanitize_title(title_hint)
+            if not base:
+                base = self._sanitize_title(orig_base)
 
-        self.queue_thread = threading.Thread(target=self._run_queue, daemon=True)
-        self.queue_thread.start()
+            # 2) Убираем дублирующееся расширение внутри base (например, "...webm" в заголовке)
+            if base.lower().endswith(f".{ext}"):
+                base = base[: -(len(ext) + 1)]
 
-    def _on_clear_queue(self):
-        if self.queue_running:
-            messagebox.showwarning("Нельзя очистить", "Сначала остановите/дождитесь выполнения очереди.")
-            return
-        self.queue.clear()
-        for row in self.queue_tv.get_children():
-            self.queue_tv.delete(row)
-        self._append_log("Очередь очищена.")
+            # 3) Крайний fallback — id/время
+            if not base:
+                vid = (video_id_hint or "").strip()
+                base = f"video_{vid}" if vid else f"video_{int(time.time())}"
 
-    # -------- Обновление yt-dlp --------
+            h_part = f"{height}" if height else ""
+            # Сначала строим базу без учёта ограничения пути
+            new_base = f"{v_short}_{a_short}_{h_part}_{base}".replace("__", "_").strip("_")
+            new_name = f"{new_base}.{ext}"
+            candidate = os.path.join(folder, new_name)
 
-    def _on_update_yt_dlp(self):
-        if self.queue_running or (self.download_thread and self.download_thread.is_alive()):
-            messagebox.showinfo("Занято", "Сначала завершите текущую загрузку или очередь.")
-            return
-        if self._updating:
-            return
-        self._updating = True
-        self._append_log("Проверка и обновление yt-dlp через pip…")
-        self._set_status("Обновление yt-dlp...")
-        self._toggle_controls(downloading=True, queue_mode=False)
-        threading.Thread(target=self._update_yt_dlp_worker, daemon=True).start()
+            # 4) Если путь длинный — ужмём только Title (часть после префикса кодеков/высоты)
+            if len(candidate) > SAFE_MAX_PATH:
+                prefix = f"{v_short}_{a_short}_{h_part}_".replace("__", "_").strip("_")
+                if prefix:
+                    prefix += "_"
+                # сколько максимум можем оставить для Title
+                extra = len(candidate) - SAFE_MAX_PATH
+                # допустимая длина Title
+                allowed = max(MIN_BASE_LEN, len(base) - extra)
+                base = ellipsize(base, allowed)
+                new_base = f"{prefix}{base}".strip("_")
+                new_name = f"{new_base}.{ext}"
+                candidate = os.path.join(folder, new_name)
 
-    def _run_pip_and_stream(self, cmd: list) -> int:
-        self._append_log(f"→ Запуск: {' '.join(cmd)}")
-        try:
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            # 5) Защита от коллизий имён
+            if os.path.abspath(candidate) != os.path.abspath(path):
+                cnt = 1
+                unique_candidate = candidate
+                while os.path.exists(unique_candidate):
+                    unique_candidate = os.path.join(folder, f"{os.path.splitext(new_name)[0]}({cnt}).{ext}")
+                    cnt += 1
+                os.replace(path, unique_candidate)
+                self._log(f"Переименовано: {os.path.basename(path)} → {os.path.basename(unique_candidate)}")
+                self.last_output_path = unique_candidate
         except Exception as e:
-            self._append_log(f"[pip] не удалось запустить: {e}")
-            return -1
-        try:
-            assert proc.stdout is not None
-            for line in proc.stdout:
-                self._append_log(f"[pip] {line.rstrip()}")
-        except Exception:
-            pass
-        return proc.wait()
+            self._log(f"Не удалось переименовать файл: {e}")
 
-    def _update_yt_dlp_worker(self):
-        try:
-            cmd1 = [sys.executable, "-m", "pip", "install", "-U", "yt-dlp"]
-            rc = self._run_pip_and_stream(cmd1)
-
-            if rc != 0:
-                self._append_log("Обычное обновление не удалось. Пробуем с флагом --user…")
-                cmd2 = [sys.executable, "-m", "pip", "install", "-U", "--user", "yt-dlp"]
-                rc = self._run_pip_and_stream(cmd2)
-
-            if rc == 0:
-                try:
-                    import yt_dlp as _ydl_mod
-                    importlib.reload(_ydl_mod)
-                    global YoutubeDL, yt_dlp
-                    yt_dlp = _ydl_mod
-                    YoutubeDL = yt_dlp.YoutubeDL
-                    new_ver = getattr(yt_dlp, "__version__", "?")
-                    self._append_log(f"✅ yt-dlp успешно обновлён до версии {new_ver}.")
-                    self.after(0, lambda: self.ydl_version_var.set(f"yt-dlp {new_ver}"))
-                except Exception as e:
-                    self._append_log(f"yt-dlp обновлён, но не удалось перезагрузить модуль в памяти: {e}")
-                    self._append_log("Совет: перезапустите приложение, чтобы использовать новую версию.")
-                finally:
-                    self._set_status("Обновление завершено ✅")
-            else:
-                self._append_log("❌ Не удалось обновить yt-dlp. Проверьте соединение и права.")
-                self._set_status("Ошибка обновления yt-dlp.")
-                self.after(0, lambda: messagebox.showerror("Обновление yt-dlp", "Не удалось обновить yt-dlp. Попробуйте вручную в терминале:\n\npip install -U yt-dlp\n\nили\n\npip install -U --user yt-dlp"))
-        finally:
-            self._updating = False
-            self._toggle_controls(downloading=False, queue_mode=False)
-
-    # ------------------------ Очередь ------------------------
-
-    def _run_queue(self):
-        try:
-            for item in list(self.queue):
-                if self.cancel_event.is_set():
-                    self._append_log("Очередь прервана пользователем.")
-                    break
-                self._queue_update_status(item, "В процессе")
-                try:
-                    idx = self.queue.index(item) + 1
-                except ValueError:
-                    idx = 1
-                self._set_status(f"Очередь: элемент {idx}/{len(self.queue)} — подготовка...")
-                self.progress["value"] = 0
-                result = self._run_single_download(url=item.url, preset=item.preset, queue_item=item)
-                if result == "success":
-                    self._queue_remove_item(item)
-                    self._append_log("Задача выполнена и удалена из очереди.")
-                else:
-                    self._append_log(f"Задача завершилась со статусом: {item.status}")
-                if self.cancel_event.is_set():
-                    break
-            else:
-                self._append_log("Очередь завершена.")
-                self._set_status("Очередь завершена ✅")
-        finally:
-            self.queue_running = False
-            self._toggle_controls(downloading=False, queue_mode=True)
-
-    # ------------------------ Загрузка ------------------------
-
-    def _run_single_download_thread(self, url: str, preset: DownloadPreset, queue_item: Optional[QueueItem]):
-        self._run_single_download(url, preset, queue_item)
-        self._toggle_controls(downloading=False, queue_mode=False)
+    # ------------------------ Разбор info_dict ------------------------
 
     def _extract_selected_formats(self, info: dict) -> Tuple[Optional[dict], Optional[dict]]:
         vfmt, afmt = None, None
@@ -1294,6 +3193,59 @@ class DownloaderApp(tk.Tk):
             pass
         return "mkv"
 
+    @staticmethod
+    def audio_format_selector(fmt_info: dict, quality: str, alang_choice: Optional[str]) -> str:
+        """
+        Селектор для режима «только аудио»: сначала поток того же кодека, что и выбранный формат
+        (его можно скопировать без перекодирования), если битрейт достаточен, иначе лучший любой.
+        Язык важнее кодека: нужный язык в другом кодеке лучше, чем совпавший кодек не на том языке.
+        """
+        same = ""
+        if fmt_info.get("source_acodec"):
+            same = f"[acodec^={fmt_info['source_acodec']}]"
+            if fmt_info.get("bitrate_values"):
+                try:
+                    same += f"[abr>=?{int(float(quality) * AUDIO_COPY_MIN_RATIO)}]"
+                except (TypeError, ValueError):
+                    pass
+        lang = (alang_choice or "").lower()
+        langs = [f"[language^={lang}]"] if lang and lang != "orig" else []
+        candidates = []
+        for lang_filter in langs + [""]:
+            if same:
+                candidates.append(f"bestaudio{same}{lang_filter}")
+            candidates.append(f"bestaudio{lang_filter}")
+        return "/".join(candidates)
+
+    @staticmethod
+    def _audio_path_note(info: dict, fmt_info: dict, quality: str) -> Optional[str]:
+        """Что будет с выбранным аудиопотоком: копирование как есть или перекодирование."""
+        src = (info.get("requested_downloads") or [info])[0]
+        acodec = (src.get("acodec") or "").lower()
+        if not acodec or acodec == "none":
+            return None
+        abr = src.get("abr") or src.get("tbr")
+        src_txt = f"{acodec}" + (f" {int(abr)} kbps" if abr else "")
+        if fmt_info.get("source_acodec") and acodec.startswith(fmt_info["source_acodec"]):
+            return f"Аудио: исходный поток {src_txt} — копирование в {fmt_info['label']} без перекодирования."
+        target = fmt_info["label"] + (f" {quality} kbps" if fmt_info.get("bitrate_values") else "")
+        return f"Аудио: исходный поток {src_txt} — перекодирование в {target}."
+
+    @staticmethod
+    def _needs_remux(info: Optional[dict], container_choice: str) -> bool:
+        """
+        Нужен ли проход FFmpegVideoRemuxer после загрузки. Несколько потоков yt-dlp сразу
+        объединяет в merge_output_format, то есть уже в нужный контейнер; одному файлу remux
+        нужен, только если его расширение другое. Выбор неизвестен (плейлист, проба не удалась) — нужен.
+        """
+        if not info or info.get("_type") in ("playlist", "multi_video"):
+            return True
+        requested = info.get("requested_formats") or []
+        if len(requested) > 1:
+            return False
+        ext = ((requested[0] if requested else info).get("ext") or "").lower()
+        return ext != container_choice
+
     def _format_summary_line(self, f: dict, kind: str) -> str:
         try:
             fmt_id = f.get("format_id", "?")
@@ -1317,485 +3269,2551 @@ class DownloaderApp(tk.Tk):
         except Exception:
             return f"{kind.capitalize()}: ?"
 
-    def _postprocessor_hook(self, d: dict):
+    # ------------------------ Статус, прогресс, хуки ------------------------
+
+    def _set_item_status(self, queue_item: Optional[QueueItem], text: str):
+        """Статус конкретной задачи: для очереди — в строку задачи, для одиночной загрузки — в общий статус."""
+        if queue_item is None:
+            base = text
+            if self._current_title and not base.strip().startswith("«"):
+                base = f"«{ellipsize(self._current_title, MAX_UI_TITLE)}» — {base}"
+            if self._extra_status_suffix:
+                base = f"{base}  |  {self._extra_status_suffix}"
+            self.listener.status(base)
+            return
+        queue_item.detail = text
+        self.listener.item_detail(queue_item)
+
+    def _set_item_progress(self, queue_item: Optional[QueueItem], percent: float):
+        if queue_item is None:
+            self.listener.progress(percent)
+            return
+        queue_item.progress = percent
+
+    def _item_state(self, queue_item: QueueItem, status: str):
+        queue_item.status = status
+        self.listener.item_state(queue_item, status)
+
+    def _append_raw_throttled(self, msg: str, percent: float):
+        """Печатаем подробные строки не чаще 2 раз/с и не чаще, чем при изменении прогресса на 0.5%."""
+        now = time.time()
+        if (now - self._last_raw_line_ts) < 0.5 and (percent - self._last_raw_percent) < 0.5:
+            return
+        self._last_raw_line_ts = now
+        self._last_raw_percent = percent
+        self._raw(msg)
+
+    def _progress_hook_factory(self, queue_item: Optional[QueueItem] = None):
+        seen_bytes: Dict[str, int] = {}  # файл → сколько байт уже «оплачено» в BandwidthGovernor
+        bucket = self.governor.new_bucket()  # лимит на эту загрузку (если задан)
+
+        def hook(d):
+            if self.cancel_event.is_set():
+                raise KeyboardInterrupt("Загрузка отменена пользователем")
+            status = d.get("status")
+            if status == "downloading":
+                total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
+                downloaded = d.get("downloaded_bytes") or 0
+                fname = d.get("tmpfilename") or d.get("filename") or ""
+                if fname not in seen_bytes:
+                    # первый отчёт по файлу: при докачке .part (continuedl) в downloaded уже всё,
+                    # что лежит на диске с прошлой попытки, — это не трафик, его не «оплачиваем»
+                    seen_bytes[fname] = downloaded
+                    self.telemetry.add_resumed(queue_item, downloaded)
+                    delta = 0
+                else:
+                    delta = downloaded - seen_bytes[fname]
+                    seen_bytes[fname] = downloaded
+                self.governor.consume(delta, self.cancel_event, bucket)
+                self.telemetry.add_bytes(queue_item, delta)
+                percent = 0.0
+                if total:
+                    percent = downloaded / total * 100.0
+                speed = d.get("speed")
+                eta = d.get("eta")
+                self._set_item_progress(queue_item, percent)
+                speed_txt = human_readable_size(speed) + "/s" if speed else "Unknown B/s"
+                eta_txt = seconds_to_hms(int(eta)) if eta is not None else "Unknown"
+                size_txt = f"{human_readable_size(downloaded)} of {human_readable_size(total)}" if total else f"{human_readable_size(downloaded)} of Unknown"
+                if queue_item:
+                    prefix = self.listener.item_position(queue_item)
+                    self._set_item_status(queue_item, f"{prefix}{percent:.1f}% · {speed_txt} · {eta_txt}")
+                else:
+                    self._set_item_status(None, f"Скачивание: {percent:.1f}%  |  {size_txt}  |  Скорость: {speed_txt}  |  Осталось: {eta_txt}")
+
+                raw_line = f"[download] {percent:5.1f}% of {size_txt} at {speed_txt} ETA {eta_txt}"
+                self._append_raw_throttled(raw_line, percent)
+
+            elif status == "finished":
+                self._set_item_progress(queue_item, 100)
+                self._set_item_status(queue_item, "Пост-обработка…" if queue_item else "Файл загружен, идет пост-обработка (объединение/конвертация)...")
+                self._raw("[download] 100.0% — файл загружен, пост-обработка…")
+            elif status == "error":
+                self._set_item_status(queue_item, "Ошибка загрузки.")
+                self._raw("[download] ERROR")
+        return hook
+
+    def _postprocessor_hook(self, d: dict):
+        try:
+            status = d.get("status")
+            pp = d.get("postprocessor") or d.get("postprocessor_name") or "postprocessor"
+            if status == "started":
+                self._log(f"Пост-обработка: {pp} — старт.")
+                self._stage_end("загрузка")
+                self._stage_start(pp)
+            elif status == "finished":
+                self._stage_end(pp)
+                info_dict = d.get("info_dict") or {}
+                final_name = info_dict.get("__final_filename") or info_dict.get("filepath")
+                ext = info_dict.get("ext")
+                if final_name:
+                    self._log(f"Пост-обработка завершена. Итоговый файл: {os.path.basename(final_name)}")
+                if ext:
+                    self._log(f"Итоговый контейнер: {str(ext).upper()}")
+            elif status == "error":
+                self._log(f"[ОШИБКА пост-обработки] {pp}")
+        except Exception:
+            pass
+
+    # ---- время по этапам (загрузка, ожидание ffmpeg, каждый постпроцессор) ----
+
+    def _stage_start(self, name: str):
+        if self._stage_started is not None:
+            self._stage_started[name] = time.time()
+
+    def _stage_end(self, name: str):
+        started = self._stage_started
+        if started is None or name not in started:  # yt-dlp шлёт хукам постпроцессора события дважды
+            return
+        self._stage_times[name] = self._stage_times.get(name, 0.0) + time.time() - started.pop(name)
+
+    def _log_stage_times(self):
+        if self._stage_times:
+            self._log("Этапы: " + " · ".join(f"{name} {sec:.1f} с" for name, sec in self._stage_times.items()))
+
+    # ------------------------ Повторное использование info из пробы ------------------------
+
+    def _cached_probe_info(self, preset: DownloadPreset, queue_item: Optional[QueueItem]) -> Optional[dict]:
+        if not queue_item or queue_item.info is None:
+            return None
+        if queue_item.info_key != self.probe_key(preset):
+            return None
+        if time.time() - queue_item.info_ts > PROBE_INFO_MAX_AGE:
+            return None
+        return queue_item.info
+
+    def _disk_cached_info(self, url: str, preset: DownloadPreset) -> Optional[dict]:
+        """Свежий (с живыми ссылками) info из дискового кэша — годится для загрузки."""
+        noplaylist = not getattr(preset, 'download_playlist', False)
+        return self.metadata_cache.get(url, preset.cookies, noplaylist, need_streams=True)
+
+    def _probe_info(self, ydl, url: str, preset: DownloadPreset, queue_item: Optional[QueueItem]) -> dict:
+        """
+        info для загрузки: из пробы очереди или дискового кэша, если они свежие,
+        иначе — одна экстракция без скачивания (результат уходит в кэш).
+        """
+        cached = self._cached_probe_info(preset, queue_item)
+        if cached is not None:
+            self._log("Используем метаданные из пробы — без повторного извлечения.")
+            return cached
+        cached = self._disk_cached_info(url, preset)
+        if cached is not None:
+            self._log("Метаданные взяты из кэша — без повторного извлечения.")
+            # в кэше лежит info без выбранных форматов — выбор делаем локально, без сети
+            return ydl.process_ie_result(cached, download=False)
+        t0 = time.time()
+        with self.hosts.slot(url, "meta"):
+            info = ydl.extract_info(url, download=False)
+        self._log(f"Метаданные получены за {time.time() - t0:.1f} с")
+        self.metadata_cache.put(url, preset.cookies, not getattr(preset, 'download_playlist', False), info)
+        return info
+
+    def _download_from_info(self, ydl, info: dict) -> dict:
+        """
+        Скачать по уже извлечённому info_dict, не вызывая extract_info повторно
+        (так же, как yt-dlp поступает с --load-info-json).
+        """
+        if info.get("_type") in ("playlist", "multi_video") and info.get("entries") is not None:
+            for entry in info.get("entries") or []:
+                if isinstance(entry, dict):
+                    ydl.process_ie_result(ydl.sanitize_info(dict(entry), remove_private_keys=True), download=True)
+            return info
+        return ydl.process_ie_result(ydl.sanitize_info(dict(info), remove_private_keys=True), download=True)
+
+    # ------------------------ Локальная пересборка в MKV ------------------------
+
+    def _local_parts_tracker(self, parts: List[dict]):
+        """
+        Хук для progress_hooks и postprocessor_hooks: запоминает скачанные потоки (.fNNN.*)
+        и результат объединения, чтобы резерв MKV мог обойтись без повторной загрузки.
+        """
+        def hook(d):
+            if d.get("status") != "finished":
+                return
+            info = d.get("info_dict") or {}
+            if "postprocessor" in d:
+                if d.get("postprocessor") != "Merger":
+                    return
+                path, kind = info.get("filepath"), "merged"
+            else:
+                path, kind = d.get("filename") or info.get("filepath"), "part"
+            if not path:
+                return
+            parts.append({
+                "kind": kind,
+                "path": path,
+                "vcodec": info.get("vcodec"),
+                "acodec": info.get("acodec"),
+                "height": info.get("height"),
+                "expected": d.get("total_bytes") if kind == "part" else None,
+            })
+        return hook
+
+    def _local_part_ok(self, part: dict) -> bool:
+        path = part.get("path")
+        try:
+            size = os.path.getsize(path)
+        except (OSError, TypeError):
+            return False
+        expected = part.get("expected")
+        return size > 0 and (not expected or size == int(expected))
+
+    def _remux_local_parts_to_mkv(self, parts: List[dict]) -> Optional[Tuple[str, Optional[str], Optional[str], Optional[int]]]:
+        """
+        Собрать MKV из того, что уже лежит на диске: сначала объединённый файл, иначе пара
+        видео+аудио потоков. Возвращает (путь, vcodec, acodec, height) или None, если локальных
+        частей нет/они битые — тогда нужна повторная загрузка.
+        """
+        ffmpeg = shutil.which("ffmpeg")
+        if not ffmpeg or not parts:
+            return None
+
+        merged = [p for p in parts if p["kind"] == "merged" and self._local_part_ok(p)]
+        video = next((p for p in reversed(parts) if p["kind"] == "part" and (p.get("vcodec") or "none") != "none"), None)
+        audio = next((p for p in reversed(parts) if p["kind"] == "part" and (p.get("acodec") or "none") != "none"
+                      and p is not video), None)
+
+        if merged:
+            src = merged[-1]
+            inputs = [src["path"]]
+            maps = ["-map", "0"]
+            vinfo = ainfo = src
+            if video:
+                vinfo = video
+            if audio:
+                ainfo = audio
+        elif video and audio and self._local_part_ok(video) and self._local_part_ok(audio):
+            inputs = [video["path"], audio["path"]]
+            maps = ["-map", "0:v:0", "-map", "1:a:0"]
+            vinfo, ainfo = video, audio
+        elif video and self._local_part_ok(video) and (video.get("acodec") or "none") != "none":
+            # progressive-формат: один файл с видео и аудио
+            inputs = [video["path"]]
+            maps = ["-map", "0"]
+            vinfo = ainfo = video
+        else:
+            self._log("Локальных частей для сборки MKV нет или они повреждены — потребуется повторная загрузка.")
+            return None
+
+        root = os.path.splitext(inputs[0])[0]
+        root = re.sub(r"\.f[0-9A-Za-z_-]+$", "", root)
+        out_path = root + ".mkv"
+        cnt = 1
+        while os.path.exists(out_path) and out_path not in inputs:
+            out_path = f"{root}({cnt}).mkv"
+            cnt += 1
+        tmp_path = out_path + ".tmp.mkv"
+
+        cmd = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y"]
+        for path in inputs:
+            cmd += ["-i", path]
+        cmd += maps + ["-c", "copy", tmp_path]
+        self._log(f"Собираем MKV локально из {len(inputs)} файл(ов), без повторной загрузки…")
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        except Exception as e:
+            self._log(f"Не удалось запустить ffmpeg: {e}")
+            return None
+        if proc.returncode != 0 or not os.path.isfile(tmp_path) or os.path.getsize(tmp_path) == 0:
+            for line in (proc.stdout or "").splitlines()[-5:]:
+                self._raw(f"[ffmpeg] {line}")
+            self._log("Локальная сборка MKV не удалась — потребуется повторная загрузка.")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+
+        os.replace(tmp_path, out_path)
+        for path in inputs:
+            if path != out_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        height = vinfo.get("height")
+        return out_path, vinfo.get("vcodec"), ainfo.get("acodec"), int(height) if height else None
+
+    # ------------------------ Завершение загрузки ------------------------
+
+    def _finish_audio(self, info: dict, codec: str, extension: str, queue_item: Optional[QueueItem]) -> str:
+        """Аудио готово (извлечение завершено): путь, переименование, «Готово»."""
+        try:
+            if 'requested_downloads' in info and info['requested_downloads']:
+                self.last_output_path = info['requested_downloads'][0].get('filepath')
+        except Exception:
+            pass
+        title_final = info.get('title') or self._current_title
+        video_id = info.get('id')
+        a_short = codec
+        v_short = 'audio'
+        final_ext = extension
+        self._extra_status_suffix = f"A:{a_short.upper()} → {final_ext.upper()}"
+        is_playlist = info.get('_type') in ('playlist', 'multi_video') or bool(info.get('entries'))
+        if not is_playlist:
+            self.auto_rename_result(self.last_output_path, v_short, a_short, None, final_ext,
+                                     title_hint=title_final, video_id_hint=video_id)
+        else:
+            self._log("Плейлист: используется шаблон имён yt-dlp для каждого трека.")
+        if queue_item:
+            queue_item.result_path = self.last_output_path  # уже после переименования
+        self._log_stage_times()
+        self._set_item_progress(queue_item, 100)
+        self._set_item_status(queue_item, 'Готово ✅')
+        self._log('Загрузка аудио завершена.')
+        if queue_item:
+            self._item_state(queue_item, 'Готово')
+        return 'success'
+
+    def _finish_video(self, info: dict, run_opts: dict, queue_item: Optional[QueueItem]) -> str:
+        """Видео готово (объединение/remux завершены): путь, кодеки, переименование, «Готово»."""
+        try:
+            if "requested_downloads" in info and info["requested_downloads"]:
+                self.last_output_path = info["requested_downloads"][0].get("filepath")
+        except Exception:
+            pass
+
+        vcodec_final, acodec_final = self._extract_final_codecs(info)
+        v_short = self.short_vcodec(vcodec_final)
+        a_short = self.short_acodec(acodec_final)
+        height_final = self._extract_final_height(info)
+
+        if run_opts.get("merge_output_format"):
+            final_ext = run_opts["merge_output_format"]
+        else:
+            final_ext = (info.get("ext") or "").lower() or "mkv"
+
+        self._extra_status_suffix = f"V:{v_short} A:{a_short} → {str(final_ext).upper()}"
+
+        title_final = info.get("title") or self._current_title
+        video_id = info.get("id")
+        is_playlist = info.get('_type') in ('playlist', 'multi_video') or bool(info.get('entries'))
+        if not is_playlist:
+            self.auto_rename_result(
+                self.last_output_path,
+                v_short,
+                a_short,
+                height_final,
+                final_ext,
+                title_hint=title_final,
+                video_id_hint=video_id,
+            )
+        else:
+            self._log("Плейлист: автоматическое переименование отключено, используется шаблон yt-dlp.")
+        if queue_item:
+            queue_item.result_path = self.last_output_path  # уже после переименования
+
+        self._log_stage_times()
+        self._set_item_progress(queue_item, 100)
+        self._set_item_status(queue_item, "Готово ✅")
+        self._log("Загрузка завершена.")
+        if queue_item:
+            self._item_state(queue_item, "Готово")
+        return "success"
+
+    def _finish_local_mkv(self, local_parts: List[dict], info_probe: Optional[dict],
+                          queue_item: Optional[QueueItem]) -> Optional[str]:
+        """MKV из уже скачанных частей; None — частей нет или они битые, нужна повторная загрузка."""
+        is_playlist_probe = bool(info_probe) and (
+            info_probe.get('_type') in ('playlist', 'multi_video') or bool(info_probe.get('entries'))
+        )
+        if is_playlist_probe:
+            return None
+        local = self._remux_local_parts_to_mkv(local_parts)
+        if not local:
+            return None
+        out_path, v_codec_local, a_codec_local, height_local = local
+        self.last_output_path = out_path
+        v_short = self.short_vcodec(v_codec_local)
+        a_short = self.short_acodec(a_codec_local)
+        self._extra_status_suffix = f"V:{v_short} A:{a_short} → MKV"
+        self.auto_rename_result(
+            out_path,
+            v_short,
+            a_short,
+            height_local,
+            "mkv",
+            title_hint=(info_probe or {}).get("title") or self._current_title,
+            video_id_hint=(info_probe or {}).get("id"),
+        )
+        if queue_item:
+            queue_item.result_path = self.last_output_path
+        self._set_item_progress(queue_item, 100)
+        self._set_item_status(queue_item, "Готово ✅ (MKV)")
+        self._log("Загрузка завершена (mkv, собрано локально без повторного скачивания).")
+        if queue_item:
+            self._item_state(queue_item, "Готово (mkv)")
+        self._current_title = None
+        return "success"
+
+    # ------------------------ Пост-обработка в отдельном пуле ------------------------
+
+    def _can_defer(self, queue_item: Optional[QueueItem]) -> bool:
+        """ffmpeg-этапы задачи очереди можно отдать пулу (одиночная загрузка делает всё сама)."""
+        return queue_item is not None and self.work is not None and self.postproc is not None \
+            and not self.postproc.closed
+
+    @staticmethod
+    def _defer_post_process(ydl, on_record: Optional[Callable[[tuple], None]] = None) -> list:
+        """
+        Подменить ydl.post_process: объединение/remux/извлечение аудио/fixup не выполняются
+        в потоке загрузки, а запоминаются (оригинал, файл, копия info, что переносить, живой info).
+        on_record(запись) — сразу отдать запись дальше (пул пост-обработки плейлиста).
+        """
+        pending = []
+        original = ydl.post_process
+
+        def post_process(filename, info, files_to_move=None):
+            info["filepath"] = filename
+            # копия: после возврата yt-dlp вычищает из info поля, совпадающие с info всего видео
+            record = (original, filename, dict(info), files_to_move, info)
+            pending.append(record)
+            if on_record:
+                on_record(record)
+            return info
+        ydl.post_process = post_process
+        return pending
+
+    def _post_process_in_pool(self, ydl) -> Tuple[PostProcessPool, list]:
+        """
+        Одиночная загрузка плейлиста: каждая запись уходит в пул пост-обработки, как только
+        скачана, а yt-dlp тем временем качает следующую. Результаты (живой info, итог или
+        исключение) применяет _join_pool_post_process — уже после загрузки, в этом потоке.
+        """
+        pool = PostProcessPool(self.postproc_workers, self.cancel_event)
+        done = []
+
+        def run(original, filename, info, files_to_move, live):
+            if self.cancel_event.is_set():
+                return
+            try:
+                done.append((live, original(filename, info, files_to_move)))
+            except Exception as e:
+                self._log(f"Ошибка пост-обработки {os.path.basename(filename)}: {e}")
+                done.append((live, e))
+
+        self._defer_post_process(ydl, on_record=lambda record: pool.submit(lambda: run(*record)))
+        return pool, done
+
+    def _join_pool_post_process(self, pool: PostProcessPool, done: list):
+        pool.close()
+        pool.join()
+        errors = []
+        for live, result in done:
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                live.update(result)
+        if errors:
+            self._log(f"Пост-обработка: ошибок {len(errors)} из {len(done)}.")
+            raise errors[0]
+
+    def ffmpeg_thread_args(self) -> dict:
+        """
+        postprocessor_args для перекодирования аудио в пуле: ядра делятся между параллельными
+        ffmpeg (-threads на декодер и кодер) — машина загружена, но без переподписки.
+        """
+        threads = ["-threads", str(max(1, (os.cpu_count() or 1) // max(1, self.postproc_workers)))]
+        return {"extractaudio+ffmpeg_i": threads, "extractaudio+ffmpeg_o": list(threads)}
+
+    def _post_process_later(self, item: QueueItem, pending: list, finish: Callable[[], str],
+                            fallback: Optional[Callable[[], Optional[str]]] = None) -> str:
+        """
+        Отдать отложенные ffmpeg-этапы пулу; поток загрузки свободен для следующей задачи.
+        В потоке пула: этапы → finish() (переименование, «Готово»); если этапы упали —
+        fallback() (локальный MKV), затем итог задачи и WorkQueue.complete().
+        """
+        work = self.work
+        title, suffix = self._current_title, self._extra_status_suffix
+        stage_times, stage_started = self._stage_times, self._stage_started
+        self._stage_end("загрузка")
+        self._stage_start("ожидание ffmpeg")
+        self._set_item_status(item, "Ждёт ffmpeg…")
+
+        def job():
+            self._current_title, self._extra_status_suffix = title, suffix
+            self._stage_times, self._stage_started = stage_times, stage_started
+            self._stage_end("ожидание ffmpeg")
+            self._last_error = None
+            if self.cancel_event.is_set():
+                self._set_item_status(item, "Загрузка отменена.")
+                self._item_state(item, "Отменено")
+                result = "cancel"
+            else:
+                try:
+                    result = self._run_deferred(item, pending, finish, fallback)
+                except Exception as e:
+                    self._log(f"Непредвиденная ошибка пост-обработки: {e}")
+                    self._last_error = e
+                    result = "error"
+            self._current_title = None
+            work.complete(item, self._settle_item(item, result))
+
+        self.postproc.submit(job)
+        return "deferred"
+
+    def _run_deferred(self, item: QueueItem, pending: list, finish: Callable[[], str],
+                      fallback: Optional[Callable[[], Optional[str]]]) -> str:
+        self._set_item_status(item, "Пост-обработка…")
+        t0 = time.time()
+        try:
+            for original, filename, info, files_to_move, live in pending:
+                live.update(original(filename, info, files_to_move))
+        except Exception as e:
+            self._log(f"Ошибка пост-обработки: {e}")
+            if fallback and classify_download_error(e) not in RETRY_NO_MKV_FALLBACK:
+                result = fallback()
+                if result:
+                    return result
+            self._set_item_status(item, "Ошибка.")
+            self._last_error = e
+            return "error"
+        self._log(f"Пост-обработка: {time.time() - t0:.1f} с")
+        return finish()
+
+    # ------------------------ Загрузка ------------------------
+
+    def run_download(self, url: str, preset: DownloadPreset, queue_item: Optional[QueueItem]) -> str:
+        with self.hosts.slot(url, "media"):
+            self.governor.begin()
+            try:
+                return self._run_download(url, preset, queue_item)
+            finally:
+                self.governor.end()
+                if queue_item is None:  # резерв задачи очереди снимает _settle_item (после пост-обработки)
+                    self.disk.release(self._disk_key(None))
+
+    @staticmethod
+    def _disk_key(queue_item: Optional[QueueItem]):
+        return queue_item.uid if queue_item else ("single", threading.get_ident())
+
+    def _reserve_disk(self, queue_item: Optional[QueueItem], preset: DownloadPreset,
+                      plan: Optional[FormatPlan]) -> Optional[str]:
+        """
+        Зарезервировать место под пик задачи в папке назначения. None — можно качать;
+        "hold" — задача очереди подождёт в хвосте, пока место освободят другие загрузки;
+        "error" — места нет и ждать нечего (ничего больше не качается). Одиночная загрузка ждёт на месте.
+        """
+        need = (plan.peak if plan else None) or 0  # без оценки — проверяем только запас
+        while True:
+            state, available = self.disk.reserve(self._disk_key(queue_item), preset.outdir, need)
+            if state == "ok":
+                if need:
+                    self._log(f"Место на диске: под задачу зарезервировано ≈{human_readable_size(need)}, "
+                              f"доступно {human_readable_size(available)}.")
+                return None
+            msg = (f"Мало места в «{preset.outdir}»: нужно ≈{human_readable_size(need)}, "
+                   f"доступно {human_readable_size(max(0, available))} "
+                   f"(без резерва идущих загрузок и запаса {human_readable_size(self.disk.margin)})")
+            if state == "full":
+                self._log(msg + ".")
+                self._set_item_status(queue_item, "Нет места на диске.")
+                self._last_error = OSError(errno.ENOSPC, msg)
+                return "error"
+            if self.cancel_event.is_set():
+                self._set_item_status(queue_item, "Загрузка отменена.")
+                if queue_item:
+                    self._item_state(queue_item, "Отменено")
+                return "cancel"
+            if queue_item is None:
+                self._set_item_status(None, f"{msg} — ждём, пока закончатся другие загрузки…")
+                if self.cancel_event.wait(DISK_HOLD_RECHECK):
+                    self._set_item_status(None, "Загрузка отменена.")
+                    return "cancel"
+                continue
+            self._log(f"{msg} — «{ellipsize(queue_item.title or queue_item.url, MAX_UI_TITLE)}» "
+                      f"ждёт, пока закончатся другие загрузки.")
+            queue_item.retry_at = time.time() + DISK_HOLD_RECHECK
+            queue_item.detail = f"нужно ≈{human_readable_size(need)}"
+            self._item_state(queue_item, "Ждёт места")
+            self.listener.item_retry(queue_item)
+            return "hold"
+
+    def _run_download(self, url: str, preset: DownloadPreset, queue_item: Optional[QueueItem]) -> str:
+        self._current_title = None
+        self._last_raw_line_ts = 0.0
+        self._last_raw_percent = -1.0
+
+        height = preset.height
+        vch_gui = preset.vcodec_choice
+        ach_gui = preset.acodec_choice
+        c_gui = preset.container_choice
+
+        vch = self.norm_vcodec_choice(vch_gui)
+        ach = self.norm_acodec_choice(ach_gui)
+        container_choice = self.norm_container_choice(c_gui)
+        # --- Режим: только аудио ---
+        if getattr(preset, 'audio_only', False):
+            fmt_info = AUDIO_FORMAT_OPTIONS.get(preset.audio_format, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
+            codec = fmt_info['codec']
+            extension = fmt_info.get('extension', codec)
+            bitrate_values = fmt_info.get('bitrate_values') or []
+            quality = preset.audio_quality or DEFAULT_AUDIO_QUALITY
+            quality_txt = f"{quality} kbps" if bitrate_values else "без сжатия"
+            fmt = self.audio_format_selector(fmt_info, quality, preset.alang_choice)
+
+            self._log(
+                f"Режим: только аудио {fmt_info['label']} | Язык аудио: {preset.alang_choice} | "
+                f"Качество: {quality_txt}"
+            )
+
+            outtmpl = self._build_outtmpl_simple(preset.outtmpl_user, preset.outdir)
+            logger = self.listener.ydl_logger()
+            postprocessors = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': codec,
+            }]
+            if bitrate_values:
+                postprocessors[0]['preferredquality'] = str(quality)
+
+            run_opts = {
+                'format': fmt,
+                'noplaylist': not getattr(preset, 'download_playlist', False),
+                'outtmpl': outtmpl,
+                'logger': logger,
+                'concurrent_fragment_downloads': self.governor.fragment_concurrency(),
+                'lazy_playlist': True,
+                'progress_hooks': [self._progress_hook_factory(queue_item=queue_item)],
+                'continuedl': True,
+                'overwrites': False,
+                'restrictfilenames': False,
+                'windowsfilenames': True,
+                'quiet': False,
+                'no_warnings': False,
+                'postprocessor_hooks': [self._postprocessor_hook],
+                'postprocessors': postprocessors,
+            }
+            if preset.cookies:
+                run_opts['cookiefile'] = preset.cookies
+            # перекодирование идёт в пуле (очередь или плейлист) — ffmpeg делят ядра между собой
+            deferred = self._can_defer(queue_item)
+            playlist_pool = not deferred and queue_item is None and self.is_playlist_url(url, preset)
+            if deferred or playlist_pool:
+                run_opts['postprocessor_args'] = self.ffmpeg_thread_args()
+            cached = self._cached_probe_info(preset, queue_item) or self._disk_cached_info(url, preset)
+            plan = self.plan_formats(cached or self.metadata_cache.get(
+                url, preset.cookies, not getattr(preset, 'download_playlist', False)), preset)
+            held = self._reserve_disk(queue_item, preset, plan or (queue_item.plan if queue_item else None))
+            if held:
+                return held
+            try:
+                self._set_item_status(queue_item, 'Скачивание аудио...')
+                ydl = self.new_ydl(run_opts)
+                pending = self._defer_post_process(ydl) if deferred else None
+                pool, pool_done = self._post_process_in_pool(ydl) if playlist_pool else (None, None)
+                if pool:
+                    self._log(f"Плейлист: треки перекодируются параллельно, потоков ffmpeg: {self.postproc_workers}.")
+                self._stage_times, self._stage_started = {}, {}
+                self._stage_start("загрузка")
+                try:
+                    with ydl:
+                        if cached is not None:
+                            self._log("Используем сохранённые метаданные — без повторного извлечения.")
+                            info = self._download_from_info(ydl, cached)
+                        else:
+                            info = ydl.extract_info(url, download=True)
+                except BaseException:
+                    if pool:
+                        pool.close()
+                        pool.join()
+                    raise
+                if pool:
+                    self._join_pool_post_process(pool, pool_done)
+                note = self._audio_path_note(info, fmt_info, quality)
+                if note:
+                    self._log(note)
+                if pending:
+                    return self._post_process_later(
+                        queue_item, pending, lambda: self._finish_audio(info, codec, extension, queue_item))
+                return self._finish_audio(info, codec, extension, queue_item)
+            except KeyboardInterrupt:
+                self._set_item_status(queue_item, 'Загрузка отменена.')
+                self._log('Загрузка отменена пользователем.')
+                if queue_item:
+                    self._item_state(queue_item, 'Отменено')
+                return 'cancel'
+            except Exception as e:
+                self._set_item_status(queue_item, 'Ошибка.')
+                self._log(f'Ошибка загрузки аудио: {e}')
+                self._last_error = e
+                return 'error'
+
+
+        eff_v, eff_a, warn = self.resolve_codecs_for_container(vch, ach, container_choice)
+        if warn:
+            self._log(warn)
+
+
+        fmt = self.format_selector(height, eff_v if eff_v != "auto" else "auto", eff_a if eff_a != "auto" else "auto", preset.alang_choice)
+        self._log(
+            f"Целевое качество: до {height}p | Видеокодек: {('Авто' if eff_v=='auto' else eff_v.upper())} | "
+            f"Аудиокодек: {('Авто' if eff_a=='auto' else eff_a.upper())} | Аудиоязык: {preset.alang_choice} | "
+            f"Контейнер: {('Авто' if container_choice=='auto' else container_choice)}"
+        )
+        self._log(f"Формат выбора (yt-dlp): {fmt}")
+        if preset.cookies:
+            self._log(f"Используется cookie-файл: {preset.cookies}")
+
+        outtmpl = self._build_outtmpl_simple(preset.outtmpl_user, preset.outdir)
+
+        logger = self.listener.ydl_logger()
+
+        base_opts = {
+            "format": fmt,
+            "noplaylist": not getattr(preset, 'download_playlist', False),
+            "outtmpl": outtmpl,
+            "logger": logger,
+            "concurrent_fragment_downloads": self.governor.fragment_concurrency(),
+            "lazy_playlist": True,  # плейлист целиком (одиночная загрузка): записи по мере прихода страниц
+            "continuedl": True,
+            "overwrites": False,
+            "restrictfilenames": False,
+            "windowsfilenames": True,
+            "quiet": False,
+            "no_warnings": False,
+            "postprocessor_hooks": [self._postprocessor_hook],
+        }
+        if preset.cookies:
+            base_opts["cookiefile"] = preset.cookies
+
+        if getattr(preset, 'write_subtitles', False):
+            base_opts["writesubtitles"] = True
+            if getattr(preset, 'subtitle_langs', None):
+                base_opts["subtitleslangs"] = list(preset.subtitle_langs)
+        if getattr(preset, 'embed_subtitles', False) and getattr(preset, 'write_subtitles', False):
+            base_opts["embedsubtitles"] = True
+
+        if container_choice != "auto":
+            base_opts["merge_output_format"] = container_choice
+            # remux для принудительного контейнера добавляется после пробы — только если он нужен
+
+        local_parts: List[dict] = []   # что уже скачано/собрано — для локальной пересборки в MKV
+        tracker = self._local_parts_tracker(local_parts)
+        hooks = [self._progress_hook_factory(queue_item=queue_item), tracker]
+        run_opts = dict(base_opts)
+        run_opts["progress_hooks"] = hooks
+        run_opts["postprocessor_hooks"] = list(base_opts["postprocessor_hooks"]) + [tracker]
+
+        # ---------- ПРОБА ----------
+        # Один экземпляр YoutubeDL и одна экстракция: info из пробы потом уходит прямо в загрузку.
+        ydl = self.new_ydl(run_opts)
+        info_probe = None
+        if self.is_playlist_url(url, preset):
+            # проба всего плейлиста перед загрузкой — минуты и вся память на длинных каналах;
+            # yt-dlp сам разберёт записи по одной по ходу загрузки
+            self._extra_status_suffix = ""
+            self._log("Плейлист: записи разбираются по ходу загрузки, без предварительной пробы.")
+        else:
+            try:
+                info_probe = self._probe_info(ydl, url, preset, queue_item)
+                if queue_item:
+                    self.telemetry.set_estimate(queue_item, self.estimate_size(info_probe))
+
+                title = info_probe.get("title") or "Без названия"
+                ch = info_probe.get("channel") or info_probe.get("uploader") or "?"
+                dur = seconds_to_hms(info_probe.get("duration"))
+                vid = info_probe.get("id") or "?"
+                self._current_title = title
+                self._log(f"▶ Сейчас скачиваем: «{ellipsize(title, MAX_UI_TITLE)}» [{vid}] | канал: {ch} | длительность: {dur}")
+
+                self.listener.info_ready(info_probe)
+
+                if queue_item and not queue_item.title:
+                    queue_item.title = title
+                    self.listener.item_title(queue_item)
+
+                vfmt, afmt = self._extract_selected_formats(info_probe)
+                if vfmt:
+                    self._log(self._format_summary_line(vfmt, "video"))
+                if afmt:
+                    self._log(self._format_summary_line(afmt, "audio"))
+                if not vfmt and not afmt:
+                    self._log("Не удалось определить выбранные форматы заранее (yt-dlp). Продолжаем загрузку...")
+
+                final_ext_guess = self._guess_final_ext(vfmt, afmt, container_choice)
+                mode = "принудительно" if container_choice != "auto" else "авто"
+                self._log(f"Итоговый контейнер (ожидаемо): {final_ext_guess.upper()} ({mode})")
+
+                vshort = self.short_vcodec((vfmt or {}).get("vcodec"))
+                ashort = self.short_acodec((afmt or {}).get("acodec"))
+                self._extra_status_suffix = f"V:{vshort} A:{ashort} → {final_ext_guess.upper()}"
+            except Exception as e_probe:
+                self._extra_status_suffix = ""
+                self._log(f"Не удалось заранее определить форматы: {e_probe}")
+
+        if container_choice != "auto":
+            if self._needs_remux(info_probe, container_choice):
+                ydl.add_post_processor(_ytdlp().postprocessor.FFmpegVideoRemuxerPP(
+                    ydl, preferedformat=container_choice), when="post_process")
+            else:
+                self._log(f"Remux не нужен: итоговый файл и так будет {container_choice.upper()} — "
+                          f"лишний проход по файлу пропущен.")
+
+        held = self._reserve_disk(queue_item, preset, self.plan_formats(info_probe, preset))
+        if held:
+            ydl.close()  # в `with ydl:` не зашли — закрываем сами (сессия, cookies)
+            return held
+
+        # ---------- Попытка №1 ----------
+        # в очереди ffmpeg-этапы уходят пулу пост-обработки, а этот поток берёт следующую задачу
+        pending = self._defer_post_process(ydl) if self._can_defer(queue_item) else None
+        self._stage_times, self._stage_started = {}, {}
+        self._stage_start("загрузка")
+        try:
+            self._set_item_status(queue_item, "Скачивание...")
+            with ydl:
+                t0 = time.time()
+                if info_probe is not None:
+                    info = self._download_from_info(ydl, info_probe)
+                else:
+                    info = ydl.extract_info(url, download=True)
+            if pending:
+                self._log(f"Загрузка: {time.time() - t0:.1f} с — пост-обработка ждёт свободного потока ffmpeg.")
+                return self._post_process_later(
+                    queue_item, pending, lambda: self._finish_video(info, run_opts, queue_item),
+                    fallback=lambda: self._finish_local_mkv(local_parts, info_probe, queue_item))
+            self._log(f"Загрузка и пост-обработка: {time.time() - t0:.1f} с")
+            return self._finish_video(info, run_opts, queue_item)
+        except KeyboardInterrupt:
+            self._set_item_status(queue_item, "Загрузка отменена.")
+            self._log("Загрузка отменена пользователем.")
+            if queue_item:
+                self._item_state(queue_item, "Отменено")
+            return "cancel"
+        except Exception as e1:
+            self._log(f"Ошибка/не удалось собрать указанный контейнер: {e1}")
+            if self.cancel_event.is_set():
+                self._set_item_status(queue_item, "Загрузка отменена.")
+                if queue_item:
+                    self._item_state(queue_item, "Отменено")
+                return "cancel"
+            if classify_download_error(e1) in RETRY_NO_MKV_FALLBACK:
+                self._set_item_status(queue_item, "Ошибка.")
+                self._last_error = e1
+                return "error"
+
+        # ---------- Попытка №2а — локальная пересборка в MKV из уже скачанного ----------
+        result = self._finish_local_mkv(local_parts, info_probe, queue_item)
+        if result:
+            return result
+
+        # ---------- Попытка №2б — резерв MKV с повторной загрузкой ----------
+        try:
+            fallback_container = "mkv"
+            fallback_opts = dict(run_opts)
+            fallback_opts["merge_output_format"] = fallback_container
+            fallback_opts["postprocessors"] = [{"key": "FFmpegVideoRemuxer", "preferedformat": fallback_container}]
+            self._log("Пробуем собрать в MKV как резервный вариант (повторная загрузка)...")
+            with self.new_ydl(fallback_opts) as ydl2:
+                if info_probe is not None:
+                    info2 = self._download_from_info(ydl2, info_probe)
+                else:
+                    info2 = ydl2.extract_info(url, download=True)
+                try:
+                    if "requested_downloads" in info2 and info2["requested_downloads"]:
+                        self.last_output_path = info2["requested_downloads"][0].get("filepath")
+                except Exception:
+                    pass
+
+                vcodec_final, acodec_final = self._extract_final_codecs(info2)
+                v_short = self.short_vcodec(vcodec_final)
+                a_short = self.short_acodec(acodec_final)
+                height_final = self._extract_final_height(info2)
+                self._extra_status_suffix = f"V:{v_short} A:{a_short} → MKV"
+
+                title_final = info2.get("title") or self._current_title
+                video_id = info2.get("id")
+                is_playlist = info2.get('_type') in ('playlist', 'multi_video') or bool(info2.get('entries'))
+                if not is_playlist:
+                    self.auto_rename_result(
+                        self.last_output_path,
+                        v_short,
+                        a_short,
+                        height_final,
+                        "mkv",
+                        title_hint=title_final,
+                        video_id_hint=video_id,
+                    )
+                else:
+                    self._log("Плейлист: автоматическое переименование отключено, используется шаблон yt-dlp.")
+                if queue_item:
+                    queue_item.result_path = self.last_output_path  # уже после переименования
+
+            self._set_item_progress(queue_item, 100)
+            self._set_item_status(queue_item, "Готово ✅ (MKV)")
+            self._log("Загрузка завершена (mkv).")
+            if queue_item:
+                self._item_state(queue_item, "Готово (mkv)")
+            return "success"
+        except KeyboardInterrupt:
+            self._set_item_status(queue_item, "Загрузка отменена.")
+            self._log("Загрузка отменена пользователем.")
+            if queue_item:
+                self._item_state(queue_item, "Отменено")
+            return "cancel"
+        except Exception as e2:
+            self._set_item_status(queue_item, "Ошибка.")
+            self._log(f"Ошибка загрузки: {e2}")
+            self._last_error = e2
+            return "error"
+        finally:
+            self._current_title = None
+
+
+class ProgressChannel:
+    """
+    Канал «рабочие потоки → окно». Публикация без блокировок: поток перезаписывает
+    последнее значение в слоте (статус, общий прогресс, ...) или кладёт задачу в deque.
+    UI-поток раз в кадр (PROGRESS_SAMPLE_MS) забирает снимок: изменившиеся слоты, задачи
+    без повторов и отложенные действия. Цена для окна не зависит ни от частоты колбэков
+    yt-dlp, ни от числа параллельных загрузок, а Tk трогается только из UI-потока.
+    """
+
+    SLOTS = ("status", "progress", "probe_status", "queue_summary")
+
+    def __init__(self):
+        self._seq = itertools.count(1)
+        self._latest: Dict[str, Tuple[int, object]] = {key: (0, None) for key in self.SLOTS}
+        self._seen: Dict[str, int] = {key: 0 for key in self.SLOTS}
+        self._items: deque = deque()
+        self._calls: deque = deque()
+
+    # ---- рабочие потоки ----
+
+    def publish(self, slot: str, value=None):
+        """Последнее значение побеждает; промежуточные между кадрами просто не показываются."""
+        self._latest[slot] = (next(self._seq), value)
+
+    def publish_item(self, item: QueueItem):
+        self._items.append(item)
+
+    def call_soon(self, fn: Callable[[], None]):
+        """Разовое действие в UI-потоке (диалог, переключение кнопок) — выполнится на ближайшем кадре."""
+        self._calls.append(fn)
+
+    # ---- UI-поток ----
+
+    def take(self) -> Tuple[Dict[str, object], List[QueueItem], List[Callable[[], None]]]:
+        changed = {}
+        for slot in self.SLOTS:
+            seq, value = self._latest[slot]
+            if seq != self._seen[slot]:
+                self._seen[slot] = seq
+                changed[slot] = value
+        items: Dict[int, QueueItem] = {}
+        while True:
+            try:
+                item = self._items.popleft()
+            except IndexError:
+                break
+            items[item.uid] = item
+        calls = []
+        while True:
+            try:
+                calls.append(self._calls.popleft())
+            except IndexError:
+                break
+        return changed, list(items.values()), calls
+
+
+class VirtualQueueView(ttk.Frame):
+    """
+    Таблица очереди, в которой существуют только видимые строки: Treeview держит пул
+    из «экранного» числа строк и при прокрутке лишь переписывает их значения. Модель —
+    список задач после фильтра по статусу и сортировки; её пересборка не трогает Tk.
+    invalidate() можно звать из любого потока: изменения копятся и применяются одним
+    проходом раз в кадр (FRAME_MS), перерисовываются только изменившиеся видимые строки.
+    При фильтре/сортировке модель пересобирается, только если у изменившейся задачи
+    поменялись попадание в фильтр или ключ сортировки, и не чаще раза в RESORT_MIN_S.
+    """
+
+    FRAME_MS = 100
+    WHEEL_ROWS = 3
+    RESORT_MIN_S = 1.0
+
+    def __init__(self, master, columns: Tuple[str, ...], headers: Dict[str, str], widths: Tuple[int, ...],
+                 row_values: Callable[[QueueItem], tuple], source: Callable[[], List[QueueItem]],
+                 sort_keys: Optional[Dict[str, Callable[[QueueItem], object]]] = None,
+                 on_view_changed: Optional[Callable[[], None]] = None):
+        super().__init__(master)
+        self.columns = columns
+        self._headers = headers
+        self._row_values = row_values
+        self._sort_keys = sort_keys or {}  # колонка → ключ прямо из задачи (дешевле, чем строить строку)
+        self._source = source
+        self._on_view_changed = on_view_changed
+
+        self.tv = ttk.Treeview(self, columns=columns, show="headings", height=10, selectmode="extended")
+        self.vsb = ttk.Scrollbar(self, orient="vertical", command=self._on_scrollbar)
+        self.tv.grid(row=0, column=0, sticky="nsew")
+        self.vsb.grid(row=0, column=1, sticky="ns")
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        for col, w in zip(columns, widths):
+            self.tv.heading(col, text=headers[col], command=lambda c=col: self.sort_by(c))
+            self.tv.column(col, width=w, anchor="w")
+
+        self._model: List[QueueItem] = []
+        self._top = 0
+        self._pool: List[str] = []                      # iid строк пула: r0, r1, ...
+        self._pool_items: List[Optional[QueueItem]] = []
+        self._shown: Dict[str, tuple] = {}              # что сейчас написано в строке пула
+        self._attached: set = set()
+        self._pool_size = 10
+        self._row_h = 20
+        self._head_h = 24
+        self._selected: set = set()                     # uid выделенных задач (в том числе вне экрана)
+        self._filter: Optional[str] = None
+        self._sort: Optional[Tuple[str, bool]] = None   # (колонка, по убыванию)
+
+        self._lock = threading.Lock()
+        self._dirty: Dict[int, QueueItem] = {}
+        self._model_dirty = True
+        self._keys: Dict[int, tuple] = {}               # uid → (в фильтре, ключ сортировки) на момент пересборки
+        self._resort_pending = False
+        self._last_rebuild = 0.0
+
+        self.tv.bind("<Configure>", self._on_resize, add="+")
+        for seq in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tv.bind(seq, self._on_wheel)
+        for seq, delta in (("<Prior>", "-page"), ("<Next>", "page"), ("<Home>", "home"), ("<End>", "end")):
+            self.tv.bind(seq, lambda _e, d=delta: self._scroll_key(d))
+        self.tv.bind("<<TreeviewSelect>>", self._on_select, add="+")
+        self.after(self.FRAME_MS, self._tick)
+
+    # ---- API для приложения ----
+
+    def invalidate(self, item: Optional[QueueItem] = None):
+        """Задача изменилась (item) или изменился состав очереди (None). Потокобезопасно, без вызовов Tk."""
+        with self._lock:
+            if item is None:
+                self._model_dirty = True
+            else:
+                self._dirty[item.uid] = item
+
+    def visible_items(self) -> List[QueueItem]:
+        return [it for it in self._pool_items if it is not None]
+
+    def item_at(self, y: int) -> Optional[QueueItem]:
+        iid = self.tv.identify_row(y)
+        if iid in self._pool:
+            return self._pool_items[self._pool.index(iid)]
+        return None
+
+    def selected_items(self) -> List[QueueItem]:
+        if not self._selected:
+            return []
+        return [it for it in self._model if it.uid in self._selected]
+
+    def select(self, item: QueueItem):
+        self._selected = {item.uid}
+        self._render()
+
+    def clear_selection(self):
+        self._selected.clear()
+        self._render()
+
+    def set_filter(self, status_prefix: Optional[str]):
+        """Показывать только задачи, чей статус начинается с status_prefix («Готово» включает «Готово (mkv)»)."""
+        self._filter = status_prefix or None
+        self._top = 0
+        self.invalidate()
+
+    def sort_by(self, col: str):
+        """Клик по заголовку: по возрастанию → по убыванию → порядок очереди."""
+        if not self._sort or self._sort[0] != col:
+            self._sort = (col, False)
+        elif not self._sort[1]:
+            self._sort = (col, True)
+        else:
+            self._sort = None
+        for c in self.columns:
+            arrow = ""
+            if self._sort and self._sort[0] == c:
+                arrow = " ▼" if self._sort[1] else " ▲"
+            self.tv.heading(c, text=self._headers[c] + arrow)
+        self.invalidate()
+
+    def shown_count(self) -> int:
+        return len(self._model)
+
+    # ---- модель ----
+
+    def _sort_key(self) -> Optional[Callable[[QueueItem], object]]:
+        if not self._sort:
+            return None
+        key = self._sort_keys.get(self._sort[0])
+        if key is None:
+            idx = self.columns.index(self._sort[0])
+
+            def key(it, idx=idx):
+                return str(self._row_values(it)[idx]).lower()
+        return key
+
+    def _order_key(self, item: QueueItem, sort_key: Optional[Callable[[QueueItem], object]]) -> tuple:
+        """Что определяет место задачи в модели: попадание в фильтр и ключ сортировки."""
+        return (
+            not self._filter or (item.status or "").startswith(self._filter),
+            sort_key(item) if sort_key else None,
+        )
+
+    def _rebuild_model(self):
+        items = self._source()
+        alive = {it.uid for it in items}
+        self._selected &= alive
+        sort_key = self._sort_key()
+        if self._filter or sort_key:
+            self._keys = {it.uid: self._order_key(it, sort_key) for it in items}
+            if self._filter:
+                items = [it for it in items if self._keys[it.uid][0]]
+            if sort_key:
+                items.sort(key=lambda it: self._keys[it.uid][1], reverse=self._sort[1])
+        else:
+            self._keys = {}
+        self._model = items
+        self._resort_pending = False
+        self._last_rebuild = time.monotonic()
+
+    def _tick(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            model_dirty, self._model_dirty = self._model_dirty, False
+        try:
+            if dirty and self._keys and not self._resort_pending:
+                # статус/название могли изменить состав или порядок — проверяем только изменившиеся
+                sort_key = self._sort_key()
+                self._resort_pending = any(
+                    uid in self._keys and self._keys[uid] != self._order_key(it, sort_key)
+                    for uid, it in dirty.items())
+            if self._resort_pending and time.monotonic() - self._last_rebuild >= self.RESORT_MIN_S:
+                model_dirty = True
+            if model_dirty:
+                self._rebuild_model()
+                self._render()
+            elif dirty and any(it is not None and it.uid in dirty for it in self._pool_items):
+                self._render()
+        finally:
+            self.after(self.FRAME_MS, self._tick)
+
+    # ---- отрисовка пула ----
+
+    def _render(self):
+        n = self._pool_size
+        while len(self._pool) < n:
+            iid = f"r{len(self._pool)}"
+            self.tv.insert("", "end", iid=iid, values=())
+            self._pool.append(iid)
+            self._attached.add(iid)
+        while len(self._pool) > n:
+            iid = self._pool.pop()
+            self.tv.delete(iid)
+            self._attached.discard(iid)
+            self._shown.pop(iid, None)
+        self._top = max(0, min(self._top, len(self._model) - n))
+        visible = self._model[self._top:self._top + n]
+        self._pool_items = visible + [None] * (n - len(visible))
+        selection = []
+        for pos, (iid, item) in enumerate(zip(self._pool, self._pool_items)):
+            if item is None:
+                if iid in self._attached:
+                    self.tv.detach(iid)
+                    self._attached.discard(iid)
+                continue
+            if iid not in self._attached:
+                self.tv.move(iid, "", pos)
+                self._attached.add(iid)
+            values = self._row_values(item)
+            if self._shown.get(iid) != values:
+                self.tv.item(iid, values=values)
+                self._shown[iid] = values
+            if item.uid in self._selected:
+                selection.append(iid)
+        if tuple(selection) != self.tv.selection():
+            self.tv.selection_set(selection)
+        self.tv.yview_moveto(0)
+        total = len(self._model)
+        if total > n:
+            self.vsb.set(self._top / total, min(1.0, (self._top + n) / total))
+        else:
+            self.vsb.set(0.0, 1.0)
+        self._measure_rows()
+
+    def _measure_rows(self):
+        if not self._pool or self._pool[0] not in self._attached:
+            return
+        bbox = self.tv.bbox(self._pool[0])
+        if bbox and (bbox[1], bbox[3]) != (self._head_h, self._row_h):
+            self._head_h, self._row_h = bbox[1], max(1, bbox[3])
+            self._resize_pool(self.tv.winfo_height())
+
+    def _resize_pool(self, height: int):
+        size = max(1, (height - self._head_h) // self._row_h)
+        if size != self._pool_size:
+            self._pool_size = size
+            self._render()
+            self._view_changed()
+
+    # ---- прокрутка / выделение ----
+
+    def _scroll_to(self, top: int):
+        top = max(0, min(top, len(self._model) - self._pool_size))
+        if top != self._top:
+            self._top = top
+            self._render()
+            self._view_changed()
+
+    def _view_changed(self):
+        if self._on_view_changed:
+            self._on_view_changed()
+
+    def _on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            self._scroll_to(int(float(args[1]) * len(self._model)))
+        elif args[0] == "scroll":
+            step = self._pool_size if args[2] == "pages" else 1
+            self._scroll_to(self._top + int(args[1]) * step)
+
+    def _on_wheel(self, event):
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self._scroll_to(self._top - self.WHEEL_ROWS)
+        else:
+            self._scroll_to(self._top + self.WHEEL_ROWS)
+        return "break"  # собственная прокрутка Treeview сдвинула бы сам пул
+
+    def _scroll_key(self, what: str):
+        target = {"-page": self._top - self._pool_size, "page": self._top + self._pool_size,
+                  "home": 0, "end": len(self._model)}[what]
+        self._scroll_to(target)
+        return "break"
+
+    def _on_resize(self, event):
+        self._resize_pool(event.height)
+
+    def _on_select(self, _event=None):
+        picked = set(self.tv.selection())
+        for iid, item in zip(self._pool, self._pool_items):
+            if item is None:
+                continue
+            if iid in picked:
+                self._selected.add(item.uid)
+            else:
+                self._selected.discard(item.uid)
+
+
+class TkEngineListener(EngineListener):
+    """Связывает DownloadEngine с окном: лог-виджеты, статус, прогресс и строки очереди."""
+
+    def __init__(self, app: "DownloaderApp"):
+        self.app = app
+
+    def log(self, msg: str):
+        self.app._append_log(msg)
+
+    def raw(self, msg: str):
+        self.app._append_raw(msg)
+
+    def ydl_logger(self):
+        return TkLogger(self.app.log_main_text, self.app.log_raw_text, self.app.log_sink)
+
+    def status(self, text: str):
+        self.app.progress_channel.publish("status", text)
+
+    def progress(self, percent: float):
+        self.app.progress_channel.publish("progress", percent)
+
+    def item_state(self, item: QueueItem, status: str):
+        item.status = status
+        with self.app._active_lock:
+            if status == "В процессе":
+                self.app._active_items[item.uid] = item
+            else:
+                self.app._active_items.pop(item.uid, None)
+        self.app.progress_channel.publish_item(item)
+        if self.app.queue_store and status != "В процессе":  # старт пишет item_started вместе со счётчиком попыток
+            self.app.queue_store.update_state(item)
+
+    def item_detail(self, item: QueueItem):
+        self.app.progress_channel.publish_item(item)
+
+    def item_title(self, item: QueueItem):
+        if self.app.queue_store:
+            self.app.queue_store.update_title(item)
+        self.app.progress_channel.publish_item(item)
+
+    def item_position(self, item: QueueItem) -> str:
+        pos = self.app.queue.position(item)
+        return f"[{pos[0]}/{pos[1]}] " if pos else ""
+
+    def info_ready(self, info: dict):
+        self.app.progress_channel.call_soon(lambda: self.app._update_languages_from_info(info))
+
+    def error(self, item: Optional[QueueItem], message: str):
+        if item is None:  # одиночная загрузка — пользователь ждёт именно её
+            self.app.progress_channel.call_soon(lambda: messagebox.showerror("Ошибка загрузки", message))
+            return
+        # в очереди окно не блокируем: ошибка остаётся в строке задачи и в истории попыток
+        self.app._append_log(f"[ОШИБКА] {item.title or item.url}: {message}")
+        if self.app.queue_store:
+            self.app.queue_store.update_history(item)
+
+    def item_retry(self, item: QueueItem):
+        if item in self.app.queue:  # в хвост и в таблице — в том же порядке, в каком пойдёт повтор
+            self.app.queue.discard(item)
+            self.app.queue.append(item)
+        if self.app.queue_store:
+            self.app.queue_store.update_history(item)
+        self.app.queue_view.invalidate()
+        self.app._refresh_queue_summary()
+
+    def should_start(self, item: QueueItem) -> bool:
+        return item in self.app.queue
+
+    def item_started(self, item: QueueItem):
+        if self.app.queue_store:
+            self.app.queue_store.mark_started(item)
+        self.app._refresh_queue_summary()
+
+    def item_finished(self, item: QueueItem, result: str):
+        if result == "success":
+            self.app._queue_remove_item(item, keep_history=True)
+            self.app._append_log("Задача выполнена и удалена из очереди.")
+        elif result == "expanded":
+            self.app._queue_remove_item(item, keep_history=True)
+        elif result == "archived":
+            self.app._queue_remove_item(item, keep_history=True)
+            self.app._append_log(f"Уже скачано, пропуск: {item.result_path or item.url}")
+        else:
+            self.app._append_log(f"Задача завершилась со статусом: {item.status}")
+        self.app._refresh_queue_summary()
+
+    def items_added(self, parent: QueueItem, items: List[QueueItem]):
+        self.app._queue_run_total += len(items)
+        self.app._queue_add_items(items, probe=False)  # форматы видео выберет загрузка, заранее не пробуем
+        self.app._refresh_queue_summary()
+
+
+class DownloaderApp(tk.Tk):
+    def __init__(self):
+        super().__init__()
+        self.title("YouTube Видео Загрузчик (yt-dlp)")
+        self.geometry("1020x900")
+        self.minsize(1020, 900)
+        self.configure(bg=LIGHT_BG)
+
+        # Состояние
+        try:
+            archive = DownloadArchive(ARCHIVE_DB_PATH)
+        except sqlite3.Error:
+            archive = None
+        self.engine = DownloadEngine(TkEngineListener(self), archive=archive)
+        try:
+            self.engine.subscriptions = SubscriptionStore(SUBSCRIPTIONS_DB_PATH)
+        except sqlite3.Error:
+            self.engine.subscriptions = None
+        self.cancel_event = self.engine.cancel_event
+        self.metadata_cache = self.engine.metadata_cache
+        self.download_thread = None
+        self.queue_thread = None
+        self.queue = QueueIndex()
+        self.queue_store: Optional[QueueStore] = None
+        self.progress_channel = ProgressChannel()
+        preload_ytdlp(self._on_ytdlp_loaded)  # импорт идёт, пока строится окно
+        self.queue_running = False
+        self._queue_run_total = 0
+        self._active_items: Dict[int, QueueItem] = {}  # uid → задача «В процессе» (для сводки без обхода очереди)
+        self._active_lock = threading.Lock()
+        self._save_debounce_after = None
+        self._updating = False
+
+        # Доступные языки (динамически обновляемые)
+        self.available_audio_languages: List[str] = ["orig", "ru", "en"]
+        self.available_subtitle_languages: List[str] = []
+        self.selected_subtitle_langs: List[str] = []
+        self._metadata_fetching = False
+
+        # UI
+        self._build_ui()
+
+        # Пул проб названий/метаданных для очереди
+        self._probe_pool = ProbePool(self._probe_queue_items, self._probe_workers_count(),
+                                     on_progress=self._on_probe_progress)
+        self._visible_probe_after = None
+
+        # Проверка ffmpeg — в фоне: shutil.which обходит весь PATH (на сетевых дисках это заметно)
+        threading.Thread(target=self._check_ffmpeg, name="ffmpeg-check", daemon=True).start()
+
+        # Загрузка/подписка настроек
+        self._load_settings()
+        self._probe_pool.set_workers(self._probe_workers_count())
+        self._bind_setting_events()
+
+        # Очередь прошлого сеанса
+        self._open_queue_store()
+        self._bandwidth_tick()
+        self._hosts_tick()
+        self.after(PROGRESS_SAMPLE_MS, self._sample_progress)
+
+        # Закрытие
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+
+    # ------------------------ Вспомогательные сокращатели ------------------------
+
+    def _ellipsize(self, s: str, maxlen: int) -> str:
+        return ellipsize(s, maxlen)
+
+    # ------------------------ UI ------------------------
+
+    def _build_ui(self):
+        pad = 10
+
+        main = ttk.Frame(self, padding=pad)
+        main.pack(fill="both", expand=True, padx=pad, pady=pad)
+
+        # URL
+        url_frame = ttk.LabelFrame(main, text="Ссылка на видео (YouTube)", padding=pad)
+        url_frame.pack(fill="x", expand=False, pady=(0, pad))
+        self.url_var = tk.StringVar()
+        url_entry = ttk.Entry(url_frame, textvariable=self.url_var)
+        url_entry.pack(side="left", fill="x", expand=True, padx=(0, pad))
+        url_entry.focus_set()
+
+        self.analyze_btn = ttk.Button(
+            url_frame,
+            text="Анализировать",
+            style="Accent.TButton",
+            command=self._on_fetch_metadata_clicked,
+        )
+        self.analyze_btn.pack(side="left", padx=(0, pad))
+
+        self.analyze_status_var = tk.StringVar(value="")
+        self.analyze_status_label = ttk.Label(
+            url_frame,
+            textvariable=self.analyze_status_var,
+            foreground=MUTED_TEXT_COLOR,
+        )
+        self.analyze_status_label.pack(side="left")
+
+        paste_btn = ttk.Button(url_frame, text="Вставить", command=self._paste_from_clipboard)
+        paste_btn.pack(side="left", padx=(0, pad))
+
+        clear_btn = ttk.Button(url_frame, text="Очистить", command=lambda: self.url_var.set(""))
+        clear_btn.pack(side="left", padx=(0, pad))
+
+        # Настройки
+        settings = ttk.LabelFrame(main, text="Настройки", padding=pad)
+        settings.pack(fill="x", expand=False, pady=(0, pad))
+
+        # Качество
+        ttk.Label(settings, text="Качество:").grid(row=0, column=0, padx=(0, 5), pady=(0, 5), sticky="w")
+        self.quality_var = tk.StringVar(value="1080p")
+        qualities = ["480p", "720p", "1080p", "1440p (2K)", "2160p (4K)", "4320p (8K)"]
+        self.quality_cb = ttk.Combobox(settings, textvariable=self.quality_var, values=qualities, state="readonly", width=20)
+        self.quality_cb.grid(row=0, column=1, padx=(0, 15), pady=(0, 5), sticky="w")
+
+        # Видео кодек
+        ttk.Label(settings, text="Видео кодек:").grid(row=0, column=2, padx=(0, 5), pady=(0, 5), sticky="w")
+        self.vcodec_var = tk.StringVar(value="Авто")
+        vcodec_values = ["Авто", "AV1 (av01)", "VP9 (vp9)", "H.264 (avc1)"]
+        self.vcodec_cb = ttk.Combobox(settings, textvariable=self.vcodec_var, values=vcodec_values, state="readonly", width=18)
+        self.vcodec_cb.grid(row=0, column=3, padx=(0, 15), pady=(0, 5), sticky="w")
+
+        # Аудио кодек
+        ttk.Label(settings, text="Аудио кодек:").grid(row=0, column=4, padx=(0, 5), pady=(0, 5), sticky="w")
+        self.acodec_var = tk.StringVar(value="Авто")
+        acodec_values = ["Авто", "Opus (opus)", "AAC (mp4a)", "Vorbis (vorbis)"]
+        self.acodec_cb = ttk.Combobox(settings, textvariable=self.acodec_var, values=acodec_values, state="readonly", width=18)
+        self.acodec_cb.grid(row=0, column=5, padx=(0, 15), pady=(0, 5), sticky="w")
+
+        # Язык аудио
+        ttk.Label(settings, text="Язык аудио:").grid(row=0, column=6, padx=(0, 5), pady=(0, 5), sticky="w")
+        self.alang_var = tk.StringVar(value="orig")
+        self.alang_cb = ttk.Combobox(settings, textvariable=self.alang_var, values=self.available_audio_languages, state="readonly", width=8)
+        self.alang_cb.grid(row=0, column=7, padx=(0, 15), pady=(0, 5), sticky="w")
+
+        self.playlist_var = tk.IntVar(value=0)
+        self.playlist_cb = ttk.Checkbutton(settings, text="Скачать плейлист целиком", variable=self.playlist_var,
+                                           command=self._save_settings_debounced)
+        self.playlist_cb.grid(row=0, column=8, padx=(0, 0), pady=(0, 5), sticky="w")
+
+        # Итоговый контейнер
+        ttk.Label(settings, text="Контейнер:").grid(row=1, column=0, padx=(0, 5), pady=5, sticky="w")
+        self.container_var = tk.StringVar(value="Авто")
+        container_values = ["Авто", "mp4", "mkv", "webm"]
+        self.container_cb = ttk.Combobox(settings, textvariable=self.container_var, values=container_values, state="readonly", width=20)
+        self.container_cb.grid(row=1, column=1, padx=(0, 15), pady=5, sticky="w")
+
+        # Папка сохранения
+        ttk.Label(settings, text="Папка сохранения:").grid(row=1, column=2, padx=(0, 5), pady=5, sticky="w")
+        self.outdir_var = tk.StringVar(value=os.path.join(os.path.expanduser("~"), "Downloads"))
+        outdir_entry = ttk.Entry(settings, textvariable=self.outdir_var, width=40)
+        outdir_entry.grid(row=1, column=3, padx=(0, 5), pady=5, sticky="ew")
+        outdir_btn = ttk.Button(settings, text="Выбрать...", command=self._choose_outdir)
+        outdir_btn.grid(row=1, column=4, padx=(0, 15), pady=5, sticky="w")
+
+        # Cookies
+        ttk.Label(settings, text="Cookies (опционально):").grid(row=1, column=5, padx=(0, 5), pady=5, sticky="w")
+        self.cookies_var = tk.StringVar()
+        cookies_btn = ttk.Button(settings, text="Выбрать cookies.txt...", command=self._choose_cookies)
+        cookies_btn.grid(row=1, column=6, columnspan=2, padx=(0, 15), pady=5, sticky="w")
+
+        # Путь к cookies
+        ttk.Label(settings, text="Путь cookies:").grid(row=2, column=0, padx=(0, 5), pady=5, sticky="w")
+        self.cookies_path_entry = ttk.Entry(settings, textvariable=self.cookies_var, width=85)
+        self.cookies_path_entry.grid(row=2, column=1, columnspan=7, padx=(0, 5), pady=5, sticky="ew")
+
+        # Имя файла (шаблон)
+        ttk.Label(settings, text="Имя файла:").grid(row=3, column=0, padx=(0, 5), pady=5, sticky="w")
+        self.outtmpl_var = tk.StringVar(value="%(title)s.%(ext)s")
+        outtmpl_entry = ttk.Entry(settings, textvariable=self.outtmpl_var, width=85)
+        outtmpl_entry.grid(row=3, column=1, columnspan=7, padx=(0, 5), pady=5, sticky="ew")
+        hint = ttk.Label(settings, text="Рекомендуем оставить %(title)s.%(ext)s — приложение переименует итоговый файл автоматически.", foreground=MUTED_TEXT_COLOR)
+        hint.grid(row=4, column=1, columnspan=7, padx=(0, 5), pady=(0, 5), sticky="w")
+
+        # Только аудио
+        self.audio_only_var = tk.IntVar(value=0)
+        audio_only_cb = ttk.Checkbutton(settings, text="Скачать только аудио", variable=self.audio_only_var,
+                                        command=self._on_audio_only_toggle)
+        audio_only_cb.grid(row=5, column=0, columnspan=2, sticky="w", pady=(5, 5))
+
+        ttk.Label(settings, text="Формат:").grid(row=5, column=2, padx=(0, 5), pady=(5, 5), sticky="e")
+        self.audio_format_var = tk.StringVar(value=DEFAULT_AUDIO_FORMAT)
+        format_labels = [info['label'] for info in AUDIO_FORMAT_OPTIONS.values()]
+        self.audio_format_map = {info["label"]: key for key, info in AUDIO_FORMAT_OPTIONS.items()}
+        self.audio_format_label_var = tk.StringVar(value=AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT]["label"])
+        self.audio_format_cb = ttk.Combobox(settings, state="readonly", values=format_labels,
+                                           textvariable=self.audio_format_label_var)
+        self.audio_format_cb.grid(row=5, column=3, padx=(0, 5), pady=(5, 5), sticky="w")
+        self.audio_format_cb.bind("<<ComboboxSelected>>", lambda *_: self._on_audio_format_selected())
+
+        ttk.Label(settings, text="Битрейт:").grid(row=5, column=4, padx=(0, 5), pady=(5, 5), sticky="e")
+        self.audio_quality_var = tk.StringVar(value=DEFAULT_AUDIO_QUALITY)
+        self.audio_quality_cb = ttk.Combobox(settings, textvariable=self.audio_quality_var, state="readonly", width=8)
+        self.audio_quality_cb.grid(row=5, column=5, padx=(0, 15), pady=(5, 5), sticky="w")
+
+        # Субтитры
+        ttk.Label(settings, text="Субтитры:").grid(row=6, column=0, padx=(0, 5), pady=(5, 0), sticky="w")
+        self.write_subs_var = tk.IntVar(value=0)
+        write_cb = ttk.Checkbutton(settings, text="Скачать", variable=self.write_subs_var,
+                                   command=self._on_subtitle_option_changed)
+        write_cb.grid(row=6, column=1, sticky="w", pady=(5, 0))
+        self.embed_subs_var = tk.IntVar(value=0)
+        self.embed_subs_check = ttk.Checkbutton(settings, text="Встроить в видео", variable=self.embed_subs_var,
+                                               command=self._on_subtitle_option_changed)
+        self.embed_subs_check.grid(row=6, column=2, columnspan=2, sticky="w", pady=(5, 0))
+
+        self.subtitle_display_var = tk.StringVar(value="Не выбрано")
+        subtitle_entry = ttk.Entry(settings, textvariable=self.subtitle_display_var, state="readonly", width=40)
+        subtitle_entry.grid(row=6, column=4, columnspan=3, sticky="ew", padx=(0, 5), pady=(5, 0))
+        self.subtitle_select_btn = ttk.Button(settings, text="Выбрать языки...", command=self._open_subtitle_selector)
+        self.subtitle_select_btn.grid(row=6, column=7, columnspan=2, sticky="w", pady=(5, 0))
+
+        for col in range(0, 9):
+            weight = 1 if col in (1, 3, 6, 7, 8) else 0
+            settings.grid_columnconfigure(col, weight=weight)
+        settings.grid_columnconfigure(3, weight=2)
+
+        # Кнопки управления
+        buttons = ttk.Frame(main, padding=(0, 0, 0, 0))
+        buttons.pack(fill="x", expand=False, pady=(0, pad))
+        self.download_btn = ttk.Button(buttons, text="Скачать сейчас", style="Accent.TButton", command=self._on_download_clicked)
+        self.download_btn.pack(side="left", padx=(0, pad))
+        self.cancel_btn = ttk.Button(buttons, text="Отмена", command=self._on_cancel_clicked, state="disabled")
+        self.cancel_btn.pack(side="left", padx=(0, pad))
+        self.open_btn = ttk.Button(buttons, text="Открыть папку", command=lambda: open_file_manager(self.outdir_var.get()))
+        self.open_btn.pack(side="left", padx=(0, pad))
+        self.update_yt_btn = ttk.Button(buttons, text="Обновить yt-dlp", command=self._on_update_yt_dlp)
+        self.update_yt_btn.pack(side="left", padx=(0, pad))
+
+        # Прогресс
+        progress_frame = ttk.LabelFrame(main, text="Прогресс", padding=pad)
+        progress_frame.pack(fill="x", expand=False, pady=(0, pad))
+        self.progress = ttk.Progressbar(progress_frame, mode="determinate", maximum=100)
+        self.progress.pack(fill="x", padx=0, pady=(0, 5))
+        self.status_var = tk.StringVar(value="Ожидание...")
+        status_label = ttk.Label(progress_frame, textvariable=self.status_var)
+        status_label.pack(fill="x", pady=(0, 0))
+
+        # Центральная область с очередью и логами
+        center_split = ttk.Panedwindow(main, orient="vertical")
+        center_split.pack(fill="both", expand=True, pady=(0, pad))
+
+        # Очередь
+        queue_frame = ttk.LabelFrame(center_split, text="Очередь загрузок", padding=pad)
+
+        queue_buttons = ttk.Frame(queue_frame)
+        queue_buttons.pack(fill="x", expand=False, pady=(0, pad))
+        self.add_queue_btn = ttk.Button(queue_buttons, text="Добавить в очередь", command=self._on_add_to_queue)
+        self.add_queue_btn.pack(side="left", padx=(0, 5))
+        self.load_txt_btn = ttk.Button(queue_buttons, text="Загрузить .txt в очередь", command=self._on_load_txt_to_queue)
+        self.load_txt_btn.pack(side="left", padx=(0, 5))
+        self.start_queue_btn = ttk.Button(queue_buttons, text="Старт очереди", style="Accent.TButton", command=self._on_start_queue)
+        self.start_queue_btn.pack(side="left", padx=(0, 5))
+        self.clear_queue_btn = ttk.Button(queue_buttons, text="Очистить очередь", command=self._on_clear_queue)
+        self.clear_queue_btn.pack(side="left", padx=(0, 5))
+
+        ttk.Label(queue_buttons, text="Параллельно:").pack(side="left", padx=(10, 5))
+        self.queue_workers_var = tk.IntVar(value=DEFAULT_QUEUE_WORKERS)
+        self.queue_workers_sb = ttk.Spinbox(queue_buttons, from_=1, to=MAX_QUEUE_WORKERS, width=4,
+                                            textvariable=self.queue_workers_var, state="readonly",
+                                            command=self._save_settings_debounced)
+        self.queue_workers_sb.pack(side="left")
+
+        ttk.Label(queue_buttons, text="Анализ названий:").pack(side="left", padx=(10, 5))
+        self.probe_workers_var = tk.IntVar(value=DEFAULT_PROBE_WORKERS)
+        self.probe_workers_sb = ttk.Spinbox(queue_buttons, from_=1, to=MAX_PROBE_WORKERS, width=4,
+                                            textvariable=self.probe_workers_var, state="readonly",
+                                            command=self._on_probe_workers_changed)
+        self.probe_workers_sb.pack(side="left")
+
+        self.probe_status_var = tk.StringVar(value="")
+        ttk.Label(queue_buttons, textvariable=self.probe_status_var,
+                  foreground=MUTED_TEXT_COLOR).pack(side="right")
+
+        archive_row = ttk.Frame(queue_frame)
+        archive_row.pack(fill="x", expand=False, pady=(0, pad))
+        self.redownload_var = tk.IntVar(value=0)
+        ttk.Checkbutton(archive_row, text="Уже скачанное — перекачивать, если пресет другой",
+                        variable=self.redownload_var, command=self._on_redownload_toggle).pack(side="left")
+        self.import_archive_btn = ttk.Button(archive_row, text="Импорт архива yt-dlp…", command=self._on_import_archive)
+        self.import_archive_btn.pack(side="left", padx=(10, 0))
+        self.subscribe_btn = ttk.Button(archive_row, text="Подписаться", command=self._on_subscribe)
+        self.subscribe_btn.pack(side="left", padx=(10, 0))
+        self.sync_subs_btn = ttk.Button(archive_row, text="Проверить подписки", command=self._on_sync_subscriptions)
+        self.sync_subs_btn.pack(side="left", padx=(5, 0))
+        self.queue_filter_var = tk.StringVar(value=QUEUE_FILTER_ALL)
+        filter_cb = ttk.Combobox(archive_row, textvariable=self.queue_filter_var, state="readonly", width=14,
+                                 values=[QUEUE_FILTER_ALL, "Ожидает", "В процессе", "Повтор", "Ждёт места", "Готово", "Ошибка", "Отменено",
+                                         "Уже скачано", "Развёрнут"])
+        filter_cb.pack(side="right")
+        filter_cb.bind("<<ComboboxSelected>>", lambda _e: self.queue_view.set_filter(
+            None if self.queue_filter_var.get() == QUEUE_FILTER_ALL else self.queue_filter_var.get()))
+        ttk.Label(archive_row, text="Показать:").pack(side="right", padx=(10, 5))
+
+        limit_row = ttk.Frame(queue_frame)
+        limit_row.pack(fill="x", expand=False, pady=(0, pad))
+        ttk.Label(limit_row, text="Лимит скорости:").pack(side="left", padx=(0, 5))
+        self.rate_limit_var = tk.StringVar(value="")
+        rate_entry = ttk.Entry(limit_row, textvariable=self.rate_limit_var, width=8)
+        rate_entry.pack(side="left")
+        ttk.Label(limit_row, text="на загрузку:").pack(side="left", padx=(10, 5))
+        self.rate_limit_item_var = tk.StringVar(value="")
+        rate_item_entry = ttk.Entry(limit_row, textvariable=self.rate_limit_item_var, width=8)
+        rate_item_entry.pack(side="left")
+        ttk.Label(limit_row, text="Расписание:").pack(side="left", padx=(10, 5))
+        self.rate_schedule_var = tk.StringVar(value="")
+        schedule_entry = ttk.Entry(limit_row, textvariable=self.rate_schedule_var, width=32)
+        schedule_entry.pack(side="left")
+        for w in (rate_entry, rate_item_entry, schedule_entry):
+            w.bind("<Return>", lambda _e: self._apply_bandwidth_settings())
+            w.bind("<FocusOut>", lambda _e: self._apply_bandwidth_settings())
+        self.bw_status_var = tk.StringVar(value="")
+        ttk.Label(limit_row, textvariable=self.bw_status_var, foreground=MUTED_TEXT_COLOR).pack(side="left", padx=(10, 0))
+        ttk.Label(limit_row, text="напр. 2M; 09:00-18:00=2M, 22:00-07:00=0",
+                  foreground=MUTED_TEXT_COLOR).pack(side="right")
+
+        hosts_row = ttk.Frame(queue_frame)
+        hosts_row.pack(fill="x", expand=False, pady=(0, pad))
+        ttk.Label(hosts_row, text="Запросы к сайтам:").pack(side="left", padx=(0, 5))
+        self.hosts_status_var = tk.StringVar(value="пока не было")
+        ttk.Label(hosts_row, textvariable=self.hosts_status_var, foreground=MUTED_TEXT_COLOR).pack(side="left")
+
+        columns = ("title", "quality", "vcodec", "acodec", "container", "status", "progress")
+        headers = {
+            "title": "Название",
+            "quality": "Качество",
+            "vcodec": "ВИДЕО",
+            "acodec": "АУДИО",
+            "container": "КОНТЕЙНЕР",
+            "status": "СТАТУС",
+            "progress": "ПРОГРЕСС",
+        }
+        self.queue_view = VirtualQueueView(queue_frame, columns, headers, (330, 90, 80, 80, 100, 110, 200),
+                                           row_values=self._queue_row_values, source=lambda: list(self.queue),
+                                           sort_keys={
+                                               "title": lambda it: (it.title or "").lower(),
+                                               "quality": lambda it: (not it.preset.audio_only, it.preset.height),
+                                               "status": lambda it: it.status,
+                                               "progress": lambda it: it.progress,
+                                           },
+                                           on_view_changed=self._on_queue_view_changed)
+        self.queue_view.pack(fill="both", expand=True)
+        self.queue_tv = self.queue_view.tv
+
+        center_split.add(queue_frame, weight=3)
+
+        # Контекстное меню / события таблицы
+        self._queue_menu = tk.Menu(self, tearoff=0)
+        self._queue_menu.add_command(label="Изменить…", command=self._on_queue_edit_selected)
+        self._queue_menu.add_command(label="Удалить", command=self._on_queue_delete_selected)
+        self._queue_menu.add_command(label="История попыток…", command=self._on_queue_history_selected)
+        self._MENU_IDX_EDIT = 0
+        self._MENU_IDX_DELETE = 1
+        self.queue_tv.bind("<Button-3>", self._on_queue_right_click)
+        self.queue_tv.bind("<Control-Button-1>", self._on_queue_right_click)
+        self.queue_tv.bind("<Double-1>", self._on_queue_double_click)
+
+        # --- ДВА ЛОГА: слева важный, справа подробный ---
+        logs_group = ttk.LabelFrame(center_split, text="Журналы", padding=pad)
+
+        # горизонтальное расположение панелей (левая/правая)
+        paned = ttk.Panedwindow(logs_group, orient="horizontal")
+        paned.pack(fill="both", expand=True)
+
+        # Важные сообщения (слева)
+        imp_frame = ttk.LabelFrame(paned, text="Важные сообщения", padding=pad)
+        self.log_main_text = tk.Text(imp_frame, wrap="word", height=10, state="disabled", bg=LIGHT_PANEL_BG, fg=TEXT_COLOR, insertbackground=ACCENT_COLOR)
+        imp_vsb = ttk.Scrollbar(imp_frame, orient="vertical", command=self.log_main_text.yview)
+        self.log_main_text.configure(yscrollcommand=imp_vsb.set)
+        self.log_main_text.pack(side="left", fill="both", expand=True)
+        imp_vsb.pack(side="right", fill="y")
+        paned.add(imp_frame, weight=1)
+
+        # Подробный лог (справа)
+        raw_frame = ttk.LabelFrame(paned, text="Подробный лог (yt-dlp)", padding=pad)
+        self.log_raw_text = tk.Text(raw_frame, wrap="none", height=10, state="disabled", bg=LIGHT_PANEL_BG, fg=TEXT_COLOR, insertbackground=ACCENT_COLOR)
+        raw_vsb = ttk.Scrollbar(raw_frame, orient="vertical", command=self.log_raw_text.yview)
+        self.log_raw_text.configure(yscrollcommand=raw_vsb.set)
+        self.log_raw_text.pack(side="left", fill="both", expand=True)
+        raw_vsb.pack(side="right", fill="y")
+        paned.add(raw_frame, weight=1)
+        self._raw_log_frame = raw_frame
+
+        self.log_sink = TkLogSink(self)
+        self.log_sink.on_flush = self._on_log_flush
+        self._log_dropped_shown = 0
+        self.log_sink.start()
+
+        center_split.add(logs_group, weight=2)
+
+        # Стили
+        try:
+            self.style = ttk.Style(self)
+            if sys.platform == "darwin":
+                self.style.theme_use("aqua")
+            else:
+                self.style.theme_use("clam")
+        except Exception:
+            self.style = ttk.Style(self)
+
+        self.style.configure("TFrame", background=LIGHT_BG)
+        self.style.configure("TLabelframe", background=LIGHT_BG, foreground=TEXT_COLOR)
+        self.style.configure("TLabelframe.Label", background=LIGHT_BG, foreground=TEXT_COLOR)
+        self.style.configure("TLabel", background=LIGHT_BG, foreground=TEXT_COLOR)
+        self.style.configure("TCheckbutton", background=LIGHT_BG, foreground=TEXT_COLOR)
+        self.style.configure("TEntry", fieldbackground=LIGHT_PANEL_BG, foreground=TEXT_COLOR)
+        self.style.configure("TCombobox", fieldbackground=LIGHT_PANEL_BG, foreground=TEXT_COLOR)
+        self.style.configure("TButton", background="#dbe8ff", foreground=TEXT_COLOR)
+        self.style.map("TButton", background=[("active", "#c9dcff")])
+        self.style.configure("Accent.TButton", background=ACCENT_COLOR, foreground="#ffffff")
+        self.style.map("Accent.TButton", background=[("active", ACCENT_COLOR_ACTIVE)])
+        self.style.configure("Treeview", background=LIGHT_PANEL_BG, fieldbackground=LIGHT_PANEL_BG, foreground=TEXT_COLOR, rowheight=24)
+        self.style.configure("Treeview.Heading", background=ACCENT_COLOR, foreground="#ffffff")
+        self.style.configure("TProgressbar", troughcolor="#dce4f5", background=ACCENT_COLOR)
+
+        # Нижняя панель
+        footer = ttk.Frame(main, padding=(0, pad, 0, 0))
+        footer.pack(fill="x", expand=False)
+        note = ttk.Label(
+            footer,
+            text="Соблюдайте авторские права и условия YouTube. Загружайте только то, на что у вас есть права.",
+            foreground=MUTED_TEXT_COLOR
+        )
+        note.pack(side="left")
+        # Версия yt-dlp
+        self.ydl_version_var = tk.StringVar(value="yt-dlp …")  # версия — когда закончится фоновый импорт
+        ver_lbl = ttk.Label(footer, textvariable=self.ydl_version_var, foreground=MUTED_TEXT_COLOR)
+        ver_lbl.pack(side="right")
+
+        self._refresh_audio_quality_values()
+        self._on_audio_only_toggle(init=True)
+        self._update_subtitle_display()
+        self._on_subtitle_option_changed(init=True)
+
+    # ------------------------ Доп. помощники UI ------------------------
+
+    def _refresh_audio_quality_values(self):
+        if not hasattr(self, "audio_quality_cb"):
+            return
+        fmt_key = self.audio_format_var.get() or DEFAULT_AUDIO_FORMAT
+        fmt = AUDIO_FORMAT_OPTIONS.get(fmt_key, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
+        values = fmt.get("bitrate_values", [])
+        if values:
+            self.audio_quality_cb.configure(values=values, state="readonly")
+            if self.audio_quality_var.get() not in values:
+                self.audio_quality_var.set(values[0])
+        else:
+            self.audio_quality_cb.configure(values=[], state="disabled")
+            self.audio_quality_var.set("0")
+
+    def _on_audio_format_selected(self):
+        label = self.audio_format_label_var.get()
+        fmt = self.audio_format_map.get(label, DEFAULT_AUDIO_FORMAT)
+        self.audio_format_var.set(fmt)
+        self._refresh_audio_quality_values()
+        self._save_settings_debounced()
+
+    def _on_audio_only_toggle(self, init: bool = False):
+        only_audio = bool(self.audio_only_var.get())
+        state_main = "disabled" if only_audio else "readonly"
+        for widget in [self.quality_cb, self.vcodec_cb, self.acodec_cb, self.container_cb]:
+            try:
+                widget.configure(state=state_main)
+            except Exception:
+                pass
+        audio_state = "readonly" if only_audio else "disabled"
+        try:
+            self.audio_format_cb.configure(state=audio_state)
+        except Exception:
+            pass
+        if only_audio:
+            self._refresh_audio_quality_values()
+        if self.audio_quality_cb:
+            try:
+                if audio_state == "disabled":
+                    self.audio_quality_cb.configure(state="disabled")
+                elif self.audio_quality_cb.cget("state") == "disabled":
+                    self.audio_quality_cb.configure(state="readonly")
+            except Exception:
+                pass
+        if not init:
+            self._save_settings_debounced()
+
+    def _on_subtitle_option_changed(self, init: bool = False):
+        if not self.write_subs_var.get():
+            self.embed_subs_var.set(0)
+        state = "normal" if self.write_subs_var.get() else "disabled"
+        if hasattr(self, 'embed_subs_check'):
+            self.embed_subs_check.configure(state=state)
+        if hasattr(self, 'subtitle_select_btn'):
+            self.subtitle_select_btn.configure(state=state)
+        if not init:
+            self._save_settings_debounced()
+
+    def _update_subtitle_display(self):
+        if not hasattr(self, "subtitle_display_var"):
+            return
+        if self.selected_subtitle_langs:
+            self.subtitle_display_var.set(", ".join(sorted(self.selected_subtitle_langs)))
+        else:
+            self.subtitle_display_var.set("Не выбрано")
+
+    def _open_subtitle_selector(self):
+        if not self.available_subtitle_languages:
+            messagebox.showinfo(
+                "Субтитры",
+                "Список доступных субтитров пока неизвестен. Нажмите «Анализировать» для получения метаданных.",
+            )
+            return
+
+        win = tk.Toplevel(self)
+        win.title("Выбор субтитров")
+        win.transient(self)
+        win.grab_set()
+        pad = 10
+
+        frame = ttk.Frame(win, padding=pad)
+        frame.pack(fill="both", expand=True)
+
+        ttk.Label(frame, text="Выберите языки субтитров (можно несколько):").pack(anchor="w", pady=(0, 5))
+
+        listbox = tk.Listbox(frame, selectmode="multiple", height=10)
+        scrollbar = ttk.Scrollbar(frame, orient="vertical", command=listbox.yview)
+        listbox.configure(yscrollcommand=scrollbar.set)
+        listbox.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+        for idx, lang in enumerate(sorted(self.available_subtitle_languages)):
+            listbox.insert("end", lang)
+            if lang in self.selected_subtitle_langs:
+                listbox.selection_set(idx)
+
+        btns = ttk.Frame(frame)
+        btns.pack(fill="x", expand=False, pady=(pad, 0))
+
+        def on_ok():
+            selections = [listbox.get(i) for i in listbox.curselection()]
+            self.selected_subtitle_langs = selections
+            self._update_subtitle_display()
+            self._save_settings_debounced()
+            win.destroy()
+
+        ttk.Button(btns, text="Отмена", command=win.destroy).pack(side="right")
+        ttk.Button(btns, text="Сохранить", style="Accent.TButton", command=on_ok).pack(side="right", padx=(0, 5))
+
+    def _flatten_info_entries(self, info: dict) -> List[dict]:
+        if not isinstance(info, dict):
+            return []
+        if info.get("_type") in ("playlist", "multi_video") and info.get("entries"):
+            entries = []
+            for entry in info.get("entries", []):
+                if isinstance(entry, dict):
+                    entries.append(entry)
+            return entries or [info]
+        return [info]
+
+    def _update_languages_from_info(self, info: dict):
+        entries = self._flatten_info_entries(info)
+        audio_langs = set()
+        subtitle_langs = set(self.available_subtitle_languages)
+
+        for entry in entries:
+            for fmt in entry.get("formats", []) or []:
+                raw_values = []
+                for key in ("language", "language_code", "language_original", "audio_lang"):
+                    value = fmt.get(key)
+                    if not value:
+                        continue
+                    if isinstance(value, (list, tuple, set)):
+                        raw_values.extend(value)
+                    else:
+                        raw_values.append(value)
+
+                pref_value = fmt.get("language_preference")
+                if isinstance(pref_value, str):
+                    raw_values.append(pref_value)
+
+                for candidate in raw_values:
+                    if candidate is None:
+                        continue
+                    if isinstance(candidate, (int, float)):
+                        continue
+                    normalized = str(candidate).strip()
+                    if not normalized:
+                        continue
+                    normalized = normalized.replace("_", "-").lower()
+                    if "-" in normalized:
+                        normalized = normalized.split("-", 1)[0]
+                    if normalized and normalized not in {"und", "none"}:
+                        audio_langs.add(normalized)
+            subtitles = entry.get("subtitles") or {}
+            for lang_code in subtitles.keys():
+                if lang_code is None:
+                    continue
+                normalized_code = str(lang_code).strip()
+                if normalized_code:
+                    subtitle_langs.add(normalized_code)
+
+        if audio_langs:
+            others = sorted({l for l in audio_langs if l.lower() not in ("", "und", "none", "orig")})
+            normalized = ["orig"] + others
+            self.available_audio_languages = normalized
+            current = self.alang_var.get()
+            self.alang_cb.configure(values=normalized)
+            if current not in normalized:
+                self.alang_var.set("orig")
+
+        self.available_subtitle_languages = sorted(subtitle_langs)
+        self.selected_subtitle_langs = [lang for lang in self.selected_subtitle_langs if lang in self.available_subtitle_languages]
+        self._update_subtitle_display()
+
+        langs_preview = ", ".join(self.available_audio_languages[:6])
+        subs_preview = ", ".join(self.available_subtitle_languages[:6]) or "—"
+        self._append_log(f"Анализ завершён. Аудиодорожки: {langs_preview or '—'} | Субтитры: {subs_preview}")
+        self._set_analyze_state(
+            "done",
+            f"Найдено аудио: {len(self.available_audio_languages)} | субтитры: {len(self.available_subtitle_languages)}",
+        )
+
+    def _set_analyze_state(self, state: str, message: str = ""):
+        """Только из потока UI (рабочие потоки — через _ui_call)."""
+        if not hasattr(self, "analyze_btn"):
+            return
+        try:
+            if state == "running":
+                self.analyze_btn.configure(state="disabled", text="Анализ…")
+                self.analyze_status_var.set(message or "Получаем данные…")
+            elif state == "done":
+                self.analyze_btn.configure(state="normal", text="Анализировать")
+                self.analyze_status_var.set(message)
+            elif state == "error":
+                self.analyze_btn.configure(state="normal", text="Анализировать")
+                self.analyze_status_var.set(message or "Не удалось получить метаданные")
+            else:
+                self.analyze_btn.configure(state="normal", text="Анализировать")
+                self.analyze_status_var.set(message)
+        except Exception:
+            pass
+
+    def _on_fetch_metadata_clicked(self):
+        url = (self.url_var.get() or "").strip()
+        if not url:
+            messagebox.showwarning("Введите ссылку", "Пожалуйста, вставьте ссылку для анализа.")
+            return
+        if self._metadata_fetching:
+            return
+        self._metadata_fetching = True
+        self._set_analyze_state("running")
+        self._append_log("Анализируем ссылку через yt-dlp...")
+        # Tk-переменные читаем здесь, в потоке UI; рабочему потоку — готовые значения
+        playlist = bool(self.playlist_var.get())
+        cookies = (self.cookies_var.get() or "").strip()
+        threading.Thread(target=self._fetch_metadata_worker, args=(url, playlist, cookies), daemon=True).start()
+
+    def _fetch_metadata_worker(self, url: str, playlist: bool, cookies: str):
+        opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "skip_download": True,
+        }
+        if not playlist:
+            opts["noplaylist"] = True
+        if cookies:
+            opts["cookiefile"] = cookies
+        noplaylist = bool(opts.get("noplaylist"))
+        try:
+            if not noplaylist and not MetadataCache.video_key(url, False).startswith("youtube:"):
+                # языки/форматы плейлиста — по первому видео; весь плейлист не извлекаем
+                first = (self.engine.probe_playlist(url, cookies or None).get("entries") or [None])[0]
+                if not first:
+                    raise RuntimeError("в плейлисте нет видео")
+                url = first.get("url") or first.get("webpage_url")
+                self._append_log(f"Плейлист: анализируем первое видео — {first.get('title') or url}")
+                opts["noplaylist"] = noplaylist = True
+            info = self.metadata_cache.get(url, cookies or None, noplaylist)
+            if info is not None:
+                self._append_log("Метаданные взяты из кэша.")
+            else:
+                with self.engine.new_ydl(opts) as ydl, self.engine.hosts.slot(url, "meta"):
+                    info = ydl.extract_info(url, download=False)
+                self.metadata_cache.put(url, cookies or None, noplaylist, info)
+            self._append_log(self.metadata_cache.stats_line())
+            self._ui_call(lambda: self._update_languages_from_info(info))
+        except Exception as e:
+            msg = f"Не удалось получить метаданные: {e}"
+            self._append_log(msg)
+
+            def show_error():
+                self._set_analyze_state("error", "Ошибка при анализе")
+                messagebox.showerror("Анализ", msg)
+
+            self._ui_call(show_error)
+        finally:
+            self._ui_call(lambda: setattr(self, "_metadata_fetching", False))
+
+    # ------------------------ Помощники UI ------------------------
+
+    def _on_ytdlp_loaded(self, version: Optional[str], error: Optional[BaseException]):
+        """Из потока импорта (окно может быть ещё не построено — всё через кадр UI)."""
+        if error is None:
+            self._ui_call(lambda: self.ydl_version_var.set(f"yt-dlp {version}"))
+            return
+        msg = ytdlp_missing_message(error)
+
+        def show():
+            self.ydl_version_var.set("yt-dlp не установлен")
+            self._append_log(msg)
+            messagebox.showerror("yt-dlp не найден", msg)
+        self._ui_call(show)
+
+    def _check_ffmpeg(self):
+        if shutil.which("ffmpeg") is None:
+            self._append_log("⚠ ffmpeg не найден. Для объединения видео и аудио его необходимо установить и добавить в PATH.")
+            self._append_log("   Рекомендуем установить ffmpeg с официального сайта или через пакетный менеджер.")
+
+    def _paste_from_clipboard(self):
         try:
-            status = d.get("status")
-            pp = d.get("postprocessor") or d.get("postprocessor_name") or "postprocessor"
-            if status == "started":
-                self._append_log(f"Пост-обработка: {pp} — старт.")
-            elif status == "finished":
-                info_dict = d.get("info_dict") or {}
-                final_name = info_dict.get("__final_filename") or info_dict.get("filepath")
-                ext = info_dict.get("ext")
-                if final_name:
-                    self._append_log(f"Пост-обработка завершена. Итоговый файл: {os.path.basename(final_name)}")
-                if ext:
-                    self._append_log(f"Итоговый контейнер: {str(ext).upper()}")
-            elif status == "error":
-                self._append_log(f"[ОШИБКА пост-обработки] {pp}")
+            text = self.clipboard_get()
+            self.url_var.set(text.strip())
         except Exception:
             pass
 
-    def _run_single_download(self, url: str, preset: DownloadPreset, queue_item: Optional[QueueItem]) -> str:
-        self._current_title = None
-        self._last_raw_line_ts = 0.0
-        self._last_raw_percent = -1.0
-
-        height = preset.height
-        vch_gui = preset.vcodec_choice
-        ach_gui = preset.acodec_choice
-        c_gui = preset.container_choice
+    def _choose_outdir(self):
+        path = filedialog.askdirectory(title="Выберите папку для сохранения", initialdir=self.outdir_var.get() or os.path.expanduser("~"))
+        if path:
+            self.outdir_var.set(path)
 
-        vch = self._norm_vcodec_choice(vch_gui)
-        ach = self._norm_acodec_choice(ach_gui)
-        container_choice = self._norm_container_choice(c_gui)
-        # --- Режим: только аудио ---
-        if getattr(preset, 'audio_only', False):
-            fmt_candidates = []
-            lang = (preset.alang_choice or '').lower()
-            if lang and lang != 'orig':
-                fmt_candidates.append(f"bestaudio[language^={lang}]")
-            fmt_candidates.append('bestaudio')
-            fmt = '/'.join(fmt_candidates)
+    def _choose_cookies(self):
+        path = filedialog.askopenfilename(
+            title="Выберите cookies.txt (Netscape формат)",
+            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")],
+        )
+        if path:
+            self.cookies_var.set(path)
 
-            fmt_info = AUDIO_FORMAT_OPTIONS.get(preset.audio_format, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
-            codec = fmt_info['codec']
-            extension = fmt_info.get('extension', codec)
-            bitrate_values = fmt_info.get('bitrate_values') or []
-            quality = preset.audio_quality or DEFAULT_AUDIO_QUALITY
-            quality_txt = f"{quality} kbps" if bitrate_values else "без сжатия"
+    def _append_log(self, msg: str):
+        if not isinstance(msg, str):
+            msg = str(msg)
+        timestamp = time.strftime("%H:%M:%S")
+        full = f"[{timestamp}] {msg}"
+        self.log_sink.write(self.log_main_text, full)
 
-            self._append_log(
-                f"Режим: только аудио {fmt_info['label']} | Язык аудио: {preset.alang_choice} | "
-                f"Качество: {quality_txt}"
+    def _append_raw(self, msg: str):
+        if not isinstance(msg, str):
+            msg = str(msg)
+        self.log_sink.write(self.log_raw_text, msg)
+
+    def _on_log_flush(self, sink: TkLogSink):
+        """Показываем число потерянных строк в заголовке подробного лога (только при изменении)."""
+        if sink.dropped != self._log_dropped_shown:
+            self._log_dropped_shown = sink.dropped
+            self._raw_log_frame.configure(
+                text=f"Подробный лог (yt-dlp) — пропущено строк: {sink.dropped}, склеено: {sink.coalesced}"
             )
 
-            outtmpl = self._build_outtmpl_simple(preset.outtmpl_user, preset.outdir)
-            logger = TkLogger(self.log_main_text, self.log_raw_text)
-            postprocessors = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': codec,
-            }]
-            if bitrate_values:
-                postprocessors[0]['preferredquality'] = str(quality)
+    def _set_status(self, text: str):
+        # зовётся и из рабочих потоков — в StringVar попадёт на ближайшем кадре _sample_progress
+        self.progress_channel.publish("status", text)
 
-            run_opts = {
-                'format': fmt,
-                'noplaylist': not getattr(preset, 'download_playlist', False),
-                'outtmpl': outtmpl,
-                'logger': logger,
-                'concurrent_fragment_downloads': 5,
-                'continuedl': True,
-                'overwrites': False,
-                'restrictfilenames': False,
-                'windowsfilenames': True,
-                'quiet': False,
-                'no_warnings': False,
-                'postprocessor_hooks': [self._postprocessor_hook],
-                'postprocessors': postprocessors,
-            }
-            if preset.cookies:
-                run_opts['cookiefile'] = preset.cookies
-            try:
-                self._set_status('Скачивание аудио...')
-                with YoutubeDL(run_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    try:
-                        if 'requested_downloads' in info and info['requested_downloads']:
-                            self.last_output_path = info['requested_downloads'][0].get('filepath')
-                            if queue_item:
-                                queue_item.result_path = self.last_output_path
-                    except Exception:
-                        pass
-                    title_final = info.get('title') or self._current_title
-                    video_id = info.get('id')
-                    a_short = codec
-                    v_short = 'audio'
-                    final_ext = extension
-                    self._extra_status_suffix = f"A:{a_short.upper()} → {final_ext.upper()}"
-                    is_playlist = info.get('_type') in ('playlist', 'multi_video') or bool(info.get('entries'))
-                    if not is_playlist:
-                        self._auto_rename_result(self.last_output_path, v_short, a_short, None, final_ext,
-                                                 title_hint=title_final, video_id_hint=video_id)
-                    else:
-                        self._append_log("Плейлист: используется шаблон имён yt-dlp для каждого трека.")
-                self.progress.after(0, lambda: self.progress.configure(value=100))
-                self._set_status('Готово ✅')
-                self._append_log('Загрузка аудио завершена.')
-                if queue_item:
-                    queue_item.status = 'Готово'
-                    self._queue_update_status(queue_item, 'Готово')
-                return 'success'
-            except KeyboardInterrupt:
-                self._set_status('Загрузка отменена.')
-                self._append_log('Загрузка отменена пользователем.')
-                if queue_item:
-                    queue_item.status = 'Отменено'
-                    self._queue_update_status(queue_item, 'Отменено')
-                return 'cancel'
-            except Exception as e:
-                self._set_status('Ошибка.')
-                self._append_log(f'Ошибка загрузки аудио: {e}')
-                if queue_item:
-                    queue_item.status = 'Ошибка'
-                    self._queue_update_status(queue_item, 'Ошибка')
-                self.after(0, lambda: messagebox.showerror('Ошибка загрузки', f"{e}"))
-                return 'error'
+    def _ui_call(self, fn: Callable[[], None]):
+        self.progress_channel.call_soon(fn)
 
+    def _sample_progress(self):
+        """Кадр UI: применить всё, что рабочие потоки опубликовали с прошлого кадра."""
+        try:
+            latest, items, calls = self.progress_channel.take()
+            for item in items:
+                self.queue_view.invalidate(item)
+            if "queue_summary" in latest or (items and self.queue_running):
+                self._apply_queue_summary()
+            if "status" in latest:
+                self.status_var.set(latest["status"])
+            if "progress" in latest:
+                self.progress.configure(value=latest["progress"])
+            if "probe_status" in latest:
+                self.probe_status_var.set(latest["probe_status"])
+            for fn in calls:
+                fn()
+        finally:
+            self.after(PROGRESS_SAMPLE_MS, self._sample_progress)
 
-        eff_v, eff_a, warn = self._resolve_codecs_for_container(vch, ach, container_choice)
-        if warn:
-            self._append_log(warn)
+    def _queue_workers_count(self) -> int:
+        try:
+            n = int(self.queue_workers_var.get())
+        except Exception:
+            n = DEFAULT_QUEUE_WORKERS
+        return max(1, min(MAX_QUEUE_WORKERS, n))
+
+    def _refresh_queue_summary(self):
+        self.progress_channel.publish("queue_summary")
+
+    def _apply_queue_summary(self):
+        """Общий прогресс очереди: готовые задачи + доли активных (без обхода всей очереди — каждый кадр)."""
+        total = max(self._queue_run_total, 1)
+        with self._active_lock:
+            active = list(self._active_items.values())
+        remaining = len(self.queue)
+        done = max(0, self._queue_run_total - remaining)
+        partial = sum(it.progress for it in active) / 100.0
+        percent = min(100.0, (done + partial) / total * 100.0)
+        text = f"Очередь: в работе {len(active)} | выполнено {done}/{self._queue_run_total} | осталось {remaining}"
+        if active:
+            text += " | " + self.engine.telemetry.summary_line()
+        self.progress.configure(value=percent)
+        self.status_var.set(text)
 
+    def _desired_height(self) -> int:
+        return QUALITY_HEIGHTS.get(self.quality_var.get(), 1080)
 
-        fmt = self._format_selector(height, eff_v if eff_v != "auto" else "auto", eff_a if eff_a != "auto" else "auto", preset.alang_choice)
-        self._append_log(
-            f"Целевое качество: до {height}p | Видеокодек: {('Авто' if eff_v=='auto' else eff_v.upper())} | "
-            f"Аудиокодек: {('Авто' if eff_a=='auto' else eff_a.upper())} | Аудиоязык: {preset.alang_choice} | "
-            f"Контейнер: {('Авто' if container_choice=='auto' else container_choice)}"
-        )
-        self._append_log(f"Формат выбора (yt-dlp): {fmt}")
-        if preset.cookies:
-            self._append_log(f"Используется cookie-файл: {preset.cookies}")
+    # ------------------------ События кнопок ------------------------
 
-        outtmpl = self._build_outtmpl_simple(preset.outtmpl_user, preset.outdir)
+    def _url_from_clipboard_if_url(self) -> Optional[str]:
+        try:
+            clip = (self.clipboard_get() or "").strip()
+        except Exception:
+            return None
+        if clip.lower().startswith(("http://", "https://")):
+            return clip
+        if "youtu" in clip and (clip.startswith("www.") or clip.startswith("youtu")):
+            return "https://" + clip if not clip.startswith("http") else clip
+        return None
 
-        logger = TkLogger(self.log_main_text, self.log_raw_text)
+    def _on_download_clicked(self):
+        url = (self.url_var.get() or "").strip()
+        if not url:
+            clip_url = self._url_from_clipboard_if_url()
+            if clip_url:
+                self.url_var.set(clip_url)
+                url = clip_url
+                self._append_log("Ссылка взята из буфера обмена.")
+        if not url:
+            messagebox.showwarning("Введите ссылку", "Пожалуйста, вставьте ссылку на видео YouTube.")
+            return
 
-        base_opts = {
-            "format": fmt,
-            "noplaylist": not getattr(preset, 'download_playlist', False),
-            "outtmpl": outtmpl,
-            "logger": logger,
-            "concurrent_fragment_downloads": 5,
-            "continuedl": True,
-            "overwrites": False,
-            "restrictfilenames": False,
-            "windowsfilenames": True,
-            "quiet": False,
-            "no_warnings": False,
-            "postprocessor_hooks": [self._postprocessor_hook],
-        }
-        if preset.cookies:
-            base_opts["cookiefile"] = preset.cookies
+        preset = self._collect_preset()
+        if not preset:
+            return
 
-        if getattr(preset, 'write_subtitles', False):
-            base_opts["writesubtitles"] = True
-            if getattr(preset, 'subtitle_langs', None):
-                base_opts["subtitleslangs"] = list(preset.subtitle_langs)
-        if getattr(preset, 'embed_subtitles', False) and getattr(preset, 'write_subtitles', False):
-            base_opts["embedsubtitles"] = True
+        os.makedirs(preset.outdir, exist_ok=True)
 
-        if container_choice != "auto":
-            base_opts["merge_output_format"] = container_choice
-            # remux для принудительного контейнера
-            base_opts["postprocessors"] = [{"key": "FFmpegVideoRemuxer", "preferedformat": container_choice}]
+        self.cancel_event.clear()
+        self.progress["value"] = 0
+        self._set_status("Подготовка...")
+        self._append_log("Запуск загрузки (одиночная)...")
+        self._toggle_controls(downloading=True, queue_mode=False)
 
-        # ---------- ПРОБА ----------
-        try:
-            probe_opts = dict(base_opts)
-            with YoutubeDL(probe_opts) as ydl_probe:
-                info_probe = ydl_probe.extract_info(url, download=False)
+        self.download_thread = threading.Thread(target=self._run_single_download_thread, args=(url, preset, None), daemon=True)
+        self.download_thread.start()
 
-            title = info_probe.get("title") or "Без названия"
-            ch = info_probe.get("channel") or info_probe.get("uploader") or "?"
-            dur = seconds_to_hms(info_probe.get("duration"))
-            vid = info_probe.get("id") or "?"
-            self._current_title = title
-            self._append_log(f"▶ Сейчас скачиваем: «{self._ellipsize(title, MAX_UI_TITLE)}» [{vid}] | канал: {ch} | длительность: {dur}")
+    def _on_cancel_clicked(self):
+        if (self.download_thread and self.download_thread.is_alive()) or (self.queue_thread and self.queue_thread.is_alive()):
+            self.cancel_event.set()
+            self._append_log("Запрошена отмена. Дождитесь завершения текущей операции...")
 
-            self.after(0, lambda info=info_probe: self._update_languages_from_info(info))
+    def _on_add_to_queue(self):
+        clip_url = self._url_from_clipboard_if_url()
+        if clip_url:
+            self.url_var.set(clip_url)
+        url = (self.url_var.get() or "").strip()
 
-            if queue_item and not queue_item.title:
-                queue_item.title = title
-                try:
-                    self._queue_set_title_cell(queue_item)
-                except Exception:
-                    pass
+        if not url:
+            messagebox.showwarning("Введите ссылку", "Скопируйте ссылку в буфер обмена или вставьте её вручную.")
+            return
 
-            vfmt, afmt = self._extract_selected_formats(info_probe)
-            if vfmt:
-                self._append_log(self._format_summary_line(vfmt, "video"))
-            if afmt:
-                self._append_log(self._format_summary_line(afmt, "audio"))
-            if not vfmt and not afmt:
-                self._append_log("Не удалось определить выбранные форматы заранее (yt-dlp). Продолжаем загрузку...")
-
-            final_ext_guess = self._guess_final_ext(vfmt, afmt, container_choice)
-            mode = "принудительно" if container_choice != "auto" else "авто"
-            self._append_log(f"Итоговый контейнер (ожидаемо): {final_ext_guess.upper()} ({mode})")
-
-            vshort = self._short_vcodec((vfmt or {}).get("vcodec"))
-            ashort = self._short_acodec((afmt or {}).get("acodec"))
-            self._extra_status_suffix = f"V:{vshort} A:{ashort} → {final_ext_guess.upper()}"
-        except Exception as e_probe:
-            self._extra_status_suffix = ""
-            self._append_log(f"Не удалось заранее определить форматы: {e_probe}")
+        preset = self._collect_preset()
+        if not preset:
+            return
+        os.makedirs(preset.outdir, exist_ok=True)
 
-        hooks = [self._progress_hook_factory(queue_item=queue_item)]
-        run_opts = dict(base_opts)
-        run_opts["progress_hooks"] = hooks
+        self._queue_add_items([QueueItem(url=url, preset=preset)])
+        self._append_log(f"Добавлено в очередь: {url}")
+        self._save_settings_debounced()
 
-        # ---------- Попытка №1 ----------
-        try:
-            self._set_status("Скачивание...")
-            with YoutubeDL(run_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
+    def _on_load_txt_to_queue(self):
+        path = filedialog.askopenfilename(
+            title="Выберите .txt со ссылками (по одной на строку)",
+            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")],
+        )
+        if not path:
+            return
+        preset = self._collect_preset()
+        if not preset:
+            return
+        items = [QueueItem(url=url, preset=preset) for url in read_links_file(path)]
+        self._queue_add_items(items)
+        self._append_log(f"Из файла добавлено ссылок: {len(items)}")
+        self._save_settings_debounced()
 
-                try:
-                    if "requested_downloads" in info and info["requested_downloads"]:
-                        self.last_output_path = info["requested_downloads"][0].get("filepath")
-                        if queue_item:
-                            queue_item.result_path = self.last_output_path
-                except Exception:
-                    pass
+    def _on_start_queue(self):
+        if self.queue_running:
+            messagebox.showinfo("Очередь", "Очередь уже выполняется.")
+            return
+        if not self.queue:
+            messagebox.showwarning("Очередь пуста", "Добавьте ссылки в очередь.")
+            return
 
-                vcodec_final, acodec_final = self._extract_final_codecs(info)
-                v_short = self._short_vcodec(vcodec_final)
-                a_short = self._short_acodec(acodec_final)
-                height_final = self._extract_final_height(info)
+        self.cancel_event.clear()
+        self.queue_running = True
+        self._set_status("Старт очереди...")
+        self._append_log("Старт очереди загрузок.")
+        self._toggle_controls(downloading=True, queue_mode=True)
 
-                if run_opts.get("merge_output_format"):
-                    final_ext = run_opts["merge_output_format"]
-                else:
-                    final_ext = (info.get("ext") or "").lower() or "mkv"
+        self.queue_thread = threading.Thread(target=self._run_queue, daemon=True)
+        self.queue_thread.start()
+
+    def _on_clear_queue(self):
+        if self.queue_running:
+            messagebox.showwarning("Нельзя очистить", "Сначала остановите/дождитесь выполнения очереди.")
+            return
+        self.queue.clear()
+        if self.queue_store:
+            self.queue_store.clear()
+        self._probe_pool.clear()
+        self.queue_view.invalidate()
+        self._append_log("Очередь очищена.")
+
+    # -------- Обновление yt-dlp --------
+
+    def _on_update_yt_dlp(self):
+        if self.queue_running or (self.download_thread and self.download_thread.is_alive()):
+            messagebox.showinfo("Занято", "Сначала завершите текущую загрузку или очередь.")
+            return
+        if self._updating:
+            return
+        self._updating = True
+        self._append_log("Проверка и обновление yt-dlp через pip…")
+        self._set_status("Обновление yt-dlp...")
+        self._toggle_controls(downloading=True, queue_mode=False)
+        threading.Thread(target=self._update_yt_dlp_worker, daemon=True).start()
+
+    def _run_pip_and_stream(self, cmd: list) -> int:
+        self._append_log(f"→ Запуск: {' '.join(cmd)}")
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        except Exception as e:
+            self._append_log(f"[pip] не удалось запустить: {e}")
+            return -1
+        try:
+            assert proc.stdout is not None
+            for line in proc.stdout:
+                self._append_log(f"[pip] {line.rstrip()}")
+        except Exception:
+            pass
+        return proc.wait()
+
+    def _update_yt_dlp_worker(self):
+        try:
+            cmd1 = [sys.executable, "-m", "pip", "install", "-U", "yt-dlp"]
+            rc = self._run_pip_and_stream(cmd1)
 
-                self._extra_status_suffix = f"V:{v_short} A:{a_short} → {str(final_ext).upper()}"
+            if rc != 0:
+                self._append_log("Обычное обновление не удалось. Пробуем с флагом --user…")
+                cmd2 = [sys.executable, "-m", "pip", "install", "-U", "--user", "yt-dlp"]
+                rc = self._run_pip_and_stream(cmd2)
 
-                title_final = info.get("title") or self._current_title
-                video_id = info.get("id")
-                is_playlist = info.get('_type') in ('playlist', 'multi_video') or bool(info.get('entries'))
-                if not is_playlist:
-                    self._auto_rename_result(
-                        self.last_output_path,
-                        v_short,
-                        a_short,
-                        height_final,
-                        final_ext,
-                        title_hint=title_final,
-                        video_id_hint=video_id,
-                    )
-                else:
-                    self._append_log("Плейлист: автоматическое переименование отключено, используется шаблон yt-dlp.")
+            if rc == 0:
+                try:
+                    import yt_dlp as _ydl_mod
+                    importlib.reload(_ydl_mod.version)
+                    importlib.reload(_ydl_mod)
+                    global YoutubeDL, yt_dlp
+                    YoutubeDL = _ydl_mod.YoutubeDL
+                    yt_dlp = _ydl_mod
+                    new_ver = ytdlp_version(yt_dlp)
+                    self._append_log(f"✅ yt-dlp успешно обновлён до версии {new_ver}.")
+                    self._ui_call(lambda: self.ydl_version_var.set(f"yt-dlp {new_ver}"))
+                except Exception as e:
+                    self._append_log(f"yt-dlp обновлён, но не удалось перезагрузить модуль в памяти: {e}")
+                    self._append_log("Совет: перезапустите приложение, чтобы использовать новую версию.")
+                finally:
+                    self._set_status("Обновление завершено ✅")
+            else:
+                self._append_log("❌ Не удалось обновить yt-dlp. Проверьте соединение и права.")
+                self._set_status("Ошибка обновления yt-dlp.")
+                self._ui_call(lambda: messagebox.showerror("Обновление yt-dlp", "Не удалось обновить yt-dlp. Попробуйте вручную в терминале:\n\npip install -U yt-dlp\n\nили\n\npip install -U --user yt-dlp"))
+        finally:
+            self._updating = False
+            self._ui_call(lambda: self._toggle_controls(downloading=False, queue_mode=False))
 
-            self.progress.after(0, lambda: self.progress.configure(value=100))
-            self._set_status("Готово ✅")
-            self._append_log("Загрузка завершена.")
-            if queue_item:
-                queue_item.status = "Готово"
-                self._queue_update_status(queue_item, "Готово")
-            return "success"
-        except KeyboardInterrupt:
-            self._set_status("Загрузка отменена.")
-            self._append_log("Загрузка отменена пользователем.")
-            if queue_item:
-                queue_item.status = "Отменено"
-                self._queue_update_status(queue_item, "Отменено")
-            return "cancel"
-        except Exception as e1:
-            self._append_log(f"Ошибка/не удалось собрать указанный контейнер: {e1}")
-            if self.cancel_event.is_set():
-                self._set_status("Загрузка отменена.")
-                if queue_item:
-                    queue_item.status = "Отменено"
-                    self._queue_update_status(queue_item, "Отменено")
-                return "cancel"
+    # ------------------------ Очередь ------------------------
 
-        # ---------- Попытка №2 — резерв MKV ----------
+    def _open_queue_store(self):
         try:
-            fallback_container = "mkv"
-            fallback_opts = dict(run_opts)
-            fallback_opts["merge_output_format"] = fallback_container
-            fallback_opts["postprocessors"] = [{"key": "FFmpegVideoRemuxer", "preferedformat": fallback_container}]
-            self._append_log("Пробуем собрать в MKV как резервный вариант...")
-            with YoutubeDL(fallback_opts) as ydl2:
-                info2 = ydl2.extract_info(url, download=True)
-                try:
-                    if "requested_downloads" in info2 and info2["requested_downloads"]:
-                        self.last_output_path = info2["requested_downloads"][0].get("filepath")
-                        if queue_item:
-                            queue_item.result_path = self.last_output_path
-                except Exception:
-                    pass
+            self.queue_store = QueueStore(QUEUE_DB_PATH)
+            items = self.queue_store.load()
+        except sqlite3.Error as e:
+            self.queue_store = None
+            self._append_log(f"Очередь на диске недоступна (работаем только в памяти): {e}")
+            return
+        if not items:
+            return
+        self.queue.extend(items)
+        self.queue_view.invalidate()
+        for item in items:
+            if not item.title and not self.engine.mark_if_archived(item):
+                self._probe_title_async(item)
+        self._append_log(f"Восстановлена очередь прошлого сеанса: {len(items)} задач(и).")
+
+    def _queue_add_items(self, items: List[QueueItem], probe: bool = True):
+        """Добавить задачи в очередь: сначала на диск (одной транзакцией), затем в память и таблицу."""
+        archived = sum(1 for it in items if self.engine.mark_if_archived(it))
+        if archived:
+            self._append_log(f"Уже скачано ранее (будет пропущено): {archived}")
+        if self.queue_store:
+            try:
+                self.queue_store.add_many(items)
+            except sqlite3.Error as e:
+                self._append_log(f"Не удалось сохранить очередь на диск: {e}")
+        self.queue.extend(items)
+        self.queue_view.invalidate()
+        if not probe:
+            return
+        for item in items:
+            if item.status != "Уже скачано":
+                self._probe_title_async(item)
 
-                vcodec_final, acodec_final = self._extract_final_codecs(info2)
-                v_short = self._short_vcodec(vcodec_final)
-                a_short = self._short_acodec(acodec_final)
-                height_final = self._extract_final_height(info2)
-                self._extra_status_suffix = f"V:{v_short} A:{a_short} → MKV"
+    def _apply_bandwidth_settings(self, quiet: bool = False):
+        """Лимит и расписание из полей → в BandwidthGovernor (идущие загрузки подхватят сразу)."""
+        try:
+            rate = parse_rate(self.rate_limit_var.get())
+            item_rate = parse_rate(self.rate_limit_item_var.get())
+            windows = parse_schedule(self.rate_schedule_var.get())
+        except ValueError as e:
+            if not quiet:
+                messagebox.showwarning("Лимит скорости", str(e))
+            return
+        self.engine.governor.set_rate(rate)
+        self.engine.governor.set_download_rate(item_rate)
+        self.engine.governor.set_schedule(windows)
+        self._refresh_bandwidth_status(log=not quiet)
+        self._save_settings_debounced()
 
-                title_final = info2.get("title") or self._current_title
-                video_id = info2.get("id")
-                is_playlist = info2.get('_type') in ('playlist', 'multi_video') or bool(info2.get('entries'))
-                if not is_playlist:
-                    self._auto_rename_result(
-                        self.last_output_path,
-                        v_short,
-                        a_short,
-                        height_final,
-                        "mkv",
-                        title_hint=title_final,
-                        video_id_hint=video_id,
-                    )
-                else:
-                    self._append_log("Плейлист: автоматическое переименование отключено, используется шаблон yt-dlp.")
+    def _refresh_bandwidth_status(self, log: bool = False):
+        text = "Сейчас: " + self.engine.governor.describe()
+        if text != self.bw_status_var.get():
+            if log or self.bw_status_var.get():
+                self._append_log(f"Лимит скорости — {text.lower()}")
+            self.bw_status_var.set(text)
+
+    def _bandwidth_tick(self):
+        # окна расписания сменяются сами; раз в полминуты обновляем подпись (и пишем в лог о смене)
+        self._refresh_bandwidth_status()
+        self.after(30000, self._bandwidth_tick)
+
+    def _hosts_tick(self):
+        text = self.engine.hosts.describe()
+        if text and text != self.hosts_status_var.get():
+            self.hosts_status_var.set(text)
+        self.after(HOST_STATUS_REFRESH_MS, self._hosts_tick)
+
+    def _on_redownload_toggle(self):
+        self.engine.redownload_if_preset_differs = bool(self.redownload_var.get())
+        self._save_settings_debounced()
 
-            self.progress.after(0, lambda: self.progress.configure(value=100))
-            self._set_status("Готово ✅ (MKV)")
-            self._append_log("Загрузка завершена (mkv).")
-            if queue_item:
-                queue_item.status = "Готово (mkv)"
-                self._queue_update_status(queue_item, "Готово (mkv)")
-            return "success"
-        except KeyboardInterrupt:
-            self._set_status("Загрузка отменена.")
-            self._append_log("Загрузка отменена пользователем.")
-            if queue_item:
-                queue_item.status = "Отменено"
-                self._queue_update_status(queue_item, "Отменено")
-            return "cancel"
-        except Exception as e2:
-            self._set_status("Ошибка.")
-            self._append_log(f"Ошибка загрузки: {e2}")
-            if queue_item:
-                queue_item.status = "Ошибка"
-                self._queue_update_status(queue_item, "Ошибка")
-            self.after(0, lambda: messagebox.showerror("Ошибка загрузки", f"{e2}"))
-            return "error"
-        finally:
-            self._current_title = None
+    def _on_subscribe(self):
+        if not self.engine.subscriptions:
+            messagebox.showwarning("Подписки", "Хранилище подписок недоступно.")
+            return
+        url = (self.url_var.get() or "").strip()
+        if not url:
+            messagebox.showwarning("Введите ссылку", "Вставьте ссылку на канал или плейлист.")
+            return
+        preset = self._collect_preset()
+        if not preset:
+            return
+        backfill = messagebox.askyesno("Подписка", "Скачать и уже вышедшие видео?\n\n"
+                                                   "«Нет» — только те, что появятся после этой проверки.")
+        sub = self.engine.subscriptions.add(url, preset, backfill=backfill)
+        self._append_log(f"Подписка #{sub.id}: {url} — проверяется кнопкой «Проверить подписки» "
+                         f"или в фоновом режиме (--daemon --sync-every).")
+
+    def _on_sync_subscriptions(self):
+        if not self.engine.subscriptions:
+            messagebox.showwarning("Подписки", "Хранилище подписок недоступно.")
+            return
+        self.sync_subs_btn.configure(state="disabled")
 
-    # ---- Асинхронная «проба» для названия в очереди ----
-    def _probe_title_async(self, item: QueueItem):
         def worker():
             try:
-                opts = {
-                    "quiet": True,
-                    "no_warnings": True,
-                    "noplaylist": not getattr(item.preset, 'download_playlist', False),
-                }
-                if item.preset.cookies:
-                    opts["cookiefile"] = item.preset.cookies
-                with YoutubeDL(opts) as ydl:
-                    info = ydl.extract_info(item.url, download=False)
-                title = info.get("title") or "Без названия"
-                item.title = title
-                self.after(0, lambda: self._queue_set_title_cell(item))
-            except Exception:
-                pass
-        threading.Thread(target=worker, daemon=True).start()
+                items = self.engine.sync_subscriptions()
+                if items:
+                    self._queue_add_items(items, probe=False)
+                self._append_log(f"Подписки проверены: в очередь добавлено {len(items)}.")
+            finally:
+                self._ui_call(lambda: self.sync_subs_btn.configure(state="normal"))
 
-    def _queue_set_title_cell(self, item: QueueItem):
-        iid = str(id(item))
+        threading.Thread(target=worker, name="subscriptions", daemon=True).start()
+
+    def _on_import_archive(self):
+        if not self.engine.archive:
+            messagebox.showwarning("Архив", "Архив скачанного недоступен.")
+            return
+        path = filedialog.askopenfilename(
+            title="Файл архива yt-dlp (--download-archive)",
+            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")],
+        )
+        if not path:
+            return
         try:
-            display = self._ellipsize(item.title or "Без названия", MAX_QUEUE_TITLE)
-            self.queue_tv.set(iid, "title", display)
-        except Exception:
-            pass
+            added = self.engine.archive.import_ytdlp_archive(path)
+        except (OSError, sqlite3.Error) as e:
+            messagebox.showerror("Архив", f"Не удалось импортировать архив:\n{e}")
+            return
+        self._append_log(f"Импортировано из архива yt-dlp: {added} новых записей.")
 
-    def _auto_rename_result(
-        self,
-        path: Optional[str],
-        v_short: str,
-        a_short: str,
-        height: Optional[int],
-        ext_from_info: Optional[str],
-        title_hint: Optional[str] = None,
-        video_id_hint: Optional[str] = None,
-    ):
-        """Переименовать итоговый файл в <v>_<a>_<h>_<Title>.<ext> с защитой по длине пути."""
+    def _run_queue(self):
+        workers = self._queue_workers_count()
+        items = list(self.queue)
+        self._queue_run_total = len(items)
+        with self._active_lock:
+            self._active_items.clear()
+        self._append_log(f"Параллельных загрузок: {workers}")
         try:
-            if not path or not os.path.isfile(path):
-                return
+            self.engine.run_queue(items, workers)
+            self._append_log("Итог очереди: " + self.engine.telemetry.summary_line())
+            self._append_log(self.metadata_cache.stats_line())
+            if self.engine.archive:
+                self._append_log(self.engine.archive.stats_line())
+            if self.cancel_event.is_set():
+                self._append_log("Очередь прервана пользователем.")
+            else:
+                self._append_log("Очередь завершена.")
+                self._refresh_queue_summary()
+                self._set_status("Очередь завершена ✅")
+        finally:
+            self.queue_running = False
+            self._ui_call(lambda: self._toggle_controls(downloading=False, queue_mode=True))
 
-            folder = os.path.dirname(path)
-            orig_base, old_ext = os.path.splitext(os.path.basename(path))
-            ext = (ext_from_info or old_ext.lstrip(".") or "mkv").lower()
+    # ------------------------ Загрузка ------------------------
 
-            # 1) Берём нормальное название из info_dict
-            base = self._sanitize_title(title_hint)
-            if not base:
-                base = self._sanitize_title(orig_base)
+    def _run_single_download_thread(self, url: str, preset: DownloadPreset, queue_item: Optional[QueueItem]):
+        if self.engine.download_with_retry(url, preset) == "success":
+            self.engine.archive_result(url, preset)
+        self._ui_call(lambda: self._toggle_controls(downloading=False, queue_mode=False))
 
-            # 2) Убираем дублирующееся расширение внутри base (например, "...webm" в заголовке)
-            if base.lower().endswith(f".{ext}"):
-                base = base[: -(len(ext) + 1)]
+    # ---- «Проба» названий для очереди (ограниченный пул) ----
 
-            # 3) Крайний fallback — id/время
-            if not base:
-                vid = (video_id_hint or "").strip()
-                base = f"video_{vid}" if vid else f"video_{int(time.time())}"
+    def _probe_pool_key(self, item: QueueItem) -> tuple:
+        preset = item.preset
+        return (item.url.strip(), preset.cookies or "", not getattr(preset, 'download_playlist', False))
 
-            h_part = f"{height}" if height else ""
-            # Сначала строим базу без учёта ограничения пути
-            new_base = f"{v_short}_{a_short}_{h_part}_{base}".replace("__", "_").strip("_")
-            new_name = f"{new_base}.{ext}"
-            candidate = os.path.join(folder, new_name)
+    def _probe_title_async(self, item: QueueItem, priority: int = ProbePool.PRIORITY_NORMAL):
+        self._probe_pool.submit(self._probe_pool_key(item), item, priority)
 
-            # 4) Если путь длинный — ужмём только Title (часть после префикса кодеков/высоты)
-            if len(candidate) > SAFE_MAX_PATH:
-                prefix = f"{v_short}_{a_short}_{h_part}_".replace("__", "_").strip("_")
-                if prefix:
-                    prefix += "_"
-                # сколько максимум можем оставить для Title
-                extra = len(candidate) - SAFE_MAX_PATH
-                # допустимая длина Title
-                allowed = max(MIN_BASE_LEN, len(base) - extra)
-                base = self._ellipsize(base, allowed)
-                new_base = f"{prefix}{base}".strip("_")
-                new_name = f"{new_base}.{ext}"
-                candidate = os.path.join(folder, new_name)
+    def _probe_queue_items(self, items: List[QueueItem]):
+        """Одна проба на ссылку: название всем элементам, info — в кэш (его подхватит загрузка)."""
+        items = [it for it in items if it in self.queue]
+        if not items:
+            return
+        preset = items[0].preset
+        info, cached = self.engine.probe_metadata(items[0].url, preset)
+        if not cached and info.get("_type") != "playlist":
+            # плейлисты в кэш не попадают — держим info на элементе до загрузки
+            key = self.engine.probe_key(preset)
+            for it in items:
+                if self.engine.probe_key(it.preset) == key:
+                    it.info, it.info_key, it.info_ts = info, key, time.time()
+        title = info.get("title") or "Без названия"
+        size = self.engine.estimate_size(info)
+        for it in items:
+            it.title = title
+            # в кэше мог лежать выбор другого пресета — считаем выбор каждой задачи по её пресету
+            it.plan = self.engine.plan_formats(info, it.preset)
+            self.engine.telemetry.set_estimate(it, (it.plan.size if it.plan and it.plan.size else size))
+            if self.queue_store:
+                self.queue_store.update_title(it)
+            self.queue_view.invalidate(it)
+
+    def _probe_workers_count(self) -> int:
+        try:
+            n = int(self.probe_workers_var.get())
+        except Exception:
+            n = DEFAULT_PROBE_WORKERS
+        return max(1, min(MAX_PROBE_WORKERS, n))
 
-            # 5) Защита от коллизий имён
-            if os.path.abspath(candidate) != os.path.abspath(path):
-                cnt = 1
-                unique_candidate = candidate
-                while os.path.exists(unique_candidate):
-                    unique_candidate = os.path.join(folder, f"{os.path.splitext(new_name)[0]}({cnt}).{ext}")
-                    cnt += 1
-                os.replace(path, unique_candidate)
-                self._append_log(f"Переименовано: {os.path.basename(path)} → {os.path.basename(unique_candidate)}")
-                self.last_output_path = unique_candidate
-        except Exception as e:
-            self._append_log(f"Не удалось переименовать файл: {e}")
+    def _on_probe_workers_changed(self):
+        self._probe_pool.set_workers(self._probe_workers_count())
+        self._save_settings_debounced()
 
-    def _progress_hook_factory(self, queue_item: Optional[QueueItem] = None):
-        def hook(d):
-            if self.cancel_event.is_set():
-                raise KeyboardInterrupt("Загрузка отменена пользователем")
-            status = d.get("status")
-            if status == "downloading":
-                total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
-                downloaded = d.get("downloaded_bytes") or 0
-                percent = 0.0
-                if total:
-                    percent = downloaded / total * 100.0
-                speed = d.get("speed")
-                eta = d.get("eta")
-                self.progress.after(0, lambda p=percent: self.progress.configure(value=p))
-                speed_txt = human_readable_size(speed) + "/s" if speed else "Unknown B/s"
-                eta_txt = seconds_to_hms(int(eta)) if eta is not None else "Unknown"
-                size_txt = f"{human_readable_size(downloaded)} of {human_readable_size(total)}" if total else f"{human_readable_size(downloaded)} of Unknown"
-                prefix = ""
-                if queue_item:
-                    try:
-                        idx = self.queue.index(queue_item) + 1
-                        prefix = f"[{idx}/{len(self.queue)}] "
-                    except Exception:
-                        prefix = ""
-                self._set_status(f"{prefix}Скачивание: {percent:.1f}%  |  {size_txt}  |  Скорость: {speed_txt}  |  Осталось: {eta_txt}")
+    def _on_probe_progress(self):
+        line = self._probe_pool.progress_line()
+        self.progress_channel.publish("probe_status", line)
 
-                raw_line = f"[download] {percent:5.1f}% of {size_txt} at {speed_txt} ETA {eta_txt}"
-                self._append_raw_throttled(raw_line, percent)
+    def _on_queue_view_changed(self, _event=None):
+        """После прокрутки/ресайза — поднимаем приоритет проб для видимых строк (с небольшим дебаунсом)."""
+        if self._visible_probe_after is not None:
+            try:
+                self.after_cancel(self._visible_probe_after)
+            except Exception:
+                pass
+        self._visible_probe_after = self.after(150, self._prioritize_visible_probes)
 
-            elif status == "finished":
-                self.progress.after(0, lambda: self.progress.configure(value=100))
-                self._set_status("Файл загружен, идет пост-обработка (объединение/конвертация)...")
-                self._append_raw("[download] 100.0% — файл загружен, пост-обработка…")
-            elif status == "error":
-                self._set_status("Ошибка загрузки.")
-                self._append_raw("[download] ERROR")
-        return hook
+    def _prioritize_visible_probes(self):
+        self._visible_probe_after = None
+        if not self._probe_pool.busy():
+            return
+        keys = [self._probe_pool_key(it) for it in self.queue_view.visible_items() if not it.title]
+        if keys:
+            self._probe_pool.prioritize(keys)
 
     # ------------------------ Переключение доступности ------------------------
 
@@ -1817,65 +5835,78 @@ class DownloaderApp(tk.Tk):
         if downloading and queue_mode:
             self.start_queue_btn.configure(state="disabled")
             self.clear_queue_btn.configure(state="disabled")
+            self.queue_workers_sb.configure(state="disabled")
         else:
             self.start_queue_btn.configure(state="normal")
             self.clear_queue_btn.configure(state="normal")
+            self.queue_workers_sb.configure(state="readonly")
 
         self.cancel_btn.configure(state=("normal" if downloading else "disabled"))
 
     # ------------------------ Очередь: UI обновления ------------------------
 
-    def _queue_insert_tv(self, item: QueueItem):
-        v = self._norm_vcodec_choice(item.preset.vcodec_choice)
-        a = self._norm_acodec_choice(item.preset.acodec_choice)
-        c = self._norm_container_choice(item.preset.container_choice)
+    def _queue_row_values(self, item: QueueItem) -> tuple:
+        v = self.engine.norm_vcodec_choice(item.preset.vcodec_choice)
+        a = self.engine.norm_acodec_choice(item.preset.acodec_choice)
+        c = self.engine.norm_container_choice(item.preset.container_choice)
         title_display = self._ellipsize(item.title or "Получаю название…", MAX_QUEUE_TITLE)
+        detail = item.detail
+        if not detail and item.status == "Ожидает" and item.size_estimate:
+            detail = f"≈{human_readable_size(item.size_estimate)}"
+        plan = item.plan
         if getattr(item.preset, 'audio_only', False):
             fmt_info = AUDIO_FORMAT_OPTIONS.get(item.preset.audio_format, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
-            values = (
+            acodec = fmt_info['codec'].upper()
+            if plan and plan.acodec:
+                acodec = f"{plan.acodec.upper()}→{acodec}" if plan.transcode else f"{acodec} (копия)"
+            return (
                 title_display,
                 f"Аудио {fmt_info['label']}",
                 '—',
-                fmt_info['codec'].upper(),
+                acodec,
                 fmt_info.get('extension', fmt_info['codec']).upper(),
                 item.status,
+                detail,
             )
-        else:
-            values = (
+        if plan:
+            # что выберет селектор по известному списку форматов, а не только что заказано в пресете
+            return (
                 title_display,
-                f"{item.preset.height}p",
-                (v.upper() if v != "auto" else "AUTO"),
-                (a.upper() if a != "auto" else "AUTO"),
-                (c.upper() if c != "auto" else "AUTO"),
+                f"{plan.height}p" if plan.height else f"{item.preset.height}p",
+                plan.vcodec.upper() or "—",
+                plan.acodec.upper() or "—",
+                plan.container.upper(),
                 item.status,
+                detail,
             )
-        self.queue_tv.insert("", "end", iid=str(id(item)), values=values)
-
-    def _queue_update_status(self, item: QueueItem, status: str):
-        item.status = status
-        try:
-            self.queue_tv.set(str(id(item)), "status", status)
-        except Exception:
-            pass
+        return (
+            title_display,
+            f"{item.preset.height}p",
+            (v.upper() if v != "auto" else "AUTO"),
+            (a.upper() if a != "auto" else "AUTO"),
+            (c.upper() if c != "auto" else "AUTO"),
+            item.status,
+            detail,
+        )
 
-    def _queue_remove_item(self, item: QueueItem):
-        try:
-            self.queue.remove(item)
-        except ValueError:
-            pass
-        try:
-            self.queue_tv.delete(str(id(item)))
-        except Exception:
-            pass
+    def _queue_remove_item(self, item: QueueItem, keep_history: bool = False):
+        self.queue.discard(item)
+        with self._active_lock:
+            self._active_items.pop(item.uid, None)
+        if self.queue_store:
+            if keep_history:
+                self.queue_store.archive(item)
+            else:
+                self.queue_store.delete([item])
+        self.queue_view.invalidate()
 
     # ------------------------ Контекстное меню и редактирование ------------------------
 
     def _on_queue_right_click(self, event):
-        iid = self.queue_tv.identify_row(event.y)
-        if iid:
-            if iid not in self.queue_tv.selection():
-                self.queue_tv.selection_set(iid)
-                self.queue_tv.focus(iid)
+        item = self.queue_view.item_at(event.y)
+        if item:
+            if item not in self.queue_view.selected_items():
+                self.queue_view.select(item)
             state = "disabled" if self.queue_running else "normal"
             try:
                 self._queue_menu.entryconfig(self._MENU_IDX_EDIT, state=state)
@@ -1887,15 +5918,12 @@ class DownloaderApp(tk.Tk):
             finally:
                 self._queue_menu.grab_release()
         else:
-            self.queue_tv.selection_remove(self.queue_tv.selection())
+            self.queue_view.clear_selection()
 
     def _on_queue_double_click(self, event):
         if self.queue_running:
             return
-        sel = self.queue_tv.selection()
-        if not sel:
-            return
-        item = self._queue_item_by_iid(sel[0])
+        item = self.queue_view.item_at(event.y)
         if item:
             self._edit_queue_item(item)
 
@@ -1903,7 +5931,7 @@ class DownloaderApp(tk.Tk):
         if self.queue_running:
             messagebox.showwarning("Очередь выполняется", "Остановите очередь перед изменениями.")
             return
-        sel = list(self.queue_tv.selection())
+        sel = self.queue_view.selected_items()
         if not sel:
             return
         confirm = messagebox.askyesno(
@@ -1912,53 +5940,31 @@ class DownloaderApp(tk.Tk):
         )
         if not confirm:
             return
-        removed = 0
-        for iid in sel:
-            item = self._queue_item_by_iid(iid)
-            if item:
-                self._queue_remove_item(item)
-                removed += 1
-        if removed:
-            self._append_log(f"Удалено из очереди: {removed}")
+        for item in sel:
+            self._queue_remove_item(item)
+        self._append_log(f"Удалено из очереди: {len(sel)}")
+
+    def _on_queue_history_selected(self):
+        sel = self.queue_view.selected_items()
+        if not sel:
+            return
+        item = sel[0]
+        lines = []
+        for entry in item.history:
+            when = time.strftime("%d.%m %H:%M:%S", time.localtime(entry.get("ts", 0)))
+            label = RETRY_POLICIES.get(entry.get("kind"), RETRY_POLICIES["other"])["label"]
+            retry = f" → повтор через {entry['retry_in']:.0f} с" if entry.get("retry_in") is not None else ""
+            lines.append(f"{when}  {label}{retry}\n    {entry.get('error', '')}")
+        messagebox.showinfo("История попыток", f"{item.title or item.url}\n\n" +
+                            ("\n".join(lines) if lines else "Неудачных попыток не было."))
 
     def _on_queue_edit_selected(self):
         if self.queue_running:
             messagebox.showwarning("Очередь выполняется", "Остановите очередь перед изменениями.")
             return
-        sel = self.queue_tv.selection()
-        if not sel:
-            return
-        item = self._queue_item_by_iid(sel[0])
-        if item:
-            self._edit_queue_item(item)
-
-    def _queue_item_by_iid(self, iid: str) -> Optional[QueueItem]:
-        for it in self.queue:
-            if str(id(it)) == iid:
-                return it
-        return None
-
-    def _update_queue_tv_row(self, item: QueueItem):
-        iid = str(id(item))
-        v = self._norm_vcodec_choice(item.preset.vcodec_choice)
-        a = self._norm_acodec_choice(item.preset.acodec_choice)
-        c = self._norm_container_choice(item.preset.container_choice)
-        try:
-            if getattr(item.preset, 'audio_only', False):
-                fmt_info = AUDIO_FORMAT_OPTIONS.get(item.preset.audio_format, AUDIO_FORMAT_OPTIONS[DEFAULT_AUDIO_FORMAT])
-                quality = f"Аудио {fmt_info['label']}"
-                self.queue_tv.set(iid, "quality", quality)
-                self.queue_tv.set(iid, "vcodec", '—')
-                self.queue_tv.set(iid, "acodec", fmt_info['codec'].upper())
-                self.queue_tv.set(iid, "container", fmt_info.get('extension', fmt_info['codec']).upper())
-            else:
-                self.queue_tv.set(iid, "quality", f"{item.preset.height}p")
-                self.queue_tv.set(iid, "vcodec", (v.upper() if v != "auto" else "AUTO"))
-                self.queue_tv.set(iid, "acodec", (a.upper() if a != "auto" else "AUTO"))
-                self.queue_tv.set(iid, "container", (c.upper() if c != "auto" else "AUTO"))
-            self._queue_set_title_cell(item)
-        except Exception:
-            pass
+        sel = self.queue_view.selected_items()
+        if sel:
+            self._edit_queue_item(sel[0])
 
     def _edit_queue_item(self, item: QueueItem):
         win = tk.Toplevel(self)
@@ -2063,8 +6069,14 @@ class DownloaderApp(tk.Tk):
         subtitle_entry = ttk.Entry(frm, textvariable=subtitle_var, width=30)
         subtitle_entry.grid(row=8, column=3, sticky='we', pady=(5, 0))
 
+        plan_var = tk.StringVar(value="")
+        ttk.Label(frm, textvariable=plan_var, foreground="#555").grid(row=9, column=0, columnspan=4, sticky="w", pady=(8, 0))
+        # список форматов — из пробы задачи или дискового кэша; по нему выбор считается без сети
+        plan_info = item.info or self.metadata_cache.get(
+            item.url, item.preset.cookies, not getattr(item.preset, 'download_playlist', False))
+
         btns = ttk.Frame(frm)
-        btns.grid(row=9, column=0, columnspan=4, sticky="e", pady=(10, 0))
+        btns.grid(row=10, column=0, columnspan=4, sticky="e", pady=(10, 0))
 
         def refresh_audio_quality():
             fmt_key = audio_format_var.get()
@@ -2107,14 +6119,14 @@ class DownloaderApp(tk.Tk):
         if not audio_only_var.get():
             audio_format_cb.configure(state='disabled')
 
-        def on_ok():
+        def collect_preset() -> DownloadPreset:
             height_map = {
                 "480p": 480, "720p": 720, "1080p": 1080,
                 "1440p (2K)": 1440, "2160p (4K)": 2160, "4320p (8K)": 4320
             }
             h = height_map.get(q_var.get(), 1080)
             subtitles_list = tuple(lang.strip() for lang in subtitle_var.get().split(',') if lang.strip())
-            new_preset = DownloadPreset(
+            return DownloadPreset(
                 height=h,
                 vcodec_choice=v_var.get(),
                 acodec_choice=a_var.get(),
@@ -2131,8 +6143,32 @@ class DownloaderApp(tk.Tk):
                 write_subtitles=bool(write_subs_var.get()),
                 embed_subtitles=bool(embed_subs_var.get()),
             )
+
+        def refresh_plan(*_):
+            plan = self.engine.plan_formats(plan_info, collect_preset())
+            if plan is None:
+                plan_var.set("Будет выбрано: станет известно после пробы ссылки." if not plan_info else "")
+                return
+            text = f"Будет выбрано: {plan.summary()}"
+            if plan.warning:
+                text += f"\n{plan.warning}"
+            plan_var.set(text)
+
+        for var in (q_var, v_var, a_var, c_var, alang_var, audio_only_var, audio_format_var, audio_quality_var):
+            var.trace_add('write', refresh_plan)
+        refresh_plan()
+
+        def on_ok():
+            new_preset = collect_preset()
             item.preset = new_preset
-            self._update_queue_tv_row(item)
+            if item.info_key != self.engine.probe_key(new_preset):
+                item.info = None
+            item.plan = self.engine.plan_formats(plan_info, new_preset)
+            if item.plan and item.plan.size:
+                self.engine.telemetry.set_estimate(item, item.plan.size)
+            if self.queue_store:
+                self.queue_store.update_preset(item)
+            self.queue_view.invalidate(item)
             self._append_log("Пресет задачи обновлён.")
             win.destroy()
 
@@ -2242,6 +6278,20 @@ class DownloaderApp(tk.Tk):
         self.outtmpl_var.set(cfg.get("outtmpl", self.outtmpl_var.get()))
         self.cookies_var.set(cfg.get("cookies", self.cookies_var.get()))
         self.url_var.set(cfg.get("last_url", self.url_var.get()))
+        try:
+            self.queue_workers_var.set(max(1, min(MAX_QUEUE_WORKERS, int(cfg.get("queue_workers", DEFAULT_QUEUE_WORKERS)))))
+        except (TypeError, ValueError):
+            self.queue_workers_var.set(DEFAULT_QUEUE_WORKERS)
+        try:
+            self.probe_workers_var.set(max(1, min(MAX_PROBE_WORKERS, int(cfg.get("probe_workers", DEFAULT_PROBE_WORKERS)))))
+        except (TypeError, ValueError):
+            self.probe_workers_var.set(DEFAULT_PROBE_WORKERS)
+        self.redownload_var.set(1 if cfg.get("redownload_changed_preset", False) else 0)
+        self.rate_limit_var.set(cfg.get("rate_limit", ""))
+        self.rate_limit_item_var.set(cfg.get("rate_limit_per_download", ""))
+        self.rate_schedule_var.set(cfg.get("rate_schedule", ""))
+        self._apply_bandwidth_settings(quiet=True)
+        self.engine.redownload_if_preset_differs = bool(self.redownload_var.get())
 
         self._refresh_audio_quality_values()
         self._on_audio_only_toggle(init=True)
@@ -2276,6 +6326,12 @@ class DownloaderApp(tk.Tk):
             "outtmpl": self.outtmpl_var.get(),
             "cookies": self.cookies_var.get(),
             "last_url": self.url_var.get(),
+            "queue_workers": self._queue_workers_count(),
+            "probe_workers": self._probe_workers_count(),
+            "redownload_changed_preset": bool(self.redownload_var.get()),
+            "rate_limit": self.rate_limit_var.get().strip(),
+            "rate_limit_per_download": self.rate_limit_item_var.get().strip(),
+            "rate_schedule": self.rate_schedule_var.get().strip(),
         }
         try:
             with open(CONFIG_PATH, "w", encoding="utf-8") as f:
@@ -2288,6 +6344,13 @@ class DownloaderApp(tk.Tk):
             self._save_settings()
         except Exception:
             pass
+        self.log_sink.stop()
+        if self.queue_store:
+            self.queue_store.close()
+        if self.engine.archive:
+            self.engine.archive.close()
+        if self.engine.subscriptions:
+            self.engine.subscriptions.close()
         self.destroy()
 
     # ------------------------ Запуск приложения ------------------------
@@ -2296,6 +6359,325 @@ class DownloaderApp(tk.Tk):
         self.mainloop()
 
 
-if __name__ == "__main__":
+# ------------------------ Консольный / фоновый режим ------------------------
+
+class ConsoleListener(EngineListener):
+    """Вывод движка в консоль: важные сообщения всегда, подробный поток yt-dlp — только с --verbose."""
+
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self.results: Dict[str, int] = {}
+
+    def _print(self, msg: str, stream=None):
+        with self._lock:
+            print(f"[{time.strftime('%H:%M:%S')}] {msg}", file=stream or sys.stdout, flush=True)
+
+    def log(self, msg: str):
+        self._print(msg)
+
+    def raw(self, msg: str):
+        if self.verbose:
+            self._print(msg)
+
+    def status(self, text: str):
+        if self.verbose:
+            self._print(text)
+
+    def item_state(self, item: QueueItem, status: str):
+        suffix = f" — {item.detail}" if status.startswith(("Повтор", "Ждёт места")) and item.detail else ""
+        self._print(f"{status}: {item.title or item.url}{suffix}")
+
+    def error(self, item: Optional[QueueItem], message: str):
+        self._print(f"[ОШИБКА] {(item.title or item.url) if item else ''} {message}", sys.stderr)
+
+    def item_finished(self, item: QueueItem, result: str):
+        with self._lock:
+            self.results[result] = self.results.get(result, 0) + 1
+
+
+_CLI_VCODECS = {"auto": "Авто", "av1": "AV1 (av01)", "vp9": "VP9 (vp9)", "h264": "H.264 (avc1)"}
+_CLI_ACODECS = {"auto": "Авто", "opus": "Opus (opus)", "aac": "AAC (mp4a)", "vorbis": "Vorbis (vorbis)"}
+
+
+def preset_from_config(cfg: dict) -> DownloadPreset:
+    """Пресет из словаря в формате конфига GUI (CONFIG_PATH) — те же ключи, что пишет _save_settings."""
+    audio_format = cfg.get("audio_format", DEFAULT_AUDIO_FORMAT)
+    if audio_format not in AUDIO_FORMAT_OPTIONS:
+        audio_format = DEFAULT_AUDIO_FORMAT
+    return DownloadPreset(
+        height=QUALITY_HEIGHTS.get(cfg.get("quality", "1080p"), 1080),
+        vcodec_choice=cfg.get("vcodec", "Авто"),
+        acodec_choice=cfg.get("acodec", "Авто"),
+        alang_choice=cfg.get("audio_lang", "orig") or "orig",
+        container_choice=cfg.get("container", "Авто"),
+        outdir=cfg.get("outdir") or os.path.join(os.path.expanduser("~"), "Downloads"),
+        outtmpl_user=cfg.get("outtmpl") or "%(title)s.%(ext)s",
+        cookies=(cfg.get("cookies") or None),
+        audio_only=bool(cfg.get("audio_only", False)),
+        audio_format=audio_format,
+        audio_quality=str(cfg.get("audio_quality", DEFAULT_AUDIO_QUALITY)),
+        download_playlist=bool(cfg.get("download_playlist", False)),
+        subtitle_langs=tuple(cfg.get("subtitle_langs") or ()),
+        write_subtitles=bool(cfg.get("write_subtitles", False)),
+        embed_subtitles=bool(cfg.get("embed_subtitles", False)),
+    )
+
+
+def _cli_preset(args) -> DownloadPreset:
+    """--preset (JSON в формате конфига GUI; по умолчанию — сам конфиг GUI) + переопределения из аргументов."""
+    cfg = {}
+    path = args.preset or CONFIG_PATH
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            cfg = json.load(f)
+    elif args.preset:
+        raise SystemExit(f"Файл пресета не найден: {args.preset}")
+    preset = preset_from_config(cfg)
+    if args.quality:
+        preset.height = int(str(args.quality).lower().rstrip("p"))
+    if args.vcodec:
+        preset.vcodec_choice = _CLI_VCODECS[args.vcodec]
+    if args.acodec:
+        preset.acodec_choice = _CLI_ACODECS[args.acodec]
+    if args.container:
+        preset.container_choice = "Авто" if args.container == "auto" else args.container
+    if args.lang:
+        preset.alang_choice = args.lang
+    if args.audio_only:
+        preset.audio_only = True
+    if args.audio_format:
+        preset.audio_format = args.audio_format
+    if args.audio_quality:
+        preset.audio_quality = args.audio_quality
+    if args.playlist:
+        preset.download_playlist = True
+    if args.outdir:
+        preset.outdir = args.outdir
+    if args.cookies:
+        preset.cookies = args.cookies
+    return preset
+
+
+def _build_arg_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(
+        description="YouTube Downloader (yt-dlp). Без аргументов запускается окно; "
+                    "со ссылками/--batch/--daemon — консольный режим без дисплея.",
+    )
+    ap.add_argument("urls", nargs="*", help="ссылки для загрузки")
+    ap.add_argument("--batch", action="append", default=[], metavar="FILE",
+                    help=".txt со ссылками (по одной на строку); можно указать несколько раз")
+    ap.add_argument("--workers", type=int, default=DEFAULT_QUEUE_WORKERS, help="параллельных загрузок")
+    ap.add_argument("--preset", metavar="JSON",
+                    help="пресет в формате конфига GUI (по умолчанию — настройки окна)")
+    ap.add_argument("--quality", help="макс. высота кадра: 480/720/1080/1440/2160/4320")
+    ap.add_argument("--vcodec", choices=sorted(_CLI_VCODECS))
+    ap.add_argument("--acodec", choices=sorted(_CLI_ACODECS))
+    ap.add_argument("--container", choices=["auto", "mp4", "mkv", "webm"])
+    ap.add_argument("--lang", help="язык аудиодорожки: orig или ISO-код")
+    ap.add_argument("--audio-only", action="store_true")
+    ap.add_argument("--audio-format", choices=sorted(AUDIO_FORMAT_OPTIONS))
+    ap.add_argument("--audio-quality")
+    ap.add_argument("--playlist", action="store_true", help="скачивать плейлист целиком")
+    ap.add_argument("--outdir")
+    ap.add_argument("--cookies", metavar="COOKIES_TXT")
+    ap.add_argument("--no-archive", action="store_true", help="не сверяться с архивом скачанного и не пополнять его")
+    ap.add_argument("--redownload-changed", action="store_true",
+                    help="уже скачанное перекачивать, если пресет (качество/кодеки/контейнер/аудио) другой")
+    ap.add_argument("--import-archive", metavar="FILE", help="импортировать текстовый архив yt-dlp (--download-archive)")
+    ap.add_argument("--limit-rate", metavar="RATE", help="общий лимит скорости на все загрузки: 500K, 2M, ...")
+    ap.add_argument("--limit-rate-per-download", metavar="RATE", help="лимит скорости одной загрузки (поверх общего)")
+    ap.add_argument("--schedule", metavar="WINDOWS", help="лимит по времени суток: \"09:00-18:00=2M, 22:00-07:00=0\"")
+    ap.add_argument("--limit-file", metavar="FILE",
+                    help="файл с лимитом (1-я строка) и окнами расписания (остальные); меняется без перезапуска")
+    ap.add_argument("--meta-rps", type=float, metavar="N",
+                    help=f"запросов метаданных в секунду к одному сайту (по умолчанию {HOST_LIMITS['meta']['rps']:g})")
+    ap.add_argument("--max-extractions", type=int, metavar="N",
+                    help=f"одновременных извлечений метаданных с одного сайта (по умолчанию {HOST_LIMITS['meta']['inflight']})")
+    ap.add_argument("--pp-workers", type=int, default=POSTPROC_WORKERS, metavar="N",
+                    help=f"потоков пост-обработки ffmpeg (по умолчанию — по числу ядер, {POSTPROC_WORKERS})")
+    ap.add_argument("--stats-file", default=QUEUE_STATS_PATH, metavar="JSON",
+                    help="куда писать сводку (скорость, ETA, байты, задач/ч); пустая строка — не писать")
+    ap.add_argument("--stats-every", type=float, default=15.0, metavar="SECONDS",
+                    help="как часто печатать сводку в консоль (0 — только итог)")
+    ap.add_argument("--sub-add", metavar="URL", action="append", default=[],
+                    help="подписаться на канал/плейлист (пресет — из остальных параметров); можно несколько раз")
+    ap.add_argument("--sub-name", help="название для --sub-add")
+    ap.add_argument("--backfill", action="store_true", help="для --sub-add: скачать и уже вышедшие видео")
+    ap.add_argument("--sub-remove", metavar="ID|URL", action="append", default=[], help="удалить подписку")
+    ap.add_argument("--sub-list", action="store_true", help="показать подписки")
+    ap.add_argument("--sync", action="store_true", help="проверить подписки и скачать новые видео")
+    ap.add_argument("--sync-every", type=float, default=0.0, metavar="MINUTES",
+                    help="в режиме --daemon: проверять подписки с этим периодом")
+    ap.add_argument("--daemon", action="store_true",
+                    help="не завершаться: следить за --batch файлами и докачивать новые ссылки")
+    ap.add_argument("--poll", type=float, default=30.0, help="период проверки --batch файлов в режиме --daemon, с")
+    ap.add_argument("-v", "--verbose", action="store_true", help="подробный вывод yt-dlp")
+    return ap
+
+
+def _watch_limit_file(path: str, engine: DownloadEngine, listener: ConsoleListener):
+    """--limit-file: первая строка — лимит (2M / 0), остальные — окна расписания; файл перечитывается на лету."""
+    last_mtime = None
+    while not engine.cancel_event.wait(2.0):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            rate = parse_rate(lines[0] if lines else "")
+            windows = parse_schedule("\n".join(lines[1:]))
+        except (OSError, ValueError) as e:
+            listener.log(f"{os.path.basename(path)}: {e}")
+            continue
+        engine.governor.set_rate(rate)
+        engine.governor.set_schedule(windows)
+        listener.log(f"Лимит скорости: {engine.governor.describe()}")
+
+
+def run_cli(args) -> int:
+    listener = ConsoleListener(verbose=args.verbose)
+    archive = None if args.no_archive else DownloadArchive(ARCHIVE_DB_PATH)
+    engine = DownloadEngine(listener, archive=archive)
+    engine.redownload_if_preset_differs = args.redownload_changed
+    if args.import_archive:
+        if not archive:
+            raise SystemExit("--import-archive несовместим с --no-archive")
+        listener.log(f"Импортировано из архива yt-dlp: {archive.import_ytdlp_archive(args.import_archive)} новых записей")
+        if not (args.urls or args.batch or args.daemon or args.sync or args.sub_add or args.sub_list):
+            return 0
+    preset = _cli_preset(args)
+    subs_wanted = args.sub_add or args.sub_remove or args.sub_list or args.sync or args.sync_every
+    if subs_wanted:
+        engine.subscriptions = SubscriptionStore(SUBSCRIPTIONS_DB_PATH)
+        for url in args.sub_add:
+            sub = engine.subscriptions.add(url, preset, name=args.sub_name, backfill=args.backfill)
+            listener.log(f"Подписка #{sub.id}: {url}")
+        for key in args.sub_remove:
+            listener.log(f"Подписка {key}: {'удалена' if engine.subscriptions.remove(key) else 'не найдена'}")
+        if args.sub_list:
+            for sub in engine.subscriptions.list():
+                last = time.strftime("%Y-%m-%d %H:%M", time.localtime(sub.last_sync_ts)) if sub.last_sync_ts else "—"
+                listener.log(f"#{sub.id} {sub.name or ''} {sub.url} | видео: {sub.seen} | проверка: {last}")
+        if not (args.urls or args.batch or args.daemon or args.sync):
+            return 0
+    os.makedirs(preset.outdir, exist_ok=True)
+    try:
+        engine.governor.set_rate(parse_rate(args.limit_rate or ""))
+        engine.governor.set_download_rate(parse_rate(args.limit_rate_per_download or ""))
+        engine.governor.set_schedule(parse_schedule(args.schedule or ""))
+    except ValueError as e:
+        raise SystemExit(str(e))
+    engine.telemetry.stats_path = args.stats_file or None
+    engine.hosts.set_limits("meta", rps=args.meta_rps, inflight=args.max_extractions)
+    engine.postproc_workers = max(1, args.pp_workers)
+    if args.limit_file:
+        threading.Thread(target=_watch_limit_file, args=(args.limit_file, engine, listener),
+                         name="limit-file", daemon=True).start()
+    listener.log(f"Лимит скорости: {engine.governor.describe()}")
+    workers = max(1, args.workers)
+
+    def on_signal(signum, frame):
+        listener.log("Получен сигнал остановки — завершаем текущие загрузки…")
+        engine.cancel_event.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, on_signal)
+
+    seen = set()
+
+    def new_items(urls: List[str]) -> List[QueueItem]:
+        items = []
+        for url in urls:
+            if url not in seen:
+                seen.add(url)
+                items.append(QueueItem(url=url, preset=preset))
+        return items
+
+    items = new_items(list(args.urls))
+    mtimes: Dict[str, float] = {}
+    for path in args.batch:
+        mtimes[path] = os.path.getmtime(path)
+        items += new_items(read_links_file(path))
+    last_sync = 0.0
+    if args.sync or (args.daemon and args.sync_every):
+        items += engine.sync_subscriptions()
+        last_sync = time.time()
+
+    done = threading.Event()
+
+    def report():
+        while not done.wait(args.stats_every):
+            listener.log(engine.telemetry.summary_line())
+
+    if args.stats_every > 0:
+        threading.Thread(target=report, name="telemetry", daemon=True).start()
+
+    if not args.daemon:
+        listener.log(f"Задач: {len(items)} | параллельно: {workers}")
+        engine.run_queue(items, workers)
+        done.set()
+        listener.log("Итог: " + engine.telemetry.summary_line())
+        if engine.hosts.describe():
+            listener.log("Запросы к сайтам: " + engine.hosts.describe())
+        listener.log(engine.metadata_cache.stats_line())
+        if archive:
+            listener.log(archive.stats_line())
+        listener.log(f"Итог: {listener.results}")
+        return 0 if not listener.results.get("error") and not engine.cancel_event.is_set() else 1
+
+    listener.log(f"Фоновый режим: файлов {len(args.batch)}, параллельно {workers}, проверка раз в {args.poll:g} с"
+                 + (f", подписки — раз в {args.sync_every:g} мин" if args.sync_every else ""))
+    engine.telemetry.begin(items)
+    work = engine.start_work(workers)
+    work.put(items)
+    while not engine.cancel_event.wait(args.poll):
+        for path in args.batch:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if mtimes.get(path) == mtime:
+                continue
+            mtimes[path] = mtime
+            fresh = new_items(read_links_file(path))
+            if fresh:
+                listener.log(f"{os.path.basename(path)}: новых ссылок {len(fresh)}")
+                engine.telemetry.add_items(fresh)
+                work.put(fresh)
+        if args.sync_every and time.time() - last_sync >= args.sync_every * 60:
+            last_sync = time.time()
+            fresh = engine.sync_subscriptions()
+            if fresh:
+                engine.telemetry.add_items(fresh)
+                work.put(fresh)
+    engine.finish_work()
+    done.set()
+    engine.telemetry.write()
+    listener.log(f"Итог: {listener.results}")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _build_arg_parser().parse_args(argv)
+    if (args.urls or args.batch or args.daemon or args.import_archive or args.sub_add or args.sub_remove
+            or args.sub_list or args.sync):
+        try:
+            _ytdlp()
+        except ImportError as e:
+            print(ytdlp_missing_message(e), file=sys.stderr)
+            return 1
+        return run_cli(args)
     app = DownloaderApp()
-    app.run()
\ No newline at end of file
+    app.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())